@@ -19,14 +19,36 @@ import os
 import shutil
 
 from copy import deepcopy
-from libcloud.compute.types import Provider
-from libcloud.compute.providers import get_driver
+from StringIO import StringIO
+from multiprocessing.pool import ThreadPool
+import threading
+from libcloud.compute.base import NodeImage, NodeSize, NodeLocation
+from libcloud.compute.base import KeyPair
+from libcloud.compute.drivers.cloudstack import CloudStackNodeDriver
+from libcloud.compute.drivers.cloudstack import CloudStackNetwork
+from libcloud.compute.drivers.cloudstack import CloudStackNetworkOffering
+from libcloud.compute.drivers.cloudstack import CloudStackAddress
+from libcloud.common.cloudstack import CloudStackConnection
+from libcloud.common.types import MalformedResponseError
+from libcloud.common.types import ProviderError
 import yaml
+import base64
+import collections
 import errno
+import functools
+import gzip
+import hashlib
+import heapq
+import httplib
+import json
+import pipes
+import socket
 import time
+import urllib2
+import urlparse
+import uuid
 
-from fabric.api import put, env
-from fabric.context_managers import settings
+import paramiko
 
 import libcloud.security
 # from CLI
@@ -47,11 +69,119 @@ lgr, flgr = init_logger()
 
 CONFIG_FILE_NAME = 'cloudify-config.yaml'
 DEFAULTS_CONFIG_FILE_NAME = 'cloudify-config.defaults.yaml'
+# cloudify.resources_prefix of the shipped config, resources are not
+# prefixed until it is changed
+DEFAULT_RESOURCES_PREFIX = 'your_name_here'
+
+# number of worker threads used for concurrent api calls
+DEFAULT_CONCURRENCY = 8
+
+# local state (caches, registries) is kept next to the cli's log files
+CACHE_DIR = '~/.cloudify'
+DEFAULT_CATALOG_TTL = 24 * 60 * 60
+
+# api commands which never change anything on the cloud
+READ_ONLY_COMMAND_PREFIXES = ('list', 'query', 'get')
+
+# largest base64 encoded userdata cloudstack accepts in a POST body (a
+# GET request takes 2KB), see vm.userdata.max.length
+DEFAULT_USERDATA_MAX_SIZE = 32768
+# api parameters sent in the request body instead of the query string
+BODY_PARAMS = ('userdata',)
+# items per page of paginated listings, at most the cloud's
+# default.page.size
+DEFAULT_PAGE_SIZE = 500
+DEFAULT_DAEMON_SOCKET = '~/.cloudify/cloudstack-daemon.sock'
+# threads shared by all provision_async and teardown_async calls, each
+# running one blocking call
+DEFAULT_ASYNC_WORKERS = 32
+
+# seconds assumed for calls that were never timed on a cloud
+DEFAULT_JOB_ESTIMATES = {
+    'createNetwork': 5,
+    'deleteNetwork': 30,
+    'createSSHKeyPair': 1,
+    'registerSSHKeyPair': 1,
+    'deleteSSHKeyPair': 1,
+    'createSecurityGroup': 1,
+    'authorizeSecurityGroupIngress': 5,
+    'deleteSecurityGroup': 1,
+    'deployVirtualMachine': 180,
+    'destroyVirtualMachine': 60,
+    'createPortForwardingRule': 10,
+    'createVolume': 5,
+    'attachVolume': 15,
+    'deleteVolume': 1,
+    'createAffinityGroup': 1,
+    'deleteAffinityGroup': 1,
+    'createLoadBalancerRule': 5,
+    'assignToLoadBalancerRule': 5,
+    'deleteLoadBalancerRule': 5,
+    'createTags': 1,
+    'resetSSHKeyForVirtualMachine': 10,
+    'startVirtualMachine': 60,
+    'disassociateIpAddress': 5,
+}
 
 
 is_verbose_output = False
 
 
+_async_pool = None
+_async_pool_lock = threading.Lock()
+
+
+def _get_async_pool(provider_config):
+    # one pool for every ProviderManager of the process, so the number
+    # of threads stays bounded however many environments are started.
+    global _async_pool
+    with _async_pool_lock:
+        if _async_pool is None:
+            _async_pool = ThreadPool(provider_config.get(
+                'cloudstack', {}).get('async_workers',
+                                      DEFAULT_ASYNC_WORKERS))
+        return _async_pool
+
+
+_connectors = {}
+_connectors_lock = threading.Lock()
+
+
+def _get_shared_connector(provider_config):
+    # one connector, with its drivers, connections and worker pool, per
+    # api endpoint and account for every ProviderManager of the process.
+    auth = provider_config['authentication']
+    key = (tuple(_get_api_urls(provider_config)), auth['api_key'])
+    with _connectors_lock:
+        connector = _connectors.get(key)
+        if connector is None:
+            connector = CloudstackConnector(provider_config)
+            _connectors[key] = connector
+        return connector
+
+
+def _proxied_by_daemon(method):
+    """
+    runs a ProviderManager method in the local daemon when one is
+    running (see cloudify_cloudstack.daemon), else in this process.
+    the daemon keeps a manager per session for the state of earlier
+    calls, and the config it ends with (the selected account) replaces
+    the config of this manager.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        client = self._get_daemon_client()
+        if client is None:
+            return method(self, *args, **kwargs)
+        lgr.debug('calling {0} through the daemon at {1}'.format(
+            method.__name__, client.socket_path))
+        result, self.provider_config = client.call(
+            method.__name__, self.provider_config, args, kwargs,
+            self.daemon_session)
+        return result
+    return wrapper
+
+
 class ProviderManager(BaseProviderClass):
 
     """class for base methods
@@ -87,9 +217,22 @@ class ProviderManager(BaseProviderClass):
         object. If initialized it will automatically trigger schema validation
         for the provider.
         """
-        self.provider_config = provider_config
         super(ProviderManager, self).__init__(provider_config,
                                               is_verbose_output)
+        # every resource provisioning creates carries the prefix the
+        # orphan sweeper looks for.
+        self.provider_config = _prefix_resource_names(provider_config) \
+            if provider_config else provider_config
+        ssh_config = (provider_config or {}).get('cloudify', {}).get(
+            'bootstrap', {}).get('ssh', {})
+        self.ssh_sessions = CloudstackSSHSessionPool(
+            connection_attempts=ssh_config.get(
+                'initial_connectivity_retries', 25),
+            retry_interval=ssh_config.get(
+                'initial_connectivity_retries_interval', 5),
+            timeout=ssh_config.get('socket_timeout', 10))
+        # the manager the daemon keeps for this one.
+        self.daemon_session = uuid.uuid4().hex
 
     def _get_private_key_path_from_keypair_config(self, keypair_config):
         path = keypair_config['provided']['private_key_filepath'] if \
@@ -98,50 +241,325 @@ class ProviderManager(BaseProviderClass):
         return expanduser(path)
 
     def copy_files_to_manager(self, mgmt_ip, config, ssh_key, ssh_user):
-        def _copy(userhome_on_management, agents_key_path):
-
-            env.user = ssh_user
-            env.key_filename = ssh_key
-            env.abort_on_prompts = False
-            env.connection_attempts = 12
-            env.keepalive = 0
-            env.linewise = False
-            env.pool_size = 0
-            env.skip_bad_hosts = False
-            env.timeout = 5
-            env.forward_agent = True
-            env.status = False
-            env.disable_known_hosts = False
-
-            lgr.info('uploading agents private key to manager')
-            # TODO: handle failed copy operations
-            time.sleep(5)
-            put(agents_key_path, userhome_on_management + '/.ssh')
-
-        def _get_private_key_path_from_keypair_config(keypair_config):
-            path = keypair_config['provided']['private_key_filepath'] if \
-                'provided' in keypair_config else \
-                keypair_config['auto_generated']['private_key_target_path']
-            return expanduser(path)
-
         compute_config = config['compute']
         mgmt_server_config = compute_config['management_server']
+        agents_key_path = self._get_private_key_path_from_keypair_config(
+            compute_config['agent_servers']['agents_keypair'])
+
+        lgr.info('uploading agents private key to manager')
+        ssh = self.ssh_sessions.get(mgmt_ip, ssh_user, ssh_key)
+        CloudstackFileUploader(ssh).upload(
+            [(agents_key_path,
+              '{0}/.ssh/{1}'.format(
+                  mgmt_server_config['userhome_on_management'],
+                  os.path.basename(agents_key_path)))])
+
+    def push_packages(self, mgmt_ip, package_cache, ssh_key, ssh_user):
+        """
+        pushes the cached cloudify packages to the manager in parallel over
+        the bootstrap ssh session and points the package urls of the
+        config at the pushed files.
+        """
+        mgmt_server_config = self.provider_config['compute'][
+            'management_server']
+        remote_dir = self.provider_config['cloudify'].get(
+            'packages_cache', {}).get('remote_dir') or \
+            '{0}/cloudify-packages'.format(
+                mgmt_server_config['userhome_on_management'])
+        package_urls = _get_package_urls(self.provider_config)
+
+        remote_paths = {}
+        uploads = {}
+        for (section, key), url in package_urls.iteritems():
+            remote_path = '{0}/{1}'.format(remote_dir, os.path.basename(
+                urlparse.urlparse(url).path))
+            remote_paths[(section, key)] = remote_path
+            # the same package may be listed more than once.
+            uploads[remote_path] = (package_cache.fetch(url), remote_path)
+
+        lgr.info('pushing {0} packages to the manager'.format(len(uploads)))
+        ssh = self.ssh_sessions.get(mgmt_ip, ssh_user, ssh_key)
+        # every upload runs on its own sftp channel of the same session.
+        pool = ThreadPool(min(len(uploads), DEFAULT_CONCURRENCY) or 1)
+        try:
+            pool.map(lambda upload: CloudstackFileUploader(ssh).upload(
+                [upload]), uploads.values())
+        finally:
+            pool.close()
+            pool.join()
+
+        for (section, key), remote_path in remote_paths.iteritems():
+            self.provider_config['cloudify'][section]['packages'][key] = \
+                remote_path
+
+    @_proxied_by_daemon
+    def bake_template(self, provider_context, name=None):
+        """
+        stops a bootstrapped management server and creates a template
+        from its root volume. later provisioning with the same packages
+        deploys the template instead of the configured image.
+
+        :param dict provider_context: context returned by provision()
+        :param str name: name of the template, derived from the vm name
+        by default
+        :rtype: 'dict' describing the baked template
+        """
+        self._select_account(provider_context)
+        packages_key = provider_context.get('packages_key') or \
+            _get_packages_key(self.provider_config)
+        connector = self._get_connector()
+        try:
+            return CloudstackTemplateBaker(
+                connector, self.provider_config).bake(
+                    provider_context['mgmt_node_id'], packages_key, name)
+        finally:
+            connector.job_timings.save()
+
+    @_proxied_by_daemon
+    def fill_warm_pool(self):
+        """
+        deploys stopped management vms until the warm pool configured in
+        compute.management_server.warm_pool is full.
+
+        :rtype: 'list' with the ids of the deployed vms
+        """
+        connector = self._get_connector()
+        warm_pool = CloudstackWarmPool(connector, self.provider_config)
+        if not warm_pool.is_enabled():
+            raise CloudstackLogicError(
+                'the warm pool needs a size and an existing management '
+                'network in an advanced zone')
+        try:
+            return warm_pool.fill()
+        finally:
+            connector.job_timings.save()
 
-        with settings(host_string=mgmt_ip):
-            _copy(
-                mgmt_server_config['userhome_on_management'],
-                _get_private_key_path_from_keypair_config(
-                    compute_config['agent_servers']['agents_keypair']))
+    def get_ssh_session(self, mgmt_ip):
+        """
+        :rtype: the pooled 'paramiko.SSHClient' connected to the manager
+        by an earlier step, or None.
+        """
+        return self.ssh_sessions.find(mgmt_ip)
 
-    def provision(self):
+    def provision(self, plan=False):
         """
         provisions resources for the management server
 
+        :param bool plan: only print and return the api calls provisioning
+        would make, without changing anything.
         :rtype: 'tuple' with the machine's public and private ip's,
         the ssh key and user configured in the config yaml and
         the prorivder's context (a dict containing the privisioned
         resources to be used during teardown)
         """
+        if plan:
+            return self._plan_provision()
+
+        package_cache = _get_package_cache(self.provider_config)
+        if package_cache is not None:
+            # downloads overlap with creating the vm.
+            package_fetch = package_cache.fetch_in_background(
+                _get_package_urls(self.provider_config).values())
+        provisioned = self._provision_resources()
+
+        mgmt_ip = provisioned['mgmt_ip']
+        mgmt_server_config = self.provider_config['compute'][
+            'management_server']
+        ssh_key = self._get_private_key_path_from_keypair_config(
+            mgmt_server_config['management_keypair'])
+        ssh_user = mgmt_server_config.get('user_on_management')
+        print('management ip: ' + mgmt_ip + ' key name: ' + ssh_key +
+              'user name: ' + ssh_user)
+
+        # the ssh steps run here, so get_ssh_session() finds the sessions
+        # when the cloud resources were created by the daemon.
+        if provisioned['userdata_delivered']:
+            lgr.info('agents private key delivered by userdata')
+        else:
+            if provisioned['provider_context'].get('mgmt_node_ids'):
+                lgr.warn('the agents private key is copied to the first '
+                         'management vm only, enable userdata to deliver '
+                         'it to all of them')
+            self.copy_files_to_manager(mgmt_ip, self.provider_config,
+                                       ssh_key, ssh_user)
+
+        if provisioned['volumes']:
+            # before cloudify installs its services on the mount points.
+            CloudstackDataVolumes(None, self.provider_config).mount(
+                self.ssh_sessions.get(mgmt_ip, ssh_user, ssh_key),
+                provisioned['volumes'])
+
+        if package_cache is not None:
+            package_fetch.get()
+            self.push_packages(mgmt_ip, package_cache, ssh_key, ssh_user)
+
+        return mgmt_ip, mgmt_ip, ssh_key, ssh_user, \
+            provisioned['provider_context']
+
+    @_proxied_by_daemon
+    def _plan_provision(self):
+        self._select_account()
+        return self._get_planner().plan_provision()
+
+    @_proxied_by_daemon
+    def _provision_resources(self):
+        """
+        creates the cloud resources of the management server.
+
+        :rtype: 'dict' with the management ip, the provider context, the
+        attached data volumes and whether userdata delivered the agents key
+        """
+        self._select_account()
+        connector = self._get_connector()
+        try:
+            return self._provision(connector)
+        finally:
+            connector.job_timings.save()
+
+    def provision_async(self, plan=False, callback=None):
+        """
+        starts provision() on the pool of provider worker threads shared
+        by the process and returns at once. provision() still blocks the
+        worker it runs on, so at most cloudstack.async_workers (of the
+        first manager starting one) calls run at a time and the others
+        queue up. calls to the same account share one connector.
+
+        :param callable callback: called with the result of provision()
+        once it succeeded
+        :rtype: 'multiprocessing.pool.AsyncResult' whose get() returns
+        the tuple returned by provision() or raises its error
+        """
+        return _get_async_pool(self.provider_config).apply_async(
+            self.provision, (plan,), callback=callback)
+
+    def teardown_async(self, provider_context, ignore_validation=False,
+                       plan=False, callback=None):
+        """
+        starts teardown() on the pool of provider worker threads shared
+        by the process (see provision_async) and returns at once.
+
+        :rtype: 'multiprocessing.pool.AsyncResult' whose get() returns
+        what teardown() returns or raises its error
+        """
+        return _get_async_pool(self.provider_config).apply_async(
+            self.teardown, (provider_context, ignore_validation, plan),
+            callback=callback)
+
+    @_proxied_by_daemon
+    def preflight(self, needs=None):
+        """
+        checks the account limits and zone capacity against what a
+        provisioning needs.
+
+        :param dict needs: resource name (instance, public_ip, volume,
+        network, cpu, memory in MB, primary_storage in GB) to the count
+        needed, defaults to what provision() needs
+        :rtype: 'list' of the shortfalls (see CloudstackPreflight.check)
+        """
+        self._select_account()
+        return self._preflight(self._get_connector(),
+                               self._get_resolved_resources(), needs)
+
+    def _preflight(self, connector, resolved, needs=None):
+        if needs is None:
+            needs = self._get_provision_needs(connector, resolved)
+        zone = resolved.get('zone')
+        return CloudstackPreflight(connector, self.provider_config).check(
+            needs, zone.id if zone is not None else None)
+
+    def _get_provision_needs(self, connector, resolved):
+        zone_type = self.provider_config['cloudstack']['zone_type'].lower()
+        needs = {}
+        cluster = CloudstackManagerCluster(connector, self.provider_config)
+        if cluster.is_enabled() or not CloudstackWarmPool(
+                connector, self.provider_config, resolved).is_enabled():
+            # a vm claimed from the warm pool is accounted for already.
+            size = resolved['size']
+            count = cluster.size if cluster.is_enabled() else 1
+            needs.update({'instance': count, 'volume': count,
+                          'memory': size.ram * count,
+                          'cpu': int(size.extra.get('cpu') or 0) * count})
+        if zone_type == 'advanced' and resolved.get('network') is None:
+            # the new network and its source nat ip.
+            needs.update({'network': 1, 'public_ip': 1})
+        data_volumes = CloudstackDataVolumes(connector, self.provider_config)
+        if data_volumes.specs:
+            needs['volume'] = needs.get('volume', 0) + len(data_volumes.specs)
+            needs['primary_storage'] = data_volumes.get_size(connector.get())
+        return needs
+
+    @_proxied_by_daemon
+    def place_agents(self, count, size=None):
+        """
+        decides where agent vms go, from a cached capacity snapshot of the
+        zones, pods and networks (see compute.agent_servers.placement).
+
+        :param int count: number of agent vms
+        :param str size: service offering of the agents, defaults to
+        compute.agent_servers.placement.size
+        :rtype: 'list' of placements (see CloudstackPlacementScheduler)
+        """
+        placement_config = self.provider_config['compute'][
+            'agent_servers'].get('placement', {})
+        connector = self._get_connector()
+        size = size or placement_config.get('size')
+        memory = 0
+        if size:
+            memory = _lookup_size(connector.get(), size,
+                                  self._get_resolver().catalog).ram
+        group = placement_config.get('anti_affinity_group')
+        if group:
+            _ensure_affinity_group(connector.get(), group)
+        snapshot = CloudstackCapacitySnapshot(connector, self.provider_config)
+        return CloudstackPlacementScheduler(
+            snapshot, self.provider_config).place(count, memory, group)
+
+    @_proxied_by_daemon
+    def stage_template(self, zones=None):
+        """
+        starts copying the management image (or baked template) to the
+        zones it is missing from.
+
+        :param list zones: zone names, defaults to the management vm's
+        zone and compute.management_server.template_staging.zones
+        :rtype: 'dict' of zone id to 'ready', the copy status or 'failed'
+        """
+        resolved = self._get_resolved_resources()
+        connector = self._get_connector()
+        zone_ids = self._get_staging_zone_ids(connector, resolved, zones)
+        return CloudstackTemplateStager(
+            connector, self.provider_config,
+            resolved['image'].id).stage(zone_ids)
+
+    def _get_staging_config(self):
+        return self.provider_config['compute']['management_server'].get(
+            'template_staging', {})
+
+    def _get_staging_zone_ids(self, connector, resolved, zones=None):
+        return _get_staging_zone_ids(connector.get(), self.provider_config,
+                                     resolved, zones)
+
+    def _stage_template(self, connector, resolved):
+        # (stager, zone ids the management vm must wait for)
+        if not self._get_staging_config().get('enabled', True) or \
+                resolved.get('image') is None:
+            return None, []
+        zone_ids = self._get_staging_zone_ids(connector, resolved)
+        if not zone_ids:
+            return None, []
+        stager = CloudstackTemplateStager(connector, self.provider_config,
+                                          resolved['image'].id)
+        stager.stage(zone_ids)
+        mgmt_zone_ids = [resolved['zone'].id] \
+            if resolved.get('zone') is not None else []
+        return stager, mgmt_zone_ids
+
+    def _get_planner(self):
+        connector = self._get_connector()
+        return CloudstackPlanner(connector, self.provider_config,
+                                 self._get_resolver())
+
+    def _provision(self, connector):
         lgr.info('bootstrapping to Cloudstack provider.')
 
         lgr.debug('reading configuration file')
@@ -149,9 +567,44 @@ class ProviderManager(BaseProviderClass):
         zone_type = self.provider_config['cloudstack']['zone_type']
 
         #init keypair and security-group resource creators.
-        cloud_driver = CloudstackConnector(self.provider_config).create()
+        cloud_driver = connector.create()
+        # fails fast on any unresolvable object before creating anything.
+        resolved = self._get_resolved_resources()
+        if self.provider_config['cloudstack'].get('preflight', {}).get(
+                'enabled', True):
+            shortfalls = self._preflight(connector, resolved)
+            if shortfalls:
+                raise CloudstackLogicError(
+                    'cannot provision, not enough resources: {0}'.format(
+                        _format_shortfalls(shortfalls)))
+        cluster = CloudstackManagerCluster(connector, self.provider_config,
+                                           resolved)
+        warm_pool = CloudstackWarmPool(connector, self.provider_config,
+                                       resolved)
+        # cluster nodes are always deployed.
+        use_warm_pool = warm_pool.is_enabled() and not cluster.is_enabled()
+        stager, mgmt_zone_ids = None, []
+        if not use_warm_pool:
+            # copies of the template run while networks and keypairs are
+            # created.
+            stager, mgmt_zone_ids = self._stage_template(connector,
+                                                         resolved)
+        data_volumes = CloudstackDataVolumes(connector, self.provider_config)
+        volume_creation = None
+        if data_volumes.specs:
+            if zone_type != 'advanced':
+                raise CloudstackLogicError(
+                    'data_disks are supported in advanced zones only')
+            # created while the networks are set up and the vm deploys.
+            zone_id = resolved['zone'].id \
+                if resolved.get('zone') is not None \
+                else cloud_driver.list_locations()[0].id
+            volume_creation = data_volumes.create_in_background(zone_id)
+        # taken before push_packages rewrites the package urls.
+        packages_key = _get_packages_key(self.provider_config)
+
         keypair_creator = CloudstackKeypairCreator(
-            cloud_driver, self.provider_config)
+            cloud_driver, self.provider_config, resolved)
 
         if zone_type == 'basic':
 
@@ -175,12 +628,16 @@ class ProviderManager(BaseProviderClass):
                                                     cloud_driver,
                                                      self.provider_config,
                                                      keypair_name,
-                                                     sg_name)
+                                                     sg_name,
+                                                     resolved=resolved)
 
             #spinning-up a new instance using the above topology.
             #Cloudstack provider supports only public ip allocation.
             #see cloudstack 'basic zone'
 
+            if stager is not None:
+                stager.wait(mgmt_zone_ids, self._get_staging_config().get(
+                    'timeout', 1800))
             public_ip = compute_creator.create_node()
 
         if zone_type == 'advanced':
@@ -188,18 +645,17 @@ class ProviderManager(BaseProviderClass):
             lgr.debug('Using the advanced zone path')
 
             network_creator = CloudstackNetworkCreator(
-                cloud_driver, self.provider_config)
+                cloud_driver, self.provider_config, resolved)
 
             #create required node topology
             lgr.debug('creating the required resources for management vm')
 
-            network_creator.create_networks()
+            netw = [network_creator.create_networks()]
             keypair_creator.create_key_pairs()
 
             keypair_name = keypair_creator.get_management_keypair_name()
             netw_name = network_creator.get_mgmt_network_name()
             lgr.debug(' network name {0}'.format(netw_name))
-            netw = network_creator.get_network(netw_name)
             lgr.debug(' network id {0}'.format(netw[0].id))
 
             #agent_netw_name = network_creator.get_agent_network_name()
@@ -217,9 +673,47 @@ class ProviderManager(BaseProviderClass):
             compute_creator = CloudstackNetworkComputeCreator(cloud_driver,
                                                      self.provider_config,
                                                      keypair_name,
-                                                     nets)
+                                                     nets,
+                                                     zone=resolved['zone'],
+                                                     resolved=resolved)
+
+            claimed = None
+            nodes = None
+            if use_warm_pool:
+                claimed = warm_pool.claim(cloud_driver)
+                if warm_pool.background_refill:
+                    warm_pool.schedule_refill()
+
+            if claimed is not None:
+                node, warm_public_ip = claimed
+                compute_creator.userdata_delivered = \
+                    warm_pool.userdata_delivered
+            else:
+                try:
+                    if use_warm_pool:
+                        # the pool is empty, the vm is deployed from the
+                        # template after all.
+                        stager, mgmt_zone_ids = self._stage_template(
+                            connector, resolved)
+                    if stager is not None:
+                        stager.wait(mgmt_zone_ids,
+                                    self._get_staging_config().get(
+                                        'timeout', 1800))
+                    if cluster.is_enabled():
+                        nodes, group_created = cluster.deploy(netw[0])
+                        node = nodes[0]
+                        compute_creator.userdata_delivered = \
+                            cluster.userdata_delivered
+                    else:
+                        node = compute_creator.create_node()
+                except Exception:
+                    if volume_creation is not None:
+                        data_volumes.discard(volume_creation)
+                    raise
 
-            node = compute_creator.create_node()
+            if volume_creation is not None:
+                volumes = volume_creation.get()
+                data_volumes.attach(volumes, node.id)
 
             # Getting network config for portmaps, in advanced zones portmaps
             # are mapped to a node so we need to create portmaps
@@ -237,6 +731,9 @@ class ProviderManager(BaseProviderClass):
 
                 #for each port, add forward rule
                 for port in mgmt_ports:
+                        if nodes is not None and \
+                                port in cluster.balanced_ports:
+                            continue
                         #cidr = management_sg_config.get('cidr', None)
                         protocol = management_network_config.get('protocol',
                                                                 None)
@@ -245,10 +742,16 @@ class ProviderManager(BaseProviderClass):
                                                           port,
                                                           protocol,
                                                           node)
+            if nodes is not None:
+                lb_rule_ids = cluster.balance(
+                    network_creator.get_mgmt_pub_ip(), nodes)
+
             # Set Management IP to either private or Public
             if mgmt_server_config['use_private_ip'] == True:
                 public_ip = node
                 mgmt_ip = node.private_ips[0]
+            elif claimed is not None:
+                mgmt_ip = warm_public_ip['address']
             else:
                 public_ip = network_creator.get_mgmt_pub_ip()
                 mgmt_ip = public_ip.address
@@ -259,26 +762,86 @@ class ProviderManager(BaseProviderClass):
 
         provider_context = {"ip": str(mgmt_ip)}
         provider_context['mgmt_node_id'] = str(node.id)
+        provider_context['resources'] = _get_context_resources(
+            self.provider_config)
+        provider_context['packages_key'] = packages_key
+        # teardown uses the same account, only its key is kept.
+        provider_context['api_key'] = \
+            self.provider_config['authentication']['api_key']
+        if zone_type == 'advanced' and claimed is not None:
+            provider_context['resources']['public_ip'] = \
+                warm_public_ip['id']
+        if volume_creation is not None:
+            provider_context['resources']['volumes'] = \
+                [volume['id'] for volume in volumes]
+        if zone_type == 'advanced' and nodes is not None:
+            provider_context['mgmt_node_ids'] = [str(n.id) for n in nodes]
+            provider_context['resources']['load_balancer_rules'] = \
+                lb_rule_ids
+            if group_created:
+                provider_context['resources']['affinity_group'] = \
+                    cluster.group
+
+        if stager is not None:
+            for zone_id, state in stager.pending().iteritems():
+                lgr.info('template {0} still being copied to zone {1}: {2}'
+                         .format(stager.image_id, zone_id, state))
+
+        return {'mgmt_ip': str(mgmt_ip),
+                'provider_context': provider_context,
+                'userdata_delivered': compute_creator.userdata_delivered,
+                'volumes': volumes if volume_creation is not None else None}
+
+    @_proxied_by_daemon
+    def teardown_many(self, provider_contexts, concurrency=None):
+        """
+        tears down many management servers at once, sharing one worker
+        pool and one inventory snapshot between them.
+
+        :param list provider_contexts: contexts returned by provision()
+        :param int concurrency: maximum number of concurrent api calls,
+        defaults to cloudstack.concurrency
+        :rtype: 'list' of (resource type, resource, error) for the
+        deletes that failed
+        """
+        accounts = CloudstackAccountPool(self.provider_config)
+        by_account = {}
+        for provider_context in provider_contexts:
+            by_account.setdefault(provider_context.get('api_key'),
+                                  []).append(provider_context)
+
+        failures = []
+        for api_key, contexts in by_account.iteritems():
+            provider_config = self.provider_config
+            if api_key is not None and api_key != \
+                    provider_config['authentication']['api_key']:
+                provider_config = accounts.get_config(api_key)
+            if concurrency or provider_config is not self.provider_config:
+                connector = CloudstackConnector(provider_config)
+                connector.concurrency = concurrency or connector.concurrency
+            else:
+                connector = self._get_connector()
+            try:
+                failures.extend(CloudstackBulkTerminator(
+                    connector, provider_config).terminate(contexts))
+            finally:
+                connector.job_timings.save()
+        return failures
+
+    @_proxied_by_daemon
+    def sweep(self, dry_run=True):
+        """
+        deletes every resource named with cloudify.resources_prefix,
+        including the orphans of failed runs.
 
-        print('management ip: ' + mgmt_ip + ' key name: ' + self.
-              _get_private_key_path_from_keypair_config(
-            mgmt_server_config['management_keypair']) + 'user name: ' +
-              mgmt_server_config.get('user_on_management'))
-
-        self.copy_files_to_manager(
-            mgmt_ip,
-            self.provider_config,
-            self._get_private_key_path_from_keypair_config(
-                mgmt_server_config['management_keypair']),
-            mgmt_server_config.get('user_on_management'))
-
-        return mgmt_ip, \
-               mgmt_ip, \
-               self._get_private_key_path_from_keypair_config(
-                   mgmt_server_config['management_keypair']), \
-               mgmt_server_config.get('user_on_management'), \
-                   provider_context
+        :param bool dry_run: only report what would be deleted.
+        :rtype: 'dict' with the matched resources and failed deletes
+        """
+        sweeper = CloudstackOrphanSweeper(
+            self._get_connector(), self.provider_config)
+        return sweeper.sweep(dry_run)
 
+    @_proxied_by_daemon
     def validate(self, validation_errors={}):
         """
         validations to be performed before provisioning and bootstrapping
@@ -289,9 +852,132 @@ class ProviderManager(BaseProviderClass):
         :rtype: 'dict' representing validation_errors. provisioning will
         continue only if the dict is empty.
         """
+        validation_errors = dict(validation_errors)
+
+        lgr.info('resolving referenced cloud objects')
+        resolver = self._get_resolver()
+        # kept so provision() can reuse the resolved objects.
+        self.resolved_resources = resolver.resolve()
+        validation_errors.update(resolver.errors)
+
+        for key, error in resolver.errors.iteritems():
+            lgr.error('validation error on {0}: {1}'.format(key, error))
         return validation_errors
 
-    def teardown(self, provider_context, ignore_validation=False):
+    def _get_resolver(self):
+        connector = self._get_connector()
+        inventory = None
+        if self.provider_config['cloudstack'].get('inventory', {}).get(
+                'enabled', False):
+            # synced by the resolver.
+            inventory = self._get_inventory()
+        endpoint = self._get_endpoint()
+        if endpoint is not None:
+            catalog = endpoint['catalog']
+        else:
+            catalog = _get_catalog_cache(connector, self.provider_config)
+        return CloudstackResourceResolver(
+            connector, self.provider_config, catalog, inventory)
+
+    def _get_endpoint(self):
+        # in the daemon, the warm connector, catalog cache and inventory
+        # of the account and api endpoint the config points at.
+        daemon = getattr(self, 'daemon', None)
+        if daemon is None:
+            return None
+        return daemon.get_endpoint(self.provider_config)
+
+    def _get_connector(self):
+        endpoint = self._get_endpoint()
+        if endpoint is not None:
+            return endpoint['connector']
+        return _get_shared_connector(self.provider_config)
+
+    def _select_account(self, provider_context=None):
+        """
+        with several accounts in authentication.accounts, points the
+        config at the account of provider_context or, for a new
+        environment, at the account with the most remaining capacity.
+        every operation selects again, so the environments one manager
+        provisions are spread over the accounts.
+        """
+        accounts = CloudstackAccountPool(self.provider_config)
+        if len(accounts) < 2:
+            return
+        if provider_context is None:
+            account = accounts.choose()
+        elif provider_context.get('api_key') is None:
+            # provisioned before accounts were configured.
+            account = accounts.accounts[0]
+        else:
+            account = accounts.get(provider_context['api_key'])
+            if account is None:
+                raise CloudstackLogicError(
+                    'the account of api key {0} is not configured in '
+                    'authentication.accounts'.format(
+                        provider_context['api_key']))
+        auth = self.provider_config['authentication']
+        if account['api_key'] == auth['api_key']:
+            return
+        # networks and keypairs resolved so far belong to another
+        # account.
+        self.resolved_resources = None
+        self.inventory = None
+        # the configured account stays the first of the pool.
+        default_account = auth.get('default_account') or {
+            'api_key': auth['api_key'],
+            'api_secret_key': auth['api_secret_key']}
+        self.provider_config['authentication'] = dict(
+            auth, default_account=default_account, **account)
+
+    def _get_daemon_client(self):
+        if getattr(self, 'daemon', None) is not None:
+            return None
+        daemon_config = (self.provider_config or {}).get(
+            'cloudstack', {}).get('daemon', {})
+        if not daemon_config.get('enabled', False):
+            return None
+        return CloudstackDaemonClient.connect(daemon_config.get('socket'))
+
+    def get_inventory(self):
+        """
+        :rtype: the 'CloudstackInventory' of the account, kept for the
+        lifetime of this manager and synced on every call.
+        """
+        inventory = self._get_inventory()
+        inventory.sync()
+        return inventory
+
+    def _get_inventory(self):
+        inventory = getattr(self, 'inventory', None)
+        if inventory is None:
+            endpoint = self._get_endpoint()
+            if endpoint is not None:
+                inventory = endpoint['inventory']
+            else:
+                inventory = CloudstackInventory(
+                    self._get_connector(),
+                    self.provider_config)
+            self.inventory = inventory
+        return inventory
+
+    def _get_resolved_resources(self):
+        resolved = getattr(self, 'resolved_resources', None)
+        if resolved is not None:
+            return resolved
+
+        resolver = self._get_resolver()
+        resolved = resolver.resolve()
+        if resolver.errors:
+            raise CloudstackLogicError(
+                'cannot provision, unresolved cloud objects: {0}'.format(
+                    ', '.join('{0} ({1})'.format(k, v) for k, v in
+                              sorted(resolver.errors.items()))))
+        self.resolved_resources = resolved
+        return resolved
+
+    def teardown(self, provider_context, ignore_validation=False,
+                 plan=False):
         """
         tears down the management server and its accompanied provisioned
         resources
@@ -300,29 +986,55 @@ class ProviderManager(BaseProviderClass):
         provisioned resources
         :param bool ignore_validation: should the teardown process ignore
         conflicts during teardown
+        :param bool plan: only print and return the api calls teardown
+        would make, without changing anything.
         :rtype: 'None'
         """
+        if plan:
+            return self._plan_teardown(provider_context)
+        self._teardown_resources(provider_context)
+
+    @_proxied_by_daemon
+    def _plan_teardown(self, provider_context):
+        self._select_account(provider_context)
+        return self._get_planner().plan_teardown(provider_context)
+
+    @_proxied_by_daemon
+    def _teardown_resources(self, provider_context):
+        self._select_account(provider_context)
+        connector = self._get_connector()
+        try:
+            self._teardown(connector, provider_context)
+        finally:
+            connector.job_timings.save()
+
+    def _teardown(self, connector, provider_context):
         management_id = provider_context['mgmt_node_id']
         lgr.info('tearing-down management vm {0}.'.format(management_id))
 
         # lgr.debug('reading configuration file {0}'.format(config_path))
         # provider_config = _read_config(config_path)
+        # the resources are named as when they were provisioned, not as
+        # the current config would name them.
+        provider_config = _name_context_resources(
+            self.provider_config, _get_provisioned_resources(
+                self.provider_config, provider_context))
 
-        zone_type = self.provider_config['cloudstack']['zone_type']
+        zone_type = provider_config['cloudstack']['zone_type']
         zone_type = zone_type.lower()
 
         if zone_type == 'basic':
 
             #init keypair and security-group resource creators.
-            cloud_driver = CloudstackConnector(self.provider_config).create()
+            cloud_driver = connector.create()
             keypair_creator = CloudstackKeypairCreator(
-                cloud_driver, self.provider_config)
+                cloud_driver, provider_config)
             security_group_creator = CloudstackSecurityGroupCreator(
-                cloud_driver, self.provider_config)
+                cloud_driver, provider_config)
             # init compute node creator
             compute_creator = CloudstackSecurityGroupComputeCreator(
                                                      cloud_driver,
-                                                     self.provider_config,
+                                                     provider_config,
                                                      keypair_name=None,
                                                      security_group_name=None,
                                                      node_name=None)
@@ -339,14 +1051,14 @@ class ProviderManager(BaseProviderClass):
         if zone_type == 'advanced':
 
             #init keypair and security-group resource creators.
-            cloud_driver = CloudstackConnector(self.provider_config).create()
+            cloud_driver = connector.create()
             keypair_creator = CloudstackKeypairCreator(
-                cloud_driver, self.provider_config)
+                cloud_driver, provider_config)
             network_creator = CloudstackNetworkCreator(
-                cloud_driver, self.provider_config)
+                cloud_driver, provider_config)
             # init compute node creator
             compute_creator = CloudstackNetworkComputeCreator(cloud_driver,
-                                                     self.provider_config,
+                                                     provider_config,
                                                      keypair_name=None,
                                                      network_name=None,
                                                      node_name=None)
@@ -357,8 +1069,37 @@ class ProviderManager(BaseProviderClass):
                                                              compute_creator,
                                                              management_id)
 
+            # the other cluster members go concurrently, the first with
+            # the network.
+            cluster = CloudstackManagerCluster(connector,
+                                               provider_config)
+            failures = ['{0} {1} ({2})'.format(*failure) for failure
+                        in cluster.remove_members(provider_context)]
+
+            # a network cannot be deleted while it still has the ip of a
+            # claimed warm pool vm.
+            ip_id = provider_context.get('resources', {}).get('public_ip')
+            if ip_id:
+                lgr.info('releasing public ip {0}'.format(ip_id))
+                cloud_driver._async_request('disassociateIpAddress',
+                                            params={'id': ip_id})
+
             lgr.debug('terminating management vm and all of its resources.')
             resource_terminator.terminate_resources()
+            cluster.delete_group(provider_context)
+
+            volume_ids = provider_context.get('resources', {}).get(
+                'volumes')
+            if volume_ids:
+                lgr.info('deleting data volumes {0}'.format(
+                    ', '.join(volume_ids)))
+                failures.extend(
+                    'volume {0} ({1})'.format(*failure) for failure
+                    in CloudstackDataVolumes(
+                        connector, provider_config).delete(volume_ids))
+            if failures:
+                raise CloudstackLogicError(
+                    'failed deleting {0}'.format(', '.join(failures)))
 
 
 # Create the provider folder in script location.
@@ -379,6 +1120,120 @@ def init(target_directory, reset_config, is_verbose_output=False):
     return True
 
 
+def _get_resources_prefix(provider_config):
+    prefix = provider_config.get('cloudify', {}).get('resources_prefix')
+    # the placeholder of the shipped config names nothing.
+    if not prefix or prefix == DEFAULT_RESOURCES_PREFIX:
+        return ''
+    return prefix
+
+
+def _get_resource_name(provider_config, name):
+    """
+    :rtype: 'str', name with cloudify.resources_prefix in front
+    """
+    prefix = _get_resources_prefix(provider_config)
+    if not name or name.startswith(prefix):
+        return name
+    return prefix + name
+
+
+def _prefix_resource_names(provider_config):
+    """
+    :rtype: 'dict', a copy of provider_config with the names of the
+    resources provisioning creates made with _get_resource_name. the
+    names of existing resources (use_existing) are kept, and the names
+    without the prefix are kept in cloudify.unprefixed_resources for the
+    contexts of older provisions.
+    """
+    provider_config = deepcopy(provider_config)
+    if not _get_resources_prefix(provider_config):
+        return provider_config
+    # a config prefixed already keeps the names it was prefixed from.
+    if 'unprefixed_resources' not in provider_config['cloudify']:
+        provider_config['cloudify']['unprefixed_resources'] = \
+            _get_context_resources(provider_config)
+    compute_config = provider_config.get('compute', {})
+    networking_config = provider_config.get('networking', {})
+    server_config = compute_config.get('management_server', {})
+    agents_config = compute_config.get('agent_servers', {})
+
+    # the vm name is the base of the volume, warm pool and cluster names.
+    named = [server_config.get('instance')]
+    for config in (server_config.get('management_keypair'),
+                   agents_config.get('agents_keypair'),
+                   networking_config.get('management_network'),
+                   networking_config.get('management_security_group'),
+                   networking_config.get('agents_security_group')):
+        if config and not config.get('use_existing'):
+            named.append(config)
+    for config in named:
+        if config and config.get('name'):
+            config['name'] = _get_resource_name(provider_config,
+                                                config['name'])
+    for config in (server_config.get('cluster'),
+                   agents_config.get('placement')):
+        if config and config.get('anti_affinity_group'):
+            config['anti_affinity_group'] = _get_resource_name(
+                provider_config, config['anti_affinity_group'])
+    return provider_config
+
+
+def _get_context_resources(provider_config):
+    """
+    :rtype: 'dict' with the names of the resources teardown deletes
+    besides the vm, so a context can be torn down without the config it
+    was created with.
+    """
+    compute_config = provider_config['compute']
+    resources = {'keypairs': [
+        compute_config['management_server']['management_keypair']['name'],
+        compute_config['agent_servers']['agents_keypair']['name']]}
+    zone_type = provider_config['cloudstack']['zone_type'].lower()
+    if zone_type == 'basic':
+        resources['security_group'] = provider_config['networking'][
+            'management_security_group']['name']
+    else:
+        netw_config = provider_config['networking']['management_network']
+        if not netw_config['use_existing']:
+            resources['network'] = netw_config['name']
+    return resources
+
+
+def _get_provisioned_resources(provider_config, provider_context):
+    """
+    :rtype: 'dict' with the resources recorded in provider_context, or for
+    a context of a provision older than the recording, the unprefixed
+    names it was provisioned with.
+    """
+    if 'resources' in provider_context:
+        return provider_context['resources']
+    return provider_config.get('cloudify', {}).get(
+        'unprefixed_resources') or _get_context_resources(provider_config)
+
+
+def _name_context_resources(provider_config, resources):
+    """
+    :rtype: 'dict', a copy of provider_config naming the keypairs, network
+    and security group as recorded in resources.
+    """
+    provider_config = deepcopy(provider_config)
+    compute_config = provider_config['compute']
+    for keypair_config, name in zip(
+            (compute_config['management_server']['management_keypair'],
+             compute_config['agent_servers']['agents_keypair']),
+            resources.get('keypairs') or []):
+        keypair_config['name'] = name
+    networking_config = provider_config['networking']
+    if resources.get('network'):
+        networking_config['management_network']['name'] = \
+            resources['network']
+    if resources.get('security_group'):
+        networking_config.setdefault('management_security_group', {})[
+            'name'] = resources['security_group']
+    return provider_config
+
+
 def _deep_merge_dictionaries(overriding_dict, overridden_dict):
     merged_dict = deepcopy(overridden_dict)
     for k, v in overriding_dict.iteritems():
@@ -544,27 +1399,3806 @@ class CloudstackNetworkResourceTerminator(object):
         self.network_creator.delete_networks()
 
 
+class CloudstackSSHSessionPool(object):
+    """
+    keeps one connected ssh client per manager host, so every step of a
+    bootstrap reuses the same transport instead of connecting again.
+    """
+
+    def __init__(self, connection_attempts=25, retry_interval=5,
+                 timeout=10):
+        self.connection_attempts = connection_attempts
+        self.retry_interval = retry_interval
+        self.timeout = timeout
+        self._clients = {}
+        self._lock = threading.Lock()
+        # connecting may retry for minutes, only callers of the same host
+        # wait for it.
+        self._key_locks = {}
+
+    def _connect(self, host, user, key_filename):
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        for attempt in range(1, self.connection_attempts + 1):
+            try:
+                client.connect(host, username=user,
+                               key_filename=key_filename,
+                               timeout=self.timeout,
+                               allow_agent=False,
+                               look_for_keys=False)
+                return client
+            except (socket.error, paramiko.SSHException) as exc:
+                # the vm may still be booting.
+                if attempt == self.connection_attempts:
+                    raise
+                lgr.debug('ssh to {0} failed ({1}), attempt {2} of {3}'
+                          .format(host, exc, attempt,
+                                  self.connection_attempts))
+                time.sleep(self.retry_interval)
+
+    def find(self, host):
+        with self._lock:
+            for (client_host, _, _), client in self._clients.iteritems():
+                transport = client.get_transport()
+                if client_host == host and transport and \
+                        transport.is_active():
+                    return client
+        return None
+
+    def get(self, host, user, key_filename):
+        """
+        :rtype: a connected 'paramiko.SSHClient'
+        """
+        key = (host, user, key_filename)
+        client = self._get_active(key)
+        if client is not None:
+            return client
+        with self._get_key_lock(key):
+            # connected by another thread meanwhile.
+            client = self._get_active(key)
+            if client is not None:
+                return client
+            lgr.debug('opening ssh session to {0}@{1}'.format(user, host))
+            client = self._connect(host, user, key_filename)
+            with self._lock:
+                self._clients[key] = client
+            return client
+
+    def _get_active(self, key):
+        with self._lock:
+            client = self._clients.get(key)
+        transport = client.get_transport() if client else None
+        if transport and transport.is_active():
+            return client
+        return None
+
+    def _get_key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def close(self):
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients = {}
+
+
+class CloudstackFileUploader(object):
+    """
+    uploads files to the manager over a single sftp channel of a pooled
+    ssh session.
+
+    files whose sha256 digest already matches the remote copy are skipped;
+    the remote digests of a whole batch are read with one command. files
+    are written to a temporary name and renamed into place, so a half
+    written file is never visible under its real name.
+    """
+
+    def __init__(self, ssh_client):
+        self.ssh_client = ssh_client
+
+    def _makedirs(self, sftp, remote_dir):
+        if remote_dir in ('', '/'):
+            return
+        try:
+            sftp.stat(remote_dir)
+        except IOError:
+            self._makedirs(sftp, os.path.dirname(remote_dir))
+            lgr.debug('creating remote dir {0}'.format(remote_dir))
+            sftp.mkdir(remote_dir)
+
+    def _run(self, command):
+        _, stdout, stderr = self.ssh_client.exec_command(command)
+        status = stdout.channel.recv_exit_status()
+        return status, stdout.read(), stderr.read()
+
+    def _remote_digests(self, remote_paths):
+        # missing files are simply absent from the output.
+        _, out, _ = self._run('sha256sum -- {0} 2>/dev/null'.format(
+            ' '.join(pipes.quote(p) for p in remote_paths)))
+        digests = {}
+        for line in out.splitlines():
+            digest, _, path = line.partition('  ')
+            if path:
+                digests[path] = digest
+        return digests
+
+    def _rename(self, sftp, source, target):
+        try:
+            sftp.posix_rename(source, target)
+        except (AttributeError, IOError):
+            # servers without the posix-rename extension.
+            status, _, err = self._run('mv -f {0} {1}'.format(
+                pipes.quote(source), pipes.quote(target)))
+            if status != 0:
+                raise CloudstackLogicError('failed moving {0} to {1}: {2}'
+                                           .format(source, target, err))
+
+    def upload(self, files):
+        """
+        :param list files: (local path, remote path) tuples
+        :rtype: 'list' of the remote paths which were transferred
+        """
+        if not files:
+            return []
+        local_digests = dict((local_path, _file_sha256(local_path))
+                             for local_path, _ in files)
+        remote_digests = self._remote_digests(
+            [remote_path for _, remote_path in files])
+        pending = [(local_path, remote_path)
+                   for local_path, remote_path in files
+                   if remote_digests.get(remote_path) !=
+                   local_digests[local_path]]
+        for remote_path in set(r for _, r in files) - \
+                set(r for _, r in pending):
+            lgr.debug('{0} is up to date'.format(remote_path))
+        if not pending:
+            return []
+
+        sftp = self.ssh_client.open_sftp()
+        try:
+            for local_path, remote_path in pending:
+                self._makedirs(sftp, os.path.dirname(remote_path))
+                tmp_path = '{0}.{1}.part'.format(remote_path, os.getpid())
+                lgr.debug('uploading {0} to {1}'.format(local_path,
+                                                        remote_path))
+                sftp.put(local_path, tmp_path)
+                sftp.chmod(tmp_path, os.stat(local_path).st_mode & 0777)
+                self._rename(sftp, tmp_path, remote_path)
+        finally:
+            sftp.close()
+        return [remote_path for _, remote_path in pending]
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class CloudstackPackageCache(object):
+    """
+    content addressed local cache of the cloudify packages. every package
+    is stored once under its sha256 digest, with an index mapping urls to
+    digests. interrupted downloads resume with http range requests.
+    """
+
+    BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, cache_dir=None, attempts=3, timeout=60):
+        self.path = expanduser(cache_dir or
+                               os.path.join(CACHE_DIR, 'packages'))
+        self.index_path = os.path.join(self.path, 'index.json')
+        self.attempts = attempts
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        # url: lock held while the url is downloaded
+        self._url_locks = {}
+        for directory in (self.path, os.path.join(self.path, 'partial')):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        try:
+            with open(self.index_path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_entry(self, url, entry):
+        with self._lock:
+            index = self._load_index()
+            index[url] = entry
+            tmp_path = '{0}.{1}.tmp'.format(self.index_path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(index, f)
+            os.rename(tmp_path, self.index_path)
+
+    def get(self, url):
+        """
+        :rtype: 'str' with the path of the cached package or None
+        """
+        entry = self._load_index().get(url)
+        if entry is None:
+            return None
+        blob_path = os.path.join(self.path, entry['sha256'])
+        if not os.path.exists(blob_path) or \
+                os.path.getsize(blob_path) != entry['size']:
+            return None
+        return blob_path
+
+    def _download(self, url, partial_path):
+        offset = os.path.getsize(partial_path) \
+            if os.path.exists(partial_path) else 0
+        request = urllib2.Request(url)
+        if offset:
+            request.add_header('Range', 'bytes={0}-'.format(offset))
+        try:
+            response = urllib2.urlopen(request, timeout=self.timeout)
+        except urllib2.HTTPError as exc:
+            if exc.code != 416:
+                raise
+            # the partial file is no prefix of the package anymore.
+            os.remove(partial_path)
+            return self._download(url, partial_path)
+
+        resumed = offset and response.getcode() == 206
+        if offset:
+            lgr.debug('{0} {1} from byte {2}'.format(
+                'resuming' if resumed else 'restarting', url, offset))
+        length = response.info().getheader('Content-Length')
+        try:
+            with open(partial_path, 'ab' if resumed else 'wb') as f:
+                for block in iter(
+                        lambda: response.read(self.BLOCK_SIZE), ''):
+                    f.write(block)
+        finally:
+            response.close()
+
+        # a dropped connection just ends the body early.
+        expected = int(length) + (offset if resumed else 0) \
+            if length else None
+        if expected is not None and \
+                os.path.getsize(partial_path) < expected:
+            raise IOError('download of {0} ended after {1} of {2} bytes'
+                          .format(url, os.path.getsize(partial_path),
+                                  expected))
+
+    def _get_url_lock(self, url):
+        with self._lock:
+            return self._url_locks.setdefault(url, threading.Lock())
+
+    def fetch(self, url):
+        """
+        :rtype: 'str' with the path of the cached package, downloading it
+        first if needed.
+        """
+        cached = self.get(url)
+        if cached:
+            return cached
+        # concurrent fetches of a url share its partial file.
+        with self._get_url_lock(url):
+            # downloaded by another thread meanwhile.
+            return self.get(url) or self._fetch(url)
+
+    def _fetch(self, url):
+        partial_path = os.path.join(self.path, 'partial',
+                                    hashlib.sha1(url).hexdigest())
+        lgr.info('downloading {0}'.format(url))
+        for attempt in range(1, self.attempts + 1):
+            try:
+                self._download(url, partial_path)
+                break
+            except (urllib2.URLError, socket.error, IOError) as exc:
+                if attempt == self.attempts:
+                    raise
+                lgr.warn('download of {0} failed ({1}), resuming'
+                         .format(url, exc))
+
+        digest = _file_sha256(partial_path)
+        blob_path = os.path.join(self.path, digest)
+        os.rename(partial_path, blob_path)
+        self._save_entry(url, {'sha256': digest,
+                               'size': os.path.getsize(blob_path)})
+        return blob_path
+
+    def fetch_in_background(self, urls):
+        """
+        :rtype: an 'AsyncResult' whose get() returns the cached paths of
+        the distinct urls, in the order they are first listed
+        """
+        # the same package may be listed more than once.
+        urls = list(collections.OrderedDict.fromkeys(urls))
+        pool = ThreadPool(min(len(urls), DEFAULT_CONCURRENCY) or 1)
+        result = pool.map_async(self.fetch, urls)
+        pool.close()
+        return result
+
+
+def _get_package_cache(provider_config):
+    cache_config = provider_config.get('cloudify', {}).get(
+        'packages_cache', {})
+    if not cache_config.get('enabled', False):
+        return None
+    return CloudstackPackageCache(cache_config.get('local_dir'))
+
+
+def _get_package_urls(provider_config):
+    """
+    :rtype: 'dict' of (section, key) to the package url
+    """
+    urls = {}
+    for section in ('server', 'agents'):
+        packages = provider_config.get('cloudify', {}).get(
+            section, {}).get('packages', {})
+        for key, url in packages.iteritems():
+            if url and urlparse.urlparse(url).scheme in ('http', 'https'):
+                urls[(section, key)] = url
+    return urls
+
+
+def _get_packages_key(provider_config):
+    """
+    :rtype: 'str' identifying the cloudify packages installed by a
+    bootstrap of provider_config on top of its base image.
+    """
+    urls = sorted(_get_package_urls(provider_config).values())
+    image_id = provider_config['compute']['management_server'][
+        'instance']['image']
+    return hashlib.sha1(json.dumps([image_id] + urls)).hexdigest()
+
+
+class CloudstackTemplateRegistry(object):
+    """
+    local registry of the templates baked from bootstrapped management
+    vms, kept per api_url and api key under ~/.cloudify (templates are
+    private to the account baking them) and keyed by the packages
+    installed on them.
+    """
+
+    def __init__(self, api_url, api_key=None, cache_dir=None):
+        self.api_key = api_key
+        self.path = os.path.join(
+            expanduser(cache_dir or CACHE_DIR),
+            'cloudstack-templates-{0}.json'.format(
+                hashlib.sha1(str((api_url, api_key))).hexdigest()[:12]))
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError) as exc:
+            lgr.debug('ignoring unreadable template registry {0}: {1}'
+                      .format(self.path, exc))
+            return {}
+
+    def _save(self, templates):
+        cache_dir = os.path.dirname(self.path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(templates, f)
+        os.rename(tmp_path, self.path)
+
+    def get(self, packages_key):
+        """
+        :rtype: 'dict' describing the baked template or None
+        """
+        return self._load().get(packages_key)
+
+    def record(self, packages_key, template):
+        with self._lock:
+            templates = self._load()
+            templates[packages_key] = template
+            self._save(templates)
+
+    def forget(self, packages_key):
+        with self._lock:
+            templates = self._load()
+            if templates.pop(packages_key, None) is not None:
+                self._save(templates)
+
+
+def _get_template_registry(provider_config):
+    auth = provider_config['authentication']
+    return CloudstackTemplateRegistry(auth['api_url'], auth['api_key'])
+
+
+class CloudstackTemplateBaker(object):
+    """
+    turns a bootstrapped management vm into a template: stops the vm,
+    creates a template from its root volume and records it in the
+    template registry.
+    """
+
+    # seconds to wait for the template copy to finish
+    DEFAULT_TIMEOUT = 3600
+
+    def __init__(self, connector, provider_config, registry=None):
+        self.connector = connector
+        self.provider_config = provider_config
+        self.registry = registry or _get_template_registry(provider_config)
+
+    def bake(self, node_id, packages_key, name=None, timeout=None):
+        """
+        :rtype: 'dict' describing the baked template
+        """
+        cloud_driver = self.connector.create()
+        cloud_driver.connection.timeout = timeout or self.DEFAULT_TIMEOUT
+
+        vms = _list_resources(cloud_driver, 'listVirtualMachines',
+                              'virtualmachine', id=node_id)
+        if not vms:
+            raise CloudstackLogicError(
+                'management vm {0} cannot be found'.format(node_id))
+        vm = vms[0]
+        if vm.get('state') != 'Stopped':
+            lgr.info('stopping management vm {0}'.format(node_id))
+            cloud_driver._async_request('stopVirtualMachine',
+                                        params={'id': node_id})
+
+        volumes = _list_resources(cloud_driver, 'listVolumes', 'volume',
+                                  virtualmachineid=node_id, type='ROOT')
+        if not volumes:
+            raise CloudstackLogicError(
+                'management vm {0} has no root volume'.format(node_id))
+
+        if name is None:
+            name = '{0}-{1}'.format(vm['name'], packages_key[:8])
+        lgr.info('creating template {0} from volume {1}'.format(
+            name, volumes[0]['id']))
+        result = cloud_driver._async_request('createTemplate', params={
+            'name': name,
+            'displaytext': 'cloudify manager baked from {0}'.format(
+                vm['name']),
+            'ostypeid': vm['guestosid'],
+            'volumeid': volumes[0]['id']})
+
+        template = {'id': result['template']['id'],
+                    'name': name,
+                    'source_node_id': node_id,
+                    'created': time.time(),
+                    'api_key': self.registry.api_key}
+        self.registry.record(packages_key, template)
+        return template
+
+
+class CloudstackTemplateStager(object):
+    """
+    gets a template ready in the zones vms are deployed to ahead of the
+    deploys. copies to zones missing the template are started at once
+    with copyTemplate (from a zone it is ready in) without waiting for
+    their jobs; a single listing tells which zones are ready since.
+    """
+
+    def __init__(self, connector, provider_config, image_id):
+        self.connector = connector
+        self.config = provider_config
+        self.image_id = image_id
+        # zone id: copyTemplate job id, None for copies failed to start
+        self.jobs = {}
+        # zone id: why the copy failed to start
+        self.errors = {}
+
+    def get_status(self):
+        """
+        :rtype: 'dict' of zone id to 'ready' or the copy status of the
+        template (e.g. '35% Downloaded'). zones without it are left out.
+        """
+        records = _list_resources(self.connector.get(), 'listTemplates',
+                                  'template', templatefilter='executable',
+                                  id=self.image_id)
+        return dict((r['zoneid'], 'ready' if r.get('isready')
+                     else r.get('status') or 'copying') for r in records)
+
+    def _copy(self, cloud_driver, copy):
+        zone_id, source_zone_id = copy
+        try:
+            # returns once the job is queued.
+            response = cloud_driver._sync_request('copyTemplate', params={
+                'id': self.image_id, 'sourcezoneid': source_zone_id,
+                'destzoneid': zone_id})
+            return zone_id, response.get('jobid'), None
+        except Exception as exc:
+            return zone_id, None, exc
+
+    def stage(self, zone_ids):
+        """
+        starts copying the template to the zones of zone_ids missing it.
+
+        :rtype: 'dict' with the status of the template per zone (see
+        get_status), zones copies failed to start for being 'failed'.
+        """
+        status = self.get_status()
+        missing = [zone_id for zone_id in zone_ids if zone_id not in status]
+        if not missing:
+            return status
+        source_zone_id = next((zone_id for zone_id, state
+                               in status.iteritems() if state == 'ready'),
+                              None)
+        if source_zone_id is None:
+            raise CloudstackLogicError(
+                'template {0} is not ready in any zone to copy it from'
+                .format(self.image_id))
+        lgr.info('copying template {0} to zones {1}'.format(
+            self.image_id, ', '.join(missing)))
+        for zone_id, job_id, error in self.connector.map(
+                self._copy, [(zone_id, source_zone_id)
+                             for zone_id in missing]):
+            if error is not None:
+                lgr.warn('cannot copy template {0} to zone {1}: {2}'.format(
+                    self.image_id, zone_id, error))
+                self.jobs[zone_id] = None
+                self.errors[zone_id] = str(error)
+                status[zone_id] = 'failed'
+                continue
+            self.jobs[zone_id] = job_id
+            status[zone_id] = 'copying'
+        return status
+
+    def _check_job(self, cloud_driver, zone_id):
+        if zone_id in self.errors:
+            raise CloudstackLogicError(
+                'copying template {0} to zone {1} failed to start: {2}'
+                .format(self.image_id, zone_id, self.errors[zone_id]))
+        job_id = self.jobs.get(zone_id)
+        if job_id is None:
+            return
+        result = cloud_driver._sync_request('queryAsyncJobResult',
+                                            params={'jobid': job_id})
+        if result.get('jobstatus') == 2:
+            raise CloudstackLogicError(
+                'copying template {0} to zone {1} failed: {2}'.format(
+                    self.image_id, zone_id, result.get('jobresult', {}).get(
+                        'errortext')))
+
+    def wait(self, zone_ids, timeout=1800, interval=10):
+        """
+        waits until the template is ready in the zones of zone_ids.
+        """
+        if not zone_ids:
+            return
+        deadline = time.time() + timeout
+        while True:
+            status = self.get_status()
+            waiting = [zone_id for zone_id in zone_ids
+                       if status.get(zone_id) != 'ready']
+            if not waiting:
+                return
+            for zone_id in waiting:
+                self._check_job(self.connector.get(), zone_id)
+            if time.time() > deadline:
+                raise CloudstackLogicError(
+                    'template {0} is not ready in zones {1} after {2} '
+                    'seconds'.format(self.image_id, ', '.join(waiting),
+                                     timeout))
+            lgr.debug('waiting for template {0} in zones {1}'.format(
+                self.image_id, ', '.join(waiting)))
+            time.sleep(interval)
+
+    def pending(self):
+        """
+        :rtype: 'dict' of zone id to the status of the copies started
+        which are not ready yet.
+        """
+        status = self.get_status()
+        return dict((zone_id, status.get(
+                        zone_id,
+                        'failed' if zone_id in self.errors else 'copying'))
+                    for zone_id in self.jobs
+                    if status.get(zone_id) != 'ready')
+
+
+def _get_staging_zone_ids(cloud_driver, provider_config, resolved,
+                          zones=None):
+    """
+    :rtype: 'list' with the ids of the zones the template is staged to,
+    by default the management vm's zone and
+    compute.management_server.template_staging.zones
+    """
+    zone_ids = []
+    if zones is None:
+        if resolved.get('zone') is not None:
+            zone_ids.append(resolved['zone'].id)
+        zones = provider_config['compute']['management_server'].get(
+            'template_staging', {}).get('zones') or []
+    for zone in zones:
+        zone_id = _lookup_zone(cloud_driver, zone).id
+        if zone_id not in zone_ids:
+            zone_ids.append(zone_id)
+    return zone_ids
+
+
+def _ensure_affinity_group(cloud_driver, name):
+    """
+    :rtype: 'bool', whether the group had to be created
+    """
+    if _find_resource(cloud_driver, 'listAffinityGroups', 'affinitygroup',
+                      name, name=name):
+        return False
+    lgr.info('creating host anti-affinity group {0}'.format(name))
+    cloud_driver._async_request('createAffinityGroup', params={
+        'name': name, 'type': 'host anti-affinity'})
+    return True
+
+
+def _delete_volume(cloud_driver, volume_id):
+    try:
+        cloud_driver._sync_request('deleteVolume', params={'id': volume_id})
+    except Exception as exc:
+        # destroying a vm detaches its data volumes, unless it failed to.
+        lgr.debug('detaching volume {0} first: {1}'.format(volume_id, exc))
+        cloud_driver._async_request('detachVolume', params={'id': volume_id})
+        cloud_driver._sync_request('deleteVolume', params={'id': volume_id})
+
+
+class CloudstackDataVolumes(object):
+    """
+    the data volumes of compute.management_server.instance.data_disks,
+    keeping the i/o of the manager's services off the root disk. they are
+    created while the vm deploys, attached once it is up, and formatted
+    and mounted over ssh before cloudify gets installed.
+    """
+
+    def __init__(self, connector, provider_config):
+        self.connector = connector
+        server_config = provider_config['compute']['management_server'][
+            'instance']
+        self.specs = server_config.get('data_disks') or []
+        self.node_name = server_config['name']
+
+    def _create(self, cloud_driver, item):
+        index, spec, zone_id = item
+        try:
+            offering = _find_resource(cloud_driver, 'listDiskOfferings',
+                                      'diskoffering', spec['disk_offering'],
+                                      name=spec['disk_offering'])
+            if offering is None:
+                raise CloudstackLogicError(
+                    'disk offering {0} cannot be found'.format(
+                        spec['disk_offering']))
+            params = {'name': '{0}-data-{1}'.format(self.node_name, index),
+                      'diskofferingid': offering['id'], 'zoneid': zone_id}
+            if spec.get('size'):
+                # in GB, for custom sized offerings.
+                params['size'] = spec['size']
+            volume = cloud_driver._async_request('createVolume',
+                                                 params=params)['volume']
+            return {'id': volume['id'], 'name': volume['name'],
+                    'mount_point': spec['mount_point']}, None
+        except Exception as exc:
+            return None, exc
+
+    def get_size(self, cloud_driver):
+        """
+        :rtype: 'int' with the total size of the volumes in GB
+        """
+        size = 0
+        for spec in self.specs:
+            if spec.get('size'):
+                size += int(spec['size'])
+                continue
+            offering = _find_resource(cloud_driver, 'listDiskOfferings',
+                                      'diskoffering', spec['disk_offering'],
+                                      name=spec['disk_offering'])
+            # a missing offering fails the creation of the volume.
+            if offering is not None:
+                size += int(offering.get('disksize') or 0)
+        return size
+
+    def create(self, zone_id):
+        """
+        creates the volumes concurrently.
+
+        :rtype: 'list' of dicts with the 'id', 'name' and 'mount_point'
+        of every volume
+        """
+        lgr.info('creating {0} data volumes'.format(len(self.specs)))
+        results = self.connector.map(
+            self._create, [(index, spec, zone_id) for index, spec
+                           in enumerate(self.specs, 1)])
+        volumes = [volume for volume, _ in results if volume is not None]
+        errors = [str(error) for _, error in results if error is not None]
+        if errors:
+            self.delete(volumes)
+            raise CloudstackLogicError('failed creating data volumes: {0}'
+                                       .format(', '.join(errors)))
+        return volumes
+
+    def create_in_background(self, zone_id):
+        """
+        :rtype: an 'AsyncResult' whose get() returns the created volumes
+        """
+        pool = ThreadPool(1)
+        result = pool.apply_async(self.create, (zone_id,))
+        pool.close()
+        return result
+
+    def attach(self, volumes, node_id):
+        cloud_driver = self.connector.get()
+        # one at a time, attaching to a vm takes a lock on it.
+        for volume in volumes:
+            attached = cloud_driver._async_request('attachVolume', params={
+                'id': volume['id'], 'virtualmachineid': node_id})['volume']
+            volume['device_id'] = int(attached['deviceid'])
+            lgr.info('attached data volume {0} to {1}'.format(
+                volume['name'], node_id))
+
+    def mount(self, ssh_client, volumes):
+        """
+        formats (when blank) and mounts the attached volumes, persisted
+        in /etc/fstab.
+        """
+        for volume in volumes:
+            letter = chr(ord('a') + volume['device_id'])
+            mount_point = pipes.quote(volume['mount_point'])
+            # the device name depends on the hypervisor.
+            script = (
+                'dev=; for d in /dev/vd{0} /dev/xvd{0} /dev/sd{0}; do '
+                '[ -b $d ] && dev=$d && break; done; '
+                '[ -n "$dev" ] || {{ echo no device for volume >&2; exit 1; }}; '
+                'sudo blkid $dev >/dev/null || sudo mkfs.ext4 -q $dev && '
+                'sudo mkdir -p {1} && '
+                '{{ grep -q " {1} " /etc/fstab || '
+                'echo "UUID=$(sudo blkid -s UUID -o value $dev) {1} ext4 '
+                'defaults,nofail 0 2" | sudo tee -a /etc/fstab >/dev/null; }} '
+                '&& {{ mountpoint -q {1} || sudo mount {1}; }}'.format(
+                    letter, mount_point))
+            _, stdout, stderr = ssh_client.exec_command(script)
+            if stdout.channel.recv_exit_status() != 0:
+                raise CloudstackLogicError(
+                    'failed mounting data volume {0} on {1}: {2}'.format(
+                        volume['name'], volume['mount_point'],
+                        stderr.read().strip()))
+            lgr.info('mounted data volume {0} on {1}'.format(
+                volume['name'], volume['mount_point']))
+
+    def discard(self, creation):
+        # the vm never came up, the volumes created for it go.
+        try:
+            volumes = creation.get()
+        except CloudstackLogicError:
+            # create() already deleted the ones it made.
+            return
+        self.delete(volumes)
+
+    def delete(self, volumes):
+        """
+        :rtype: 'list' of (volume id, error) for the deletes that failed
+        """
+        def _delete(cloud_driver, volume_id):
+            try:
+                _delete_volume(cloud_driver, volume_id)
+                return None
+            except Exception as exc:
+                lgr.warn('failed deleting volume {0}: {1}'.format(
+                    volume_id, exc))
+                return volume_id, str(exc)
+        return filter(None, self.connector.map(
+            _delete, [v['id'] if isinstance(v, dict) else v
+                      for v in volumes]))
+
+
+class CloudstackManagerCluster(object):
+    """
+    several management vms behind load balancer rules on the management
+    public ip (compute.management_server.cluster). the vms deploy
+    concurrently into a host anti-affinity group, so no two of them share
+    a host. the first node is the one bootstrapped, the management ports
+    that are not balanced are forwarded to it.
+    """
+
+    def __init__(self, connector, provider_config, resolved=None):
+        self.connector = connector
+        self.provider_config = provider_config
+        self.resolved = resolved or {}
+        self.server_config = provider_config['compute']['management_server']
+        cluster_config = self.server_config.get('cluster', {})
+        self.size = cluster_config.get('size', 1)
+        self.node_name = self.server_config['instance']['name']
+        self.group = cluster_config.get('anti_affinity_group') or \
+            self.node_name + '-cluster'
+        self.balanced_ports = cluster_config.get('balanced_ports',
+                                                 [80, 8100])
+        self.algorithm = cluster_config.get('algorithm', 'roundrobin')
+        self.userdata_delivered = False
+
+    def is_enabled(self):
+        zone_type = self.provider_config['cloudstack']['zone_type'].lower()
+        return self.size > 1 and zone_type == 'advanced'
+
+    def _get_node_name(self, index):
+        # the first node keeps the instance name.
+        if index == 1:
+            return self.node_name
+        return '{0}-{1}'.format(self.node_name, index)
+
+    def _deploy_node(self, cloud_driver, item):
+        index, network, userdata = item
+        try:
+            params = cloud_driver._create_args_to_params(
+                None,
+                name=self._get_node_name(index),
+                image=_lookup_management_image(
+                    cloud_driver, self.provider_config, self.resolved),
+                size=_get_resolved_size(
+                    cloud_driver, self.resolved,
+                    self.server_config['instance']['size']),
+                location=NodeLocation(network.zoneid, network.zoneid,
+                                      'Unknown', cloud_driver),
+                networks=[network],
+                ex_keyname=self.server_config['management_keypair']['name'],
+                ex_userdata=userdata)
+            params['affinitygroupnames'] = self.group
+            vm = cloud_driver._async_request(
+                'deployVirtualMachine', params=params)['virtualmachine']
+            return cloud_driver._to_node(vm), None
+        except Exception as exc:
+            return None, exc
+
+    def deploy(self, network):
+        """
+        deploys the nodes concurrently. when one of them fails the others
+        are destroyed again.
+
+        :rtype: 'tuple' of the 'list' of nodes, first node first, and
+        whether the anti-affinity group was created for them
+        """
+        cloud_driver = self.connector.get()
+        group_created = _ensure_affinity_group(cloud_driver, self.group)
+        userdata = CloudstackUserdataBuilder(self.provider_config).build()
+        self.userdata_delivered = userdata is not None
+        lgr.info('deploying {0} management vms in {1}'.format(
+            self.size, self.group))
+        results = self.connector.map(
+            self._deploy_node, [(index, network, userdata) for index
+                                in range(1, self.size + 1)])
+        nodes = [node for node, _ in results if node is not None]
+        errors = [str(error) for _, error in results if error is not None]
+        if errors:
+            self._remove(nodes, group_created)
+            raise CloudstackLogicError(
+                'failed deploying management vms: {0}'.format(
+                    ', '.join(errors)))
+        return nodes, group_created
+
+    def _remove(self, nodes, group_created):
+        self.connector.map(self._delete, [('vm', node.id)
+                                          for node in nodes])
+        if group_created:
+            self.delete_group({'resources': {'affinity_group': self.group}})
+
+    def balance(self, public_ip, nodes):
+        """
+        creates a load balancer rule for every balanced port, each with
+        all of the nodes assigned.
+
+        :rtype: 'list' with the ids of the rules
+        """
+        node_ids = ','.join(node.id for node in nodes)
+
+        def _create(cloud_driver, port):
+            rule = cloud_driver._async_request(
+                'createLoadBalancerRule', params={
+                    'name': '{0}-{1}'.format(self.node_name, port),
+                    'publicipid': public_ip.id,
+                    'publicport': port,
+                    'privateport': port,
+                    'algorithm': self.algorithm,
+                    'openfirewall': False})['loadbalancer']
+            cloud_driver._async_request('assignToLoadBalancerRule', params={
+                'id': rule['id'], 'virtualmachineids': node_ids})
+            lgr.info('balancing port {0} of {1} over {2} vms'.format(
+                port, public_ip.address, len(nodes)))
+            return rule['id']
+        return self.connector.map(_create, self.balanced_ports)
+
+    def _delete(self, cloud_driver, item):
+        resource_type, resource_id = item
+        try:
+            if resource_type == 'vm':
+                cloud_driver._async_request('destroyVirtualMachine',
+                                            params={'id': resource_id})
+            elif resource_type == 'load_balancer_rule':
+                cloud_driver._async_request('deleteLoadBalancerRule',
+                                            params={'id': resource_id})
+            return None
+        except Exception as exc:
+            lgr.warn('failed deleting {0} {1}: {2}'.format(
+                resource_type, resource_id, exc))
+            return resource_type, resource_id, str(exc)
+
+    def remove_members(self, provider_context):
+        """
+        deletes the load balancer rules and destroys every node but the
+        first, all at once.
+
+        :rtype: 'list' of (resource type, resource id, error) for the
+        deletes that failed
+        """
+        rule_ids = provider_context.get('resources', {}).get(
+            'load_balancer_rules', [])
+        node_ids = provider_context.get('mgmt_node_ids', [])[1:]
+        if not rule_ids and not node_ids:
+            return []
+        lgr.info('deleting {0} load balancer rules and {1} management vms'
+                 .format(len(rule_ids), len(node_ids)))
+        items = [('load_balancer_rule', rule_id) for rule_id in rule_ids] + \
+            [('vm', node_id) for node_id in node_ids]
+        return filter(None, self.connector.map(self._delete, items))
+
+    def delete_group(self, provider_context):
+        # only a group provisioning created is recorded.
+        name = provider_context.get('resources', {}).get('affinity_group')
+        if name:
+            lgr.info('deleting anti-affinity group {0}'.format(name))
+            self.connector.get()._async_request('deleteAffinityGroup',
+                                                params={'name': name})
+
+
+class CloudstackWarmPool(object):
+    """
+    keeps stopped, pre-deployed management vms in an existing management
+    network. every pooled vm has a public ip of its own with the
+    management port forwards in place, so claiming one only resets its
+    ssh key (and userdata) and starts it.
+
+    pooled vms are found by name (<instance name>-warm-<suffix>) and
+    state, and deployed without the configured private_ip. a claim tags
+    the vm first, which fails for a vm tagged already, so concurrent runs
+    never claim the same vm and a claimed vm stopped later (e.g. by
+    bake_template) never joins the pool again.
+    """
+
+    NAME_INFIX = '-warm-'
+    CLAIM_TAG = 'cloudify-warm-pool-claim'
+
+    def __init__(self, connector, provider_config, resolved=None):
+        self.connector = connector
+        self.provider_config = provider_config
+        self.resolved = resolved or {}
+        self.server_config = provider_config['compute']['management_server']
+        pool_config = self.server_config.get('warm_pool', {})
+        self.size = pool_config.get('size', 0)
+        self.background_refill = pool_config.get('background_refill', True)
+        self.name_prefix = self.server_config['instance']['name'] + \
+            self.NAME_INFIX
+        self.userdata_delivered = False
+
+    def is_enabled(self):
+        zone_type = self.provider_config['cloudstack']['zone_type'].lower()
+        netw_config = self.provider_config['networking'][
+            'management_network']
+        # teardown deletes networks created by provisioning, and the pool
+        # with them.
+        return self.size > 0 and zone_type == 'advanced' and \
+            netw_config['use_existing']
+
+    def _get_network(self, cloud_driver):
+        network = self.resolved.get('network')
+        if network is not None:
+            return network
+        netw_name = self.provider_config['networking'][
+            'management_network']['name']
+        record = _find_resource(cloud_driver, 'listNetworks', 'network',
+                                netw_name, keyword=netw_name)
+        if record is None:
+            raise CloudstackLogicError(
+                'management network {0} cannot be found'.format(netw_name))
+        return _to_network(cloud_driver, record)
+
+    def list_members(self, cloud_driver, network):
+        """
+        :rtype: 'list' of the stopped pooled vm records
+        """
+        return [vm for vm in _list_resources(
+            cloud_driver, 'listVirtualMachines', 'virtualmachine',
+            networkid=network.id, state='Stopped')
+            if vm['name'].startswith(self.name_prefix) and
+            not any(tag.get('key') == self.CLAIM_TAG
+                    for tag in vm.get('tags') or [])]
+
+    def _tag_claimed(self, cloud_driver, vm):
+        """
+        :rtype: 'bool', whether this run claimed the vm
+        """
+        claim_id = uuid.uuid4().hex
+        try:
+            cloud_driver._async_request('createTags', params={
+                'resourceids': vm['id'],
+                'resourcetype': 'UserVm',
+                'tags[0].key': self.CLAIM_TAG,
+                'tags[0].value': claim_id})
+        except Exception as exc:
+            lgr.debug('warm pool vm {0} is claimed already: {1}'.format(
+                vm['name'], exc))
+            return False
+        # the tag is the one of this run once it is there.
+        tags = _list_resources(cloud_driver, 'listTags', 'tag',
+                               resourceid=vm['id'], resourcetype='UserVm',
+                               key=self.CLAIM_TAG)
+        return [tag.get('value') for tag in tags] == [claim_id]
+
+    def _untag_claimed(self, cloud_driver, vm):
+        try:
+            cloud_driver._async_request('deleteTags', params={
+                'resourceids': vm['id'],
+                'resourcetype': 'UserVm',
+                'tags[0].key': self.CLAIM_TAG})
+        except Exception as exc:
+            lgr.warn('cannot return vm {0} to the warm pool: {1}'.format(
+                vm['name'], exc))
+
+    def _get_public_ip(self, cloud_driver, network, vm_id):
+        for rule in _list_resources(cloud_driver, 'listPortForwardingRules',
+                                    'portforwardingrule',
+                                    networkid=network.id):
+            if rule['virtualmachineid'] == vm_id:
+                return {'id': rule['ipaddressid'],
+                        'address': rule['ipaddress']}
+        return None
+
+    def _deploy_member(self, cloud_driver, network):
+        netw_config = self.provider_config['networking'][
+            'management_network']
+        instance_config = self.server_config['instance']
+        name = '{0}{1}'.format(self.name_prefix,
+                               hashlib.sha1(os.urandom(8)).hexdigest()[:8])
+        params = cloud_driver._create_args_to_params(
+            None,
+            name=name,
+            image=_lookup_management_image(
+                cloud_driver, self.provider_config, self.resolved),
+            size=_get_resolved_size(cloud_driver, self.resolved,
+                                    instance_config['size']),
+            location=NodeLocation(network.zoneid, network.zoneid,
+                                  'Unknown', cloud_driver),
+            networks=[network],
+            ex_keyname=self.server_config['management_keypair']['name'])
+        params['startvm'] = 'false'
+
+        lgr.info('deploying warm pool vm {0}'.format(name))
+        vm = cloud_driver._async_request('deployVirtualMachine',
+                                         params=params)['virtualmachine']
+        ip_id = None
+        try:
+            ip_id = cloud_driver._async_request(
+                'associateIpAddress',
+                params={'networkid': network.id})['ipaddress']['id']
+            for port in netw_config['ports']:
+                cloud_driver._async_request('createPortForwardingRule',
+                                            params={
+                                                'ipaddressid': ip_id,
+                                                'privateport': port,
+                                                'publicport': port,
+                                                'protocol': netw_config.get(
+                                                    'protocol', 'TCP'),
+                                                'virtualmachineid': vm['id'],
+                                                'openfirewall': False})
+        except Exception:
+            cloud_driver._async_request('destroyVirtualMachine',
+                                        params={'id': vm['id']})
+            if ip_id is not None:
+                cloud_driver._async_request('disassociateIpAddress',
+                                            params={'id': ip_id})
+            raise
+        return vm['id']
+
+    def fill(self):
+        """
+        deploys pooled vms until the pool holds its configured size.
+
+        :rtype: 'list' with the ids of the deployed vms
+        """
+        cloud_driver = self.connector.get()
+        network = self._get_network(cloud_driver)
+        missing = self.size - len(self.list_members(cloud_driver, network))
+        if missing <= 0:
+            return []
+        lgr.info('adding {0} vms to the warm pool of {1}'.format(
+            missing, network.name))
+        return self.connector.map(
+            lambda driver, _: self._deploy_member(driver, network),
+            range(missing))
+
+    def schedule_refill(self):
+        def _refill():
+            try:
+                self.fill()
+            except Exception as exc:
+                lgr.warn('failed refilling the warm pool: {0}'.format(exc))
+            finally:
+                self.connector.job_timings.save()
+
+        # not a daemon, deployments already started should finish.
+        refill_thread = threading.Thread(target=_refill,
+                                         name='cloudstack-warm-pool')
+        # set explicitly, provisioning may run on a (daemon) worker.
+        refill_thread.daemon = False
+        refill_thread.start()
+        return refill_thread
+
+    def claim(self, cloud_driver):
+        """
+        starts a pooled vm with the current management keypair and
+        userdata.
+
+        :rtype: 'tuple' of the started node and a dict with the id and
+        address of its public ip, or None when the pool is empty.
+        """
+        network = self._get_network(cloud_driver)
+        userdata = CloudstackUserdataBuilder(self.provider_config).build()
+        for vm in self.list_members(cloud_driver, network):
+            public_ip = self._get_public_ip(cloud_driver, network, vm['id'])
+            if public_ip is None:
+                lgr.debug('skipping warm pool vm {0} without port forwards'
+                          .format(vm['name']))
+                continue
+            # lost to another run, the next vm is tried.
+            if not self._tag_claimed(cloud_driver, vm):
+                continue
+            try:
+                # the keypair may have been recreated since the deploy.
+                cloud_driver._async_request(
+                    'resetSSHKeyForVirtualMachine',
+                    params={'id': vm['id'],
+                            'keypair': self.server_config[
+                                'management_keypair']['name']})
+                if userdata is not None:
+                    cloud_driver._sync_request(
+                        'updateVirtualMachine',
+                        params={'id': vm['id'],
+                                'userdata': base64.b64encode(userdata)})
+                data = cloud_driver._async_request(
+                    'startVirtualMachine',
+                    params={'id': vm['id']})['virtualmachine']
+            except Exception as exc:
+                lgr.warn('failed starting warm pool vm {0}: {1}'.format(
+                    vm['name'], exc))
+                self._untag_claimed(cloud_driver, vm)
+                continue
+            lgr.info('claimed warm pool vm {0}'.format(vm['name']))
+            self.userdata_delivered = userdata is not None
+            return cloud_driver._to_node(data), public_ip
+        return None
+
+
+class CloudstackBulkTerminator(object):
+    """
+    tears down the resources of many provider contexts. vms, keypairs,
+    networks and security groups are listed once, the deletes are grouped
+    by resource type and run on the connector's worker pool, whose size
+    caps the number of concurrent api calls.
+    """
+
+    LISTINGS = {
+        'vms': ('listVirtualMachines', 'virtualmachine'),
+        'keypairs': ('listSSHKeyPairs', 'sshkeypair'),
+        'networks': ('listNetworks', 'network'),
+        'security_groups': ('listSecurityGroups', 'securitygroup'),
+        'public_ips': ('listPublicIpAddresses', 'publicipaddress'),
+        'volumes': ('listVolumes', 'volume'),
+        'load_balancer_rules': ('listLoadBalancerRules', 'loadbalancerrule'),
+        'affinity_groups': ('listAffinityGroups', 'affinitygroup'),
+    }
+    # types within a tier are deleted together, tiers one after the other.
+    # a network cannot be deleted while it still has ips.
+    TIERS = (('vms', 'keypairs', 'load_balancer_rules'),
+             ('public_ips', 'volumes', 'affinity_groups'),
+             ('networks', 'security_groups'))
+
+    def __init__(self, connector, provider_config):
+        self.connector = connector
+        self.provider_config = provider_config
+
+    def _list(self, cloud_driver, resource_type):
+        command, response_key = self.LISTINGS[resource_type]
+        return resource_type, list(_iter_resources(
+            cloud_driver, command, response_key, self.connector))
+
+    def _group_deletes(self, provider_contexts, inventory):
+        by_id = dict((vm['id'], vm) for vm in inventory['vms'])
+        ips_by_id = dict((ip['id'], ip) for ip in inventory['public_ips'])
+        volumes_by_id = dict((v['id'], v) for v in inventory['volumes'])
+        rules_by_id = dict((r['id'], r)
+                           for r in inventory['load_balancer_rules'])
+        by_name = dict(
+            (resource_type,
+             dict((r['name'], r) for r in inventory[resource_type]))
+            for resource_type in ('keypairs', 'networks', 'security_groups',
+                                  'affinity_groups'))
+
+        deletes = dict((t, {}) for t in self.LISTINGS.keys())
+        for provider_context in provider_contexts:
+            # cluster contexts list all of their vms.
+            for node_id in provider_context.get(
+                    'mgmt_node_ids', [provider_context['mgmt_node_id']]):
+                if node_id in by_id:
+                    deletes['vms'][node_id] = by_id[node_id]
+                else:
+                    lgr.info('management vm {0} not found'.format(node_id))
+            # contexts of older provisions only carry the vm id.
+            resources = _get_provisioned_resources(self.provider_config,
+                                                   provider_context)
+            names = {'keypairs': resources.get('keypairs', []),
+                     'networks': filter(None, [resources.get('network')]),
+                     'security_groups': filter(
+                         None, [resources.get('security_group')]),
+                     'affinity_groups': filter(
+                         None, [resources.get('affinity_group')])}
+            for resource_type, resource_names in names.iteritems():
+                for name in resource_names:
+                    record = by_name[resource_type].get(name)
+                    if record is None:
+                        lgr.info('{0} {1} not found'.format(resource_type,
+                                                            name))
+                        continue
+                    deletes[resource_type][name] = record
+            ip_id = resources.get('public_ip')
+            if ip_id in ips_by_id:
+                deletes['public_ips'][ip_id] = ips_by_id[ip_id]
+            for volume_id in resources.get('volumes', []):
+                if volume_id in volumes_by_id:
+                    deletes['volumes'][volume_id] = volumes_by_id[volume_id]
+            for rule_id in resources.get('load_balancer_rules', []):
+                if rule_id in rules_by_id:
+                    deletes['load_balancer_rules'][rule_id] = \
+                        rules_by_id[rule_id]
+        return deletes
+
+    def _delete(self, cloud_driver, item):
+        resource_type, record = item
+        try:
+            if resource_type == 'vms':
+                cloud_driver._async_request('destroyVirtualMachine',
+                                            params={'id': record['id']})
+            elif resource_type == 'keypairs':
+                cloud_driver._sync_request('deleteSSHKeyPair',
+                                           params={'name': record['name']})
+            elif resource_type == 'networks':
+                cloud_driver._async_request('deleteNetwork',
+                                            params={'id': record['id']})
+            elif resource_type == 'security_groups':
+                cloud_driver._sync_request('deleteSecurityGroup',
+                                           params={'id': record['id']})
+            elif resource_type == 'public_ips':
+                cloud_driver._async_request('disassociateIpAddress',
+                                            params={'id': record['id']})
+            elif resource_type == 'volumes':
+                _delete_volume(cloud_driver, record['id'])
+            elif resource_type == 'load_balancer_rules':
+                cloud_driver._async_request('deleteLoadBalancerRule',
+                                            params={'id': record['id']})
+            elif resource_type == 'affinity_groups':
+                cloud_driver._async_request('deleteAffinityGroup',
+                                            params={'id': record['id']})
+            return None
+        except Exception as exc:
+            lgr.warn('failed deleting {0} {1}: {2}'.format(
+                resource_type, _describe_record(record), exc))
+            return (resource_type, record.get('id') or record.get('name'),
+                    str(exc))
+
+    def terminate(self, provider_contexts):
+        """
+        :rtype: 'list' of (resource type, resource, error) for the
+        deletes that failed
+        """
+        lgr.info('tearing-down {0} management vms'.format(
+            len(provider_contexts)))
+        inventory = dict(self.connector.map(self._list,
+                                            self.LISTINGS.keys()))
+        deletes = self._group_deletes(provider_contexts, inventory)
+
+        failures = []
+        for tier in self.TIERS:
+            items = [(resource_type, record) for resource_type in tier
+                     for record in deletes[resource_type].values()]
+            lgr.info('deleting {0}'.format(', '.join(
+                '{0} {1}'.format(len(deletes[t]), t) for t in tier)))
+            failures.extend(r for r in self.connector.map(self._delete, items)
+                            if r)
+        return failures
+
+
 class CloudstackLogicError(RuntimeError):
     pass
 
 
+class CloudstackDaemonClient(object):
+    """
+    client of the local daemon (see cloudify_cloudstack.daemon). a call
+    is one json line each way over the daemon's unix socket.
+    """
+
+    def __init__(self, sock, socket_path):
+        self.sock = sock
+        self.socket_path = socket_path
+
+    @classmethod
+    def connect(cls, socket_path=None):
+        """
+        :rtype: a connected 'CloudstackDaemonClient' or None when no
+        daemon is running.
+        """
+        socket_path = expanduser(socket_path or DEFAULT_DAEMON_SOCKET)
+        if not os.path.exists(socket_path):
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(socket_path)
+        except socket.error as exc:
+            # left behind by a daemon that is gone.
+            lgr.debug('daemon at {0} is not running: {1}'.format(
+                socket_path, exc))
+            sock.close()
+            return None
+        return cls(sock, socket_path)
+
+    def call(self, method, provider_config, args=(), kwargs=None,
+             session=None):
+        """
+        :rtype: 'tuple' with the result of the call and the provider
+        config the daemon's manager ended with
+        """
+        try:
+            self.sock.sendall(json.dumps({'method': method,
+                                          'config': provider_config,
+                                          'args': list(args),
+                                          'kwargs': kwargs or {},
+                                          'session': session}) + '\n')
+            line = self.sock.makefile('r').readline()
+        finally:
+            self.sock.close()
+        if not line:
+            raise CloudstackLogicError(
+                'the daemon closed the connection during {0}'.format(method))
+        response = json.loads(line)
+        if 'error' in response:
+            if response['error_type'] == 'CloudstackLogicError':
+                raise CloudstackLogicError(response['error'])
+            raise RuntimeError('{0}: {1}'.format(response['error_type'],
+                                                 response['error']))
+        return response['result'], response['config']
+
+
+class CloudstackJobTimings(object):
+    """
+    historical durations of mutating api calls (async jobs included),
+    kept per api_url under ~/.cloudify as a moving average. used to
+    estimate how long a plan will take.
+    """
+
+    # weight of a new sample in the moving average
+    ALPHA = 0.3
+
+    def __init__(self, api_url, cache_dir=None):
+        self.path = os.path.join(
+            expanduser(cache_dir or CACHE_DIR),
+            'cloudstack-timings-{0}.json'.format(
+                hashlib.sha1(str(api_url)).hexdigest()[:12]))
+        self._lock = threading.Lock()
+        self._samples = {}
+        self._stats = self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError) as exc:
+            lgr.debug('ignoring unreadable job timings {0}: {1}'
+                      .format(self.path, exc))
+            return {}
+
+    def record(self, command, duration):
+        with self._lock:
+            self._samples.setdefault(command, []).append(duration)
+
+    def estimate(self, command):
+        """
+        :rtype: 'float' with the average duration in seconds or None if
+        the command was never timed.
+        """
+        stats = self._stats.get(command)
+        return stats['avg'] if stats else None
+
+    def save(self):
+        with self._lock:
+            samples, self._samples = self._samples, {}
+        if not samples:
+            return
+        # merges into what other processes may have written meanwhile.
+        stats = self._load()
+        for command, durations in samples.iteritems():
+            entry = stats.setdefault(command, {'avg': durations[0],
+                                               'count': 0})
+            for duration in durations:
+                entry['avg'] += self.ALPHA * (duration - entry['avg'])
+            entry['count'] += len(durations)
+        try:
+            cache_dir = os.path.dirname(self.path)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            tmp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(stats, f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as exc:
+            lgr.debug('failed saving job timings: {0}'.format(exc))
+        self._stats = stats
+
+
+class CloudstackSingleFlight(object):
+    """
+    collapses identical read calls made at the same time by threads of
+    one connector into a single api call whose response all of them get.
+    empty ("not found") responses can be kept for a few seconds; any
+    mutating call made through the connector drops them.
+    """
+
+    def __init__(self, negative_ttl=0):
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._not_found = {}
+
+    @staticmethod
+    def get_key(command, params):
+        return (command.lower(), tuple(sorted(
+            (str(k).lower(), str(v)) for k, v in (params or {}).items())))
+
+    def call(self, key, func):
+        with self._lock:
+            if self._not_found.get(key, 0) > time.time():
+                return {}
+            self._not_found.pop(key, None)
+            flight = self._calls.get(key)
+            leader = flight is None
+            if leader:
+                flight = {'done': threading.Event()}
+                self._calls[key] = flight
+
+        if not leader:
+            flight['done'].wait()
+            if 'error' in flight:
+                raise flight['error']
+            # callers may change what they get back.
+            return deepcopy(flight['result'])
+
+        try:
+            result = func()
+            # kept apart from the leader's result, which it may change
+            # while followers copy.
+            flight['result'] = deepcopy(result)
+        except Exception as exc:
+            flight['error'] = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                if self.negative_ttl and 'error' not in flight and \
+                        not flight['result']:
+                    self._not_found[key] = time.time() + self.negative_ttl
+            flight['done'].set()
+        return result
+
+    def invalidate(self):
+        with self._lock:
+            self._not_found.clear()
+
+
+def _abort_request(cloud_driver):
+    # libcloud opens a connection per request, shutting its socket down
+    # makes the request in flight fail at once.
+    cloud_driver.aborted = True
+    connection = getattr(cloud_driver.connection, 'connection', None)
+    sock = getattr(connection, 'sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+
+class CloudstackHedger(object):
+    """
+    sends a second request for a read call which is still unanswered
+    after the p95 latency seen for its command. the first answer is
+    used and the other request is aborted. at most max_in_flight hedges
+    run at a time, so a slow api endpoint is never hit by a hedge storm.
+    """
+
+    def __init__(self, connector, percentile=0.95, min_delay=1,
+                 min_samples=20, max_in_flight=4):
+        self.connector = connector
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.max_in_flight = max_in_flight
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._latencies = {}
+        self._pending = []
+        self._seq = 0
+        self._in_flight = 0
+        self._watcher = None
+        self._pool = None
+
+    def get_delay(self, command):
+        """
+        :rtype: 'float' with the seconds after which a call of command is
+        hedged or None while too few calls were timed.
+        """
+        with self._lock:
+            latencies = sorted(self._latencies.get(command, ()))
+        if len(latencies) < self.min_samples:
+            return None
+        index = min(len(latencies) - 1,
+                    int(len(latencies) * self.percentile))
+        return max(self.min_delay, latencies[index])
+
+    def _record(self, command, latency):
+        with self._lock:
+            latencies = self._latencies.get(command)
+            if latencies is None:
+                latencies = self._latencies[command] = \
+                    collections.deque(maxlen=200)
+            latencies.append(latency)
+
+    def call(self, cloud_driver, command, request):
+        """
+        performs request(cloud_driver), hedged by request(other driver)
+        once it is late.
+        """
+        command = command.lower()
+        delay = self.get_delay(command)
+        start = time.time()
+        if delay is None:
+            result = request(cloud_driver)
+            self._record(command, time.time() - start)
+            return result
+
+        call = {'driver': cloud_driver, 'request': request,
+                'done': threading.Event()}
+        self._schedule(start + delay, call)
+        try:
+            result = request(cloud_driver)
+        except Exception:
+            if self._settle(call) == 'primary':
+                raise
+        else:
+            if self._settle(call) == 'primary':
+                self._record(command, time.time() - start)
+                return result
+
+        # the hedge answered first and aborted this request.
+        call['done'].wait()
+        cloud_driver.aborted = False
+        self._record(command, time.time() - start)
+        lgr.debug('hedged {0} answered first'.format(command))
+        return call['result']
+
+    def _settle(self, call):
+        # the primary request answered, it wins unless the hedge did first.
+        with self._lock:
+            winner = call.setdefault('winner', 'primary')
+            if winner == 'primary' and call.get('hedge_driver') is not None:
+                _abort_request(call['hedge_driver'])
+            # no hedge is due anymore, the watcher stops once none is.
+            pending = [entry for entry in self._pending
+                       if entry[2] is not call]
+            if len(pending) < len(self._pending):
+                heapq.heapify(pending)
+                self._pending = pending
+                self._wakeup.notify()
+            return winner
+
+    def _schedule(self, deadline, call):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.max_in_flight)
+            if self._watcher is None:
+                # runs while hedges are due only. a daemon, hedges are
+                # reads whose callers have the answer once the process
+                # exits.
+                self._watcher = threading.Thread(target=self._watch,
+                                                 name='cloudstack-hedger')
+                self._watcher.daemon = True
+                self._watcher.start()
+            self._seq += 1
+            heapq.heappush(self._pending, (deadline, self._seq, call))
+            self._wakeup.notify()
+
+    def _watch(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._watcher = None
+                    return
+                if self._pending[0][0] > time.time():
+                    self._wakeup.wait(self._pending[0][0] - time.time())
+                    continue
+                call = heapq.heappop(self._pending)[2]
+                if 'winner' in call or \
+                        self._in_flight >= self.max_in_flight:
+                    continue
+                self._in_flight += 1
+            self._pool.apply_async(self._hedge, (call,))
+
+    def _hedge(self, call):
+        cloud_driver = self.connector.get()
+        try:
+            with self._lock:
+                if 'winner' in call:
+                    return
+                call['hedge_driver'] = cloud_driver
+            try:
+                result = call['request'](cloud_driver)
+            except Exception as exc:
+                with self._lock:
+                    call['hedge_driver'] = None
+                    cloud_driver.aborted = False
+                # the primary request may still succeed.
+                lgr.debug('hedge request failed: {0}'.format(exc))
+                return
+            with self._lock:
+                call['hedge_driver'] = None
+                cloud_driver.aborted = False
+                if 'winner' in call:
+                    return
+                call['winner'] = 'hedge'
+                call['result'] = result
+                call['done'].set()
+                _abort_request(call['driver'])
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+
+def _get_api_urls(provider_config):
+    """
+    :rtype: 'list' with the api endpoints of authentication.api_url,
+    which is a single url or a list of urls of the same cloud.
+    """
+    api_url = provider_config['authentication']['api_url']
+    return [api_url] if isinstance(api_url, basestring) else list(api_url)
+
+
+def _is_endpoint_error(exc):
+    # errors of the endpoint itself, as opposed to errors returned by the
+    # api for the call made (which any other endpoint would return too).
+    if isinstance(exc, (socket.error, httplib.HTTPException,
+                        MalformedResponseError)):
+        return True
+    return isinstance(exc, ProviderError) and \
+        exc.http_code in (httplib.BAD_GATEWAY, httplib.SERVICE_UNAVAILABLE,
+                          httplib.GATEWAY_TIMEOUT)
+
+
+class CloudstackEndpoint(object):
+    def __init__(self, url):
+        self.url = url
+        parsed = urlparse.urlparse(url)
+        self.secure = int(parsed.scheme == 'https')
+        self.host = parsed.hostname
+        self.port = parsed.port or (443 if self.secure else 80)
+        self.path = parsed.path
+        # moving averages of the request latency (None until measured)
+        # and error rate
+        self.latency = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.open_until = 0
+        # whether the single request sent once the circuit half opens is
+        # in flight
+        self.probing = False
+        self.in_flight = 0
+
+
+class CloudstackEndpointPool(object):
+    """
+    the api endpoints (management servers) of one cloud. requests go to
+    the endpoint with the lowest expected wait, estimated from its moving
+    latency, error rate and requests in flight. an endpoint failing
+    failure_threshold requests in a row is skipped for reset_timeout
+    seconds, then gets a single probe request which closes its circuit
+    again or keeps it open.
+    """
+
+    # weight of a new sample in the moving averages
+    ALPHA = 0.2
+    # seconds a failing request is assumed to cost
+    ERROR_COST = 10
+
+    def __init__(self, urls, failure_threshold=3, reset_timeout=30):
+        self.endpoints = [CloudstackEndpoint(url) for url in urls]
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def _score(self, endpoint, prior):
+        latency = endpoint.latency if endpoint.latency is not None \
+            else prior
+        return latency * (1 + endpoint.in_flight) + \
+            self.ERROR_COST * endpoint.error_rate
+
+    def acquire(self, exclude=()):
+        """
+        :rtype: 'CloudstackEndpoint' to send the next request to. it is
+        counted in flight until released.
+        """
+        with self._lock:
+            now = time.time()
+            candidates = [e for e in self.endpoints if e not in exclude]
+            half_open = [e for e in candidates if 0 < e.open_until <= now
+                         and not e.probing]
+            closed = [e for e in candidates if not e.open_until]
+            if half_open:
+                endpoint = half_open[0]
+                endpoint.probing = True
+                lgr.debug('probing api endpoint {0}'.format(endpoint.url))
+            elif closed:
+                # endpoints not measured yet are expected to be as fast
+                # as the others on average.
+                measured = [e.latency for e in self.endpoints
+                            if e.latency is not None]
+                prior = sum(measured) / len(measured) if measured else 0.0
+                endpoint = min(closed, key=lambda e: self._score(e, prior))
+            else:
+                # every circuit is open, the one closing first is tried.
+                endpoint = min(candidates, key=lambda e: e.open_until)
+            endpoint.in_flight += 1
+            return endpoint
+
+    def release(self, endpoint, latency=None, error=False):
+        with self._lock:
+            endpoint.in_flight -= 1
+            endpoint.error_rate += self.ALPHA * (
+                int(error) - endpoint.error_rate)
+            probing = endpoint.probing
+            endpoint.probing = False
+            if error:
+                endpoint.failures += 1
+                if probing or endpoint.failures >= self.failure_threshold:
+                    lgr.warn('api endpoint {0} failed {1} requests in a row, '
+                             'skipping it for {2} seconds'.format(
+                                 endpoint.url, endpoint.failures,
+                                 self.reset_timeout))
+                    endpoint.open_until = time.time() + self.reset_timeout
+                return
+            endpoint.failures = 0
+            endpoint.open_until = 0
+            if latency is not None:
+                endpoint.latency = latency if endpoint.latency is None \
+                    else endpoint.latency + self.ALPHA * (
+                        latency - endpoint.latency)
+
+
+class CloudstackConnection(CloudStackConnection):
+    """
+    the libcloud cloudstack connection, signing the fields of a form
+    encoded request body together with the query parameters, as
+    cloudstack verifies the signature over both.
+    """
+
+    _body_params = None
+
+    def encode_data(self, data):
+        # called before pre_connect_hook, only for requests with a body.
+        self._body_params = data or None
+        return super(CloudstackConnection, self).encode_data(data)
+
+    def pre_connect_hook(self, params, headers):
+        body_params, self._body_params = self._body_params, None
+        if not body_params:
+            return super(CloudstackConnection, self).pre_connect_hook(
+                params, headers)
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        signed = dict(params)
+        signed.update(body_params)
+        params['signature'] = self._make_signature(signed)
+        return params, headers
+
+
+def _move_body_params(kwargs):
+    # (command, action, params, data, headers, method, ...)
+    params = kwargs.get('params')
+    if not params or not any(key in params for key in BODY_PARAMS):
+        return kwargs
+    kwargs = dict(kwargs)
+    params = dict(params)
+    data = dict(kwargs.get('data') or {})
+    for key in BODY_PARAMS:
+        if key in params:
+            data[key] = params.pop(key)
+    kwargs.update({'params': params, 'data': data, 'method': 'POST'})
+    return kwargs
+
+
+class CloudstackDriver(CloudStackNodeDriver):
+    """
+    the libcloud cloudstack driver with the provider's request hooks.
+    every api call of the provider goes through _sync_request or
+    _async_request.
+    """
+
+    connectionCls = CloudstackConnection
+    job_timings = None
+    single_flight = None
+    hedger = None
+    endpoints = None
+    aborted = False
+    page_size = DEFAULT_PAGE_SIZE
+
+    def _timed(self, request, command, *args, **kwargs):
+        if command.lower().startswith(READ_ONLY_COMMAND_PREFIXES):
+            return request(command, *args, **kwargs)
+        if self.single_flight is not None:
+            # whatever was not found may exist after this call.
+            self.single_flight.invalidate()
+        if self.job_timings is None:
+            return request(command, *args, **kwargs)
+        start = time.time()
+        result = request(command, *args, **kwargs)
+        self.job_timings.record(command, time.time() - start)
+        return result
+
+    def _on_endpoint(self, request, timed, command, *args, **kwargs):
+        if self.endpoints is None:
+            return request(command, *args, **kwargs)
+        failed = []
+        while True:
+            endpoint = self.endpoints.acquire(exclude=failed)
+            self.path = endpoint.path
+            self.connection.host = endpoint.host
+            self.connection.port = endpoint.port
+            self.connection.secure = endpoint.secure
+            start = time.time()
+            try:
+                result = request(command, *args, **kwargs)
+            except Exception as exc:
+                if self.aborted or not _is_endpoint_error(exc):
+                    self.endpoints.release(endpoint)
+                    raise
+                self.endpoints.release(endpoint, error=True)
+                failed.append(endpoint)
+                # a mutating call may have been made before the endpoint
+                # failed, so only reads are sent again.
+                if len(failed) == len(self.endpoints) or \
+                        not command.lower().startswith(
+                            READ_ONLY_COMMAND_PREFIXES):
+                    raise
+                lgr.warn('{0} failed on {1}, failing over: {2}'.format(
+                    command, endpoint.url, exc))
+                continue
+            self.endpoints.release(
+                endpoint, latency=time.time() - start if timed else None)
+            return result
+
+    def _endpoint_sync_request(self, command, *args, **kwargs):
+        return self._on_endpoint(super(CloudstackDriver, self)._sync_request,
+                                 True, command, *args, **kwargs)
+
+    def _sync_request(self, command, *args, **kwargs):
+        # userdata goes in a POST body, a query string only takes 2KB.
+        kwargs = _move_body_params(kwargs)
+        request = self._endpoint_sync_request
+        if self.hedger is not None and \
+                command.lower().startswith(READ_ONLY_COMMAND_PREFIXES):
+            hedger = self.hedger
+            request = lambda *a, **kw: hedger.call(
+                self, command,
+                lambda driver: driver._endpoint_sync_request(*a, **kw))
+        if self.single_flight is not None and \
+                command.lower().startswith(READ_ONLY_COMMAND_PREFIXES):
+            # (command, action, params, ...)
+            params = kwargs.get('params', args[1] if len(args) > 1 else None)
+            return self.single_flight.call(
+                CloudstackSingleFlight.get_key(command, params),
+                lambda: request(command, *args, **kwargs))
+        return self._timed(request, command, *args, **kwargs)
+
+    def _async_request(self, command, *args, **kwargs):
+        # async jobs are polled on the endpoint they were started on, any
+        # management server of the cloud can tell their result. the time
+        # they take says nothing about the endpoint.
+        kwargs = _move_body_params(kwargs)
+        request = functools.partial(
+            self._on_endpoint, super(CloudstackDriver, self)._async_request,
+            False)
+        return self._timed(request, command, *args, **kwargs)
+
+
 class CloudstackConnector(object):
     def __init__(self, provider_config):
         self.config = provider_config
+        self.concurrency = provider_config.get('cloudstack', {}).get(
+            'concurrency', DEFAULT_CONCURRENCY)
+        self.page_size = provider_config.get('cloudstack', {}).get(
+            'page_size', DEFAULT_PAGE_SIZE)
+        self.job_timings = CloudstackJobTimings(
+            provider_config['authentication']['api_url'])
+        self.single_flight = None
+        single_flight_config = provider_config.get('cloudstack', {}).get(
+            'single_flight', {})
+        if single_flight_config.get('enabled', True):
+            self.single_flight = CloudstackSingleFlight(
+                single_flight_config.get('negative_ttl', 2))
+        self.hedger = None
+        hedging_config = provider_config.get('cloudstack', {}).get(
+            'hedging', {})
+        if hedging_config.get('enabled', True):
+            self.hedger = CloudstackHedger(
+                self,
+                percentile=hedging_config.get('percentile', 0.95),
+                min_delay=hedging_config.get('min_delay', 1),
+                min_samples=hedging_config.get('min_samples', 20),
+                max_in_flight=hedging_config.get('max_in_flight', 4))
+        self.endpoints = None
+        api_urls = _get_api_urls(provider_config)
+        if len(api_urls) > 1:
+            endpoints_config = provider_config.get('cloudstack', {}).get(
+                'endpoints', {})
+            self.endpoints = CloudstackEndpointPool(
+                api_urls,
+                failure_threshold=endpoints_config.get('failure_threshold',
+                                                       3),
+                reset_timeout=endpoints_config.get('reset_timeout', 30))
+        self._local = threading.local()
+        self._pool = None
+        self._pool_lock = threading.Lock()
 
     def create(self):
         lgr.debug('creating Cloudstack cloudstack connector')
         api_key = self.config['authentication']['api_key']
         api_secret_key = self.config['authentication']['api_secret_key']
-        api_url = self.config['authentication']['api_url']
-        cls = get_driver(Provider.CLOUDSTACK)
-        return cls(key=api_key, secret=api_secret_key, url=api_url)
+        api_url = _get_api_urls(self.config)[0]
+        driver = CloudstackDriver(key=api_key, secret=api_secret_key,
+                                  url=api_url)
+        driver.endpoints = self.endpoints
+        driver.job_timings = self.job_timings
+        driver.single_flight = self.single_flight
+        driver.hedger = self.hedger
+        driver.page_size = self.page_size
+        return driver
+
+    def get(self):
+        # libcloud connections are not thread safe, so every thread
+        # gets a driver of its own which is reused for later calls.
+        driver = getattr(self._local, 'driver', None)
+        if driver is None:
+            driver = self.create()
+            self._local.driver = driver
+        return driver
+
+    def map(self, func, items, workers=None):
+        """
+        calls func(cloud_driver, item) for every item using a pool of worker
+        threads, each holding its own driver.
+
+        :rtype: 'list' with the results in the order of items
+        """
+        items = list(items)
+        if not items:
+            return []
+        if workers is None and not getattr(self._local, 'in_pool', False):
+            # the workers and their drivers (and connections) are kept
+            # for later calls.
+            return self._get_pool().map(
+                lambda item: self._run_in_pool(func, item), items)
+
+        # nested calls get a pool of their own, waiting on the shared
+        # one from one of its workers could deadlock.
+        pool = ThreadPool(min(workers or self.concurrency, len(items)))
+        try:
+            return pool.map(lambda item: func(self.get(), item), items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def apply_async(self, func, args=()):
+        """
+        calls func(cloud_driver, *args) on one of the worker threads.
+
+        :rtype: 'AsyncResult', or None when called from a worker thread,
+        as waiting on the pool from one of its workers could deadlock.
+        """
+        if getattr(self._local, 'in_pool', False):
+            return None
+        return self._get_pool().apply_async(
+            self._run_in_pool, (lambda driver, item: func(driver, *item),
+                                args))
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.concurrency)
+            return self._pool
+
+    def _run_in_pool(self, func, item):
+        self._local.in_pool = True
+        return func(self.get(), item)
+
+
+# resource types of listResourceLimits a provisioning uses, with the
+# field of listAccounts telling how many of them the account uses
+ACCOUNT_RESOURCES = {
+    '0': ('instance', 'vmtotal'),
+    '1': ('public_ip', 'iptotal'),
+    '2': ('volume', 'volumetotal'),
+    '6': ('network', 'networktotal'),
+    '8': ('cpu', 'cputotal'),
+    '9': ('memory', 'memorytotal'),
+    '10': ('primary_storage', 'primarystoragetotal'),
+}
+
+# resources the account pool balances environments on
+SHARDING_RESOURCES = ('instance', 'public_ip', 'network')
+
+
+def _get_account_usage(cloud_driver):
+    """
+    :rtype: 'dict' of resource name to a dict with the 'limit' (None if
+    unlimited), 'used' and 'remaining' (None if unlimited) count of the
+    account of cloud_driver.
+    """
+    return _to_account_usage(
+        _list_resources(cloud_driver, 'listResourceLimits', 'resourcelimit'),
+        _list_resources(cloud_driver, 'listAccounts', 'account'))
+
+
+def _to_account_usage(limits, accounts):
+    account_name = limits[0].get('account') if limits else None
+    # domain admins list the accounts of their domain.
+    account = next((a for a in accounts if a.get('name') == account_name),
+                   accounts[0] if accounts else {})
+    usage = {}
+    for limit in limits:
+        resource = ACCOUNT_RESOURCES.get(str(limit['resourcetype']))
+        if resource is None:
+            continue
+        name, used_field = resource
+        maximum = int(limit['max'])
+        used = int(account.get(used_field, 0))
+        usage[name] = {
+            'limit': None if maximum < 0 else maximum,
+            'used': used,
+            'remaining': None if maximum < 0 else maximum - used,
+        }
+    return usage
+
+
+class CloudstackAccountPool(object):
+    """
+    the api key pairs environments can be provisioned with: the one of
+    authentication and those listed in authentication.accounts, each
+    account having its own api rate and resource limits.
+    """
+
+    def __init__(self, provider_config):
+        self.config = provider_config
+        auth = provider_config['authentication']
+        # the account selected last is in authentication, the configured
+        # one is kept in default_account.
+        default_account = auth.get('default_account') or auth
+        self.accounts = [{'api_key': default_account['api_key'],
+                          'api_secret_key': default_account[
+                              'api_secret_key']}]
+        for account in (auth.get('accounts') or []) + [auth]:
+            if account['api_key'] not in [a['api_key']
+                                          for a in self.accounts]:
+                self.accounts.append({
+                    'api_key': account['api_key'],
+                    'api_secret_key': account['api_secret_key']})
+
+    def __len__(self):
+        return len(self.accounts)
+
+    def get(self, api_key):
+        return next((a for a in self.accounts if a['api_key'] == api_key),
+                    None)
+
+    def get_config(self, api_key):
+        """
+        :rtype: 'dict' with a copy of the provider config using the
+        account of api_key.
+        """
+        account = self.get(api_key)
+        if account is None:
+            raise CloudstackLogicError(
+                'the account of api key {0} is not configured in '
+                'authentication.accounts'.format(api_key))
+        provider_config = dict(self.config)
+        provider_config['authentication'] = dict(
+            self.config['authentication'], **account)
+        return provider_config
+
+    def _get_usage(self, account):
+        try:
+            cloud_driver = CloudstackConnector(
+                self.get_config(account['api_key'])).create()
+            return _get_account_usage(cloud_driver)
+        except Exception as exc:
+            lgr.warn('cannot read the limits of account {0}: {1}'.format(
+                account['api_key'], exc))
+            return None
+
+    def choose(self):
+        """
+        :rtype: 'dict' with the api key pair of the account with the most
+        remaining capacity, that is the most of the resource it has
+        fewest of left.
+        """
+        pool = ThreadPool(len(self.accounts))
+        try:
+            usages = pool.map(self._get_usage, self.accounts)
+        finally:
+            pool.close()
+            pool.join()
+
+        def _capacity(usage):
+            remaining = [usage[name]['remaining']
+                         for name in SHARDING_RESOURCES
+                         if usage.get(name, {}).get('remaining') is not None]
+            return min(remaining) if remaining else float('inf')
+
+        candidates = [(_capacity(usage), index)
+                      for index, usage in enumerate(usages)
+                      if usage is not None]
+        if not candidates:
+            raise CloudstackLogicError(
+                'cannot read the limits of any configured account')
+        capacity, index = max(candidates, key=lambda c: (c[0], -c[1]))
+        account = self.accounts[index]
+        lgr.info('provisioning with account {0} ({1} remaining)'.format(
+            account['api_key'], capacity))
+        return account
+
+
+class CloudstackPreflight(object):
+    """
+    compares what a provisioning needs with the limits and usage of the
+    account and, where the api keys may read it, the capacity of the
+    zone, so a provisioning that cannot fit is refused before anything
+    gets created.
+    """
+
+    # capacity types of listCapacity checked, with the unit of the
+    # capacity per unit of the need (memory is needed in MB).
+    ZONE_CAPACITY = {
+        '0': ('memory', 1024 * 1024),
+        '3': ('primary_storage', 1024 * 1024 * 1024),
+    }
+    # the public ips of advanced zones come from the virtual network pool,
+    # those of basic zones are direct attached.
+    PUBLIC_IP_CAPACITY = {'advanced': '4', 'basic': '8'}
+
+    def __init__(self, connector, provider_config):
+        self.connector = connector
+        self.config = provider_config
+
+    def _list(self, cloud_driver, listing):
+        command, response_key, params = listing
+        try:
+            return _list_resources(cloud_driver, command, response_key,
+                                   **params)
+        except Exception as exc:
+            if command != 'listCapacity':
+                raise
+            # listCapacity is for root admins only.
+            lgr.debug('zone capacity not checked: {0}'.format(exc))
+            return []
+
+    def fetch(self, zone_id=None):
+        """
+        :rtype: 'dict' with the 'account' usage (see _get_account_usage)
+        and the 'zone' capacity, resource name to a dict with the
+        'remaining' count.
+        """
+        listings = [('listResourceLimits', 'resourcelimit', {}),
+                    ('listAccounts', 'account', {})]
+        if zone_id is not None:
+            listings.append(('listCapacity', 'capacity', {'zoneid': zone_id}))
+        results = self.connector.map(self._list, listings)
+
+        zone_capacity = dict(self.ZONE_CAPACITY)
+        zone_type = self.config['cloudstack']['zone_type'].lower()
+        if zone_type in self.PUBLIC_IP_CAPACITY:
+            zone_capacity[self.PUBLIC_IP_CAPACITY[zone_type]] = \
+                ('public_ip', 1)
+        zone = {}
+        for capacity in results[2] if zone_id is not None else []:
+            resource = zone_capacity.get(str(capacity['type']))
+            if resource is None:
+                continue
+            name, unit = resource
+            zone[name] = {'remaining': (int(capacity['capacitytotal']) -
+                                        int(capacity['capacityused'])) /
+                          unit}
+        return {'account': _to_account_usage(results[0], results[1]),
+                'zone': zone}
+
+    def check(self, needs, zone_id=None):
+        """
+        :param dict needs: resource name to the count needed
+        :rtype: 'list' of dicts with the 'scope' (account or zone),
+        'resource', 'needed' and 'available' count of each resource
+        there is not enough of. empty if the needs fit.
+        """
+        usage = self.fetch(zone_id)
+        shortfalls = []
+        for scope in ('account', 'zone'):
+            for resource, needed in sorted(needs.items()):
+                remaining = usage[scope].get(resource, {}).get('remaining')
+                if not needed or remaining is None or needed <= remaining:
+                    continue
+                shortfalls.append({'scope': scope, 'resource': resource,
+                                   'needed': needed,
+                                   'available': max(remaining, 0)})
+        return shortfalls
+
+
+class CloudstackCapacitySnapshot(object):
+    """
+    on-disk snapshot of the zones of a cloud with their pods (host count
+    and memory capacity) and networks, and of the account limits,
+    stored under ~/.cloudify and keyed by api_url and api key. placement
+    decisions are made from it, and placed vms are deducted from it until
+    it is fetched again.
+    """
+
+    def __init__(self, connector, provider_config, cache_dir=None):
+        self.connector = connector
+        auth = provider_config['authentication']
+        self.ttl = provider_config.get('cloudstack', {}).get(
+            'placement', {}).get('snapshot_ttl', 300)
+        self.path = os.path.join(
+            expanduser(cache_dir or CACHE_DIR),
+            'cloudstack-capacity-{0}.json'.format(hashlib.sha1(
+                str((auth['api_url'], auth['api_key']))).hexdigest()[:12]))
+        self._lock = threading.Lock()
+        self._snapshot = None
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError) as exc:
+            lgr.debug('ignoring unreadable capacity snapshot {0}: {1}'
+                      .format(self.path, exc))
+            return None
+
+    def _save(self):
+        cache_dir = os.path.dirname(self.path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self._snapshot, f)
+        os.rename(tmp_path, self.path)
+
+    def get(self):
+        """
+        :rtype: 'dict' with the snapshot, fetched when missing or older
+        than cloudstack.placement.snapshot_ttl seconds.
+        """
+        with self._lock:
+            if self._snapshot is None:
+                self._snapshot = self._load()
+            if self._snapshot is None or \
+                    time.time() - self._snapshot['fetched_at'] > self.ttl:
+                self._snapshot = self.fetch()
+                self._save()
+            return self._snapshot
+
+    def _list(self, cloud_driver, listing):
+        command, response_key, params = listing
+        try:
+            return list(_iter_resources(cloud_driver, command, response_key,
+                                        **params))
+        except Exception as exc:
+            if command not in ('listPods', 'listHosts', 'listCapacity'):
+                raise
+            # pods, hosts and capacity are for root admins only.
+            lgr.debug('{0} not readable, placing without it: {1}'.format(
+                command, exc))
+            return []
+
+    def fetch(self):
+        lgr.debug('fetching the capacity snapshot')
+        listings = [('listZones', 'zone', {'available': 'true'}),
+                    ('listNetworks', 'network', {}),
+                    ('listPods', 'pod', {}),
+                    ('listHosts', 'host', {'type': 'Routing'}),
+                    ('listResourceLimits', 'resourcelimit', {}),
+                    ('listAccounts', 'account', {})]
+        zones, networks, pods, hosts, limits, accounts = \
+            self.connector.map(self._list, listings)
+        capacities = self.connector.map(
+            self._list, [('listCapacity', 'capacity', {'podid': pod['id']})
+                         for pod in pods])
+
+        snapshot_zones = dict(
+            (zone['id'], {'id': zone['id'], 'name': zone['name'],
+                          'pods': [], 'networks': []}) for zone in zones)
+        for network in networks:
+            zone = snapshot_zones.get(network.get('zoneid'))
+            if zone is not None:
+                zone['networks'].append({'id': network['id'],
+                                         'name': network['name']})
+        for pod, capacity in zip(pods, capacities):
+            zone = snapshot_zones.get(pod.get('zoneid'))
+            if zone is None:
+                continue
+            # memory capacity (type 0) is in bytes.
+            memory = next((c for c in capacity if str(c['type']) == '0'),
+                          None)
+            zone['pods'].append({
+                'id': pod['id'], 'name': pod['name'],
+                'hosts': len([h for h in hosts
+                              if h.get('podid') == pod['id']]),
+                'memory_total': int(memory['capacitytotal']) / 2 ** 20
+                if memory else None,
+                'memory_used': int(memory['capacityused']) / 2 ** 20
+                if memory else None})
+        return {'fetched_at': time.time(),
+                'zones': sorted(snapshot_zones.values(),
+                                key=lambda z: z['name']),
+                'account': _to_account_usage(limits, accounts)}
+
+    def deduct(self, placements, memory=0):
+        """
+        accounts for placed vms until the snapshot is fetched again.
+        """
+        with self._lock:
+            pods = dict((pod['id'], pod) for zone in self._snapshot['zones']
+                        for pod in zone['pods'])
+            groups = self._snapshot.setdefault('groups', {})
+            for placement in placements:
+                pod = pods.get(placement['pod_id'])
+                if pod is not None and pod['memory_used'] is not None:
+                    pod['memory_used'] += memory
+                if placement['affinity_group']:
+                    members = groups.setdefault(placement['affinity_group'],
+                                                {})
+                    members[placement['zone_id']] = \
+                        members.get(placement['zone_id'], 0) + 1
+            instance = self._snapshot['account'].get('instance')
+            if instance is not None:
+                instance['used'] += len(placements)
+                if instance['remaining'] is not None:
+                    instance['remaining'] -= len(placements)
+            self._save()
+
+
+class CloudstackPlacementScheduler(object):
+    """
+    spreads vms over the zones, pods and networks of a capacity
+    snapshot. every vm goes to the zone whose roomiest pod keeps the
+    largest share of its memory free (zones without capacity data get
+    the fewest vms), and to the network of that zone with the fewest
+    vms. a zone fits a vm only if one of its pods has room for it, and
+    it takes no more members of a host anti-affinity group than it has
+    hosts.
+    """
+
+    def __init__(self, snapshot, provider_config):
+        self.snapshot = snapshot
+        placement_config = provider_config['compute']['agent_servers'].get(
+            'placement', {})
+        self.zone_names = placement_config.get('zones') or []
+        self.network_names = placement_config.get('networks') or []
+
+    def _get_zones(self, snapshot):
+        zones = []
+        for zone in snapshot['zones']:
+            if self.zone_names and zone['name'] not in self.zone_names \
+                    and zone['id'] not in self.zone_names:
+                continue
+            networks = [n for n in zone['networks']
+                        if not self.network_names or
+                        n['name'] in self.network_names]
+            if networks:
+                zones.append(dict(zone, networks=networks))
+        return zones
+
+    def _choose_pod(self, zone, assigned, memory):
+        # (share of memory left, pod) of the pod with the most room or
+        # None if no pod has room. pods without capacity data always fit.
+        best = None
+        for pod in zone['pods'] or [{'id': None, 'memory_total': None}]:
+            if not pod['memory_total']:
+                share = None
+            else:
+                used = pod['memory_used'] + memory * (
+                    assigned['pods'].get(pod['id'], 0) + 1)
+                if used > pod['memory_total']:
+                    continue
+                share = 1 - float(used) / pod['memory_total']
+            if best is None or share > best[0]:
+                best = (share, pod)
+        return best
+
+    def place(self, count, memory=0, anti_affinity_group=None):
+        """
+        :param int count: number of vms
+        :param int memory: memory of each vm in MB
+        :param str anti_affinity_group: host anti-affinity group the vms
+        are spread with
+        :rtype: 'list' of dicts with the 'zone_id', 'zone_name',
+        'pod_id', 'network_id', 'network_name' and 'affinity_group' of
+        every vm
+        """
+        snapshot = self.snapshot.get()
+        remaining = snapshot['account'].get('instance', {}).get('remaining')
+        if remaining is not None and remaining < count:
+            raise CloudstackLogicError(
+                'cannot place {0} vms, not enough resources: {1}'.format(
+                    count, _format_shortfalls([{
+                        'scope': 'account', 'resource': 'instance',
+                        'needed': count, 'available': max(remaining, 0)}])))
+        zones = self._get_zones(snapshot)
+        if not zones:
+            raise CloudstackLogicError('no zone with a usable network to '
+                                       'place vms in')
+
+        assigned = dict((zone['id'], {'count': 0, 'pods': {}, 'networks': {}})
+                        for zone in zones)
+        # members of the group placed earlier share the hosts.
+        members = snapshot.get('groups', {}).get(anti_affinity_group, {})
+        placements = []
+        for _ in range(count):
+            candidates = []
+            for zone in zones:
+                zone_assigned = assigned[zone['id']]
+                hosts = sum(pod.get('hosts', 0) for pod in zone['pods'])
+                if anti_affinity_group and hosts and zone_assigned[
+                        'count'] + members.get(zone['id'], 0) >= hosts:
+                    continue
+                pod = self._choose_pod(zone, zone_assigned, memory)
+                if pod is not None:
+                    share, pod = pod
+                    candidates.append(((share if share is not None else -1,
+                                        -zone_assigned['count']), zone, pod))
+            if not candidates:
+                raise CloudstackLogicError(
+                    'cannot place {0} vms of {1} MB{2}, there is room for '
+                    '{3}'.format(count, memory, ' in anti-affinity group '
+                                 '{0}'.format(anti_affinity_group)
+                                 if anti_affinity_group else '',
+                                 len(placements)))
+            _, zone, pod = max(candidates, key=lambda c: c[0])
+            zone_assigned = assigned[zone['id']]
+            network = min(zone['networks'], key=lambda n: zone_assigned[
+                'networks'].get(n['id'], 0))
+            zone_assigned['count'] += 1
+            zone_assigned['pods'][pod['id']] = \
+                zone_assigned['pods'].get(pod['id'], 0) + 1
+            zone_assigned['networks'][network['id']] = \
+                zone_assigned['networks'].get(network['id'], 0) + 1
+            placements.append({'zone_id': zone['id'],
+                               'zone_name': zone['name'],
+                               'pod_id': pod['id'],
+                               'network_id': network['id'],
+                               'network_name': network['name'],
+                               'affinity_group': anti_affinity_group})
+        self.snapshot.deduct(placements, memory)
+        return placements
+
+
+def _format_shortfalls(shortfalls):
+    return ', '.join(
+        '{0} {1} (needs {2}, {3} available)'.format(
+            s['scope'], s['resource'], s['needed'], s['available'])
+        for s in shortfalls)
+
+
+def _list_resources(cloud_driver, command, response_key, **params):
+    response = cloud_driver._sync_request(command, params=params)
+    return response.get(response_key, []) if response else []
+
+
+def _iter_resources(cloud_driver, command, response_key, connector=None,
+                    **params):
+    """
+    yields the listed resources page by page, so a caller that stops
+    early never requests the remaining pages. with a connector the next
+    page is requested on its worker pool while the current page is
+    consumed.
+    """
+    page_size = getattr(cloud_driver, 'page_size', DEFAULT_PAGE_SIZE)
+
+    def _fetch_page(driver, page):
+        return driver._sync_request(command, params=dict(
+            params, page=page, pagesize=page_size)) or {}
+
+    page = 1
+    response = _fetch_page(cloud_driver, page)
+    seen = 0
+    while True:
+        items = response.get(response_key, [])
+        seen += len(items)
+        # count is the total number of matching resources.
+        done = len(items) < page_size or \
+            seen >= response.get('count', seen + 1)
+        next_page = None
+        if not done and connector is not None:
+            next_page = connector.apply_async(_fetch_page, (page + 1,))
+        for item in items:
+            yield item
+        if done:
+            return
+        page += 1
+        response = next_page.get() if next_page is not None else \
+            _fetch_page(cloud_driver, page)
+
+
+def _find_resource(cloud_driver, command, response_key, resource_name,
+                   **params):
+    # name filters of the list api are partial matches, hence the
+    # exact comparison on the client side.
+    for resource in _iter_resources(cloud_driver, command, response_key,
+                                    **params):
+        if resource.get('name') == resource_name:
+            return resource
+    return None
+
+
+def _to_image(cloud_driver, data):
+    return NodeImage(id=data['id'],
+                     name=data['name'],
+                     driver=cloud_driver,
+                     extra={'os': data.get('ostypename'),
+                            'ostypeid': data.get('ostypeid'),
+                            'displaytext': data.get('displaytext')})
+
+
+def _to_size(cloud_driver, data):
+    return NodeSize(data['id'], data['name'], data['memory'], 0, 0, 0,
+                    cloud_driver, extra={'cpu': data['cpunumber']})
+
+
+def _to_location(cloud_driver, data):
+    return NodeLocation(str(data['id']), data['name'], 'Unknown',
+                        cloud_driver)
+
+
+def _to_network(cloud_driver, data):
+    return CloudStackNetwork(data['displaytext'],
+                             data['name'],
+                             data['networkofferingid'],
+                             data['id'],
+                             data['zoneid'],
+                             cloud_driver)
+
+
+def _to_network_offering(cloud_driver, data):
+    return CloudStackNetworkOffering(data['name'],
+                                     data['displaytext'],
+                                     data['guestiptype'],
+                                     data['id'],
+                                     data.get('serviceofferingid'),
+                                     data.get('forvpc'),
+                                     cloud_driver)
+
+
+def _to_keypair(cloud_driver, data):
+    return KeyPair(name=data['name'],
+                   public_key=data.get('publickey'),
+                   fingerprint=data['fingerprint'],
+                   driver=cloud_driver)
+
+
+class CloudstackCatalogCache(object):
+    """
+    on-disk snapshot of the templates, service offerings, zones and network
+    offerings of a cloud, stored under ~/.cloudify and keyed by api_url.
+
+    only the fields used by the provider are kept. with background_refresh
+    lookups never block on a full listing: a missing or expired catalog is
+    refreshed in the background while callers fall back to a filtered api
+    call. without it the catalog is refreshed before the lookup. either
+    way a catalog is invalidated as soon as a lookup misses it.
+    """
+
+    # catalog name: (list command, response key, params, kept fields)
+    CATALOGS = {
+        'templates': ('listTemplates', 'template',
+                      {'templatefilter': 'executable'},
+                      ('id', 'name', 'displaytext', 'ostypeid',
+                       'ostypename', 'zoneid', 'isready')),
+        'service_offerings': ('listServiceOfferings', 'serviceoffering', {},
+                              ('id', 'name', 'memory', 'cpunumber',
+                               'cpuspeed')),
+        'zones': ('listZones', 'zone', {},
+                  ('id', 'name', 'networktype')),
+        'network_offerings': ('listNetworkOfferings', 'networkoffering', {},
+                              ('id', 'name', 'displaytext', 'guestiptype',
+                               'serviceofferingid', 'forvpc')),
+    }
+    INDEXED_FIELDS = ('id', 'name')
+    # templates are listed once per zone they are in, under the same id.
+    ZONED_CATALOGS = ('templates',)
+
+    def __init__(self, connector, provider_config, cache_dir=None):
+        self.connector = connector
+        cache_config = provider_config.get('cloudstack', {}).get(
+            'catalog_cache', {})
+        self.ttl = cache_config.get('ttl', DEFAULT_CATALOG_TTL)
+        self.background_refresh = cache_config.get('background_refresh',
+                                                   True)
+        api_url = provider_config['authentication']['api_url']
+        self.path = os.path.join(
+            expanduser(cache_dir or CACHE_DIR),
+            'cloudstack-catalog-{0}.json'.format(
+                hashlib.sha1(str(api_url)).hexdigest()[:12]))
+        self._lock = threading.RLock()
+        self._snapshot = None
+        self._indexes = {}
+        self._refreshing = set()
+
+    def _load(self):
+        with self._lock:
+            if self._snapshot is not None:
+                return self._snapshot
+            self._snapshot = {}
+            if os.path.exists(self.path):
+                try:
+                    with open(self.path, 'r') as f:
+                        self._snapshot = json.load(f).get('catalogs', {})
+                except (IOError, ValueError) as exc:
+                    lgr.debug('ignoring unreadable catalog cache {0}: {1}'
+                              .format(self.path, exc))
+            self._indexes = {}
+            return self._snapshot
+
+    def _save(self):
+        with self._lock:
+            cache_dir = os.path.dirname(self.path)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            tmp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump({'catalogs': self._snapshot}, f)
+            os.rename(tmp_path, self.path)
+
+    def _get_index(self, catalog):
+        with self._lock:
+            snapshot = self._load()
+            if catalog not in snapshot:
+                return None
+            if catalog not in self._indexes:
+                index = dict((field, {}) for field in self.INDEXED_FIELDS)
+                index['zone'] = {}
+                for record in snapshot[catalog]['records']:
+                    for field in self.INDEXED_FIELDS:
+                        index[field].setdefault(record.get(field), record)
+                    if catalog in self.ZONED_CATALOGS:
+                        index['zone'][(record.get('id'),
+                                       record.get('zoneid'))] = record
+                self._indexes[catalog] = index
+            return self._indexes[catalog]
+
+    def is_expired(self, catalog):
+        entry = self._load().get(catalog)
+        return entry is None or time.time() - entry['fetched_at'] > self.ttl
+
+    def find(self, catalog, field, value, zone_id=None):
+        """
+        :param str zone_id: for templates, the zone the record must be of
+        :rtype: 'dict' with the cached record or None when the catalog
+        cannot answer (missing, or a miss which invalidated it).
+        """
+        refreshed = False
+        if self.is_expired(catalog):
+            if self.background_refresh:
+                self._schedule_refresh(catalog)
+            else:
+                refreshed = self._refresh_now(catalog)
+        index = self._get_index(catalog)
+        if index is None:
+            return None
+        if zone_id is not None and catalog in self.ZONED_CATALOGS:
+            record = index['zone'].get((value, zone_id)) \
+                if field == 'id' else None
+        else:
+            record = index[field].get(value)
+        if record is None and not refreshed:
+            lgr.debug('{0} {1} not in catalog cache, invalidating {2}'
+                      .format(field, value, catalog))
+            self.invalidate(catalog)
+        return record
+
+    def invalidate(self, catalog=None):
+        with self._lock:
+            snapshot = self._load()
+            for name in [catalog] if catalog else snapshot.keys():
+                snapshot.pop(name, None)
+                self._indexes.pop(name, None)
+            self._save()
+        if catalog:
+            self._schedule_refresh(catalog)
+
+    def _fetch(self, cloud_driver, catalog):
+        command, response_key, params, fields = self.CATALOGS[catalog]
+        # every page, a record past the first one would miss on every
+        # lookup.
+        records = [dict((f, r[f]) for f in fields if f in r) for r in
+                   _iter_resources(cloud_driver, command, response_key,
+                                   self.connector, **params)]
+        return catalog, {'fetched_at': time.time(), 'records': records}
+
+    def refresh(self, catalogs=None):
+        """
+        re-lists the given catalogs (all by default) concurrently and
+        persists them.
+        """
+        catalogs = list(catalogs or self.CATALOGS.keys())
+        lgr.debug('refreshing catalog cache {0}'.format(catalogs))
+        try:
+            results = self.connector.map(self._fetch, catalogs)
+        finally:
+            with self._lock:
+                self._refreshing.difference_update(catalogs)
+        with self._lock:
+            snapshot = self._load()
+            for catalog, entry in results:
+                snapshot[catalog] = entry
+                self._indexes.pop(catalog, None)
+            self._save()
+
+    def _refresh_now(self, catalog):
+        try:
+            self.refresh([catalog])
+            return True
+        except Exception as exc:
+            lgr.debug('refresh of {0} failed: {1}'.format(catalog, exc))
+            return False
+
+    def _schedule_refresh(self, catalog):
+        if not self.background_refresh:
+            return
+        with self._lock:
+            if catalog in self._refreshing:
+                return
+            self._refreshing.add(catalog)
+
+        def _refresh():
+            try:
+                self.refresh([catalog])
+            except Exception as exc:
+                lgr.debug('background refresh of {0} failed: {1}'
+                          .format(catalog, exc))
+        # a daemon thread, a cli run does not wait for a full listing on
+        # exit. the cache file is replaced atomically, an interrupted
+        # refresh leaves the previous catalog in place.
+        refresh_thread = threading.Thread(target=_refresh,
+                                          name='catalog-refresh-' + catalog)
+        refresh_thread.daemon = True
+        refresh_thread.start()
+
+
+def _get_catalog_cache(connector, provider_config):
+    cache_config = provider_config.get('cloudstack', {}).get(
+        'catalog_cache', {})
+    if not cache_config.get('enabled', True):
+        return None
+    return CloudstackCatalogCache(connector, provider_config)
+
+
+class CloudstackRecord(object):
+    """
+    compact read only copy of a listed cloud object, keeping only the
+    fields the provider uses (missing ones are None). records read like
+    the api dicts they replace: record['id'] and record.get('id').
+    """
+
+    __slots__ = ()
+    FIELDS = ()
+    # fields with few distinct values, whose values are stored only once
+    SHARED_FIELDS = ()
+
+    def __init__(self, data, shared_values=None):
+        """
+        :param dict shared_values: the values of SHARED_FIELDS stored so
+        far, kept by the owner of the records (see CloudstackInventory)
+        """
+        for field in self.FIELDS:
+            value = self._extract(data, field)
+            if value is not None and shared_values is not None and \
+                    field in self.SHARED_FIELDS:
+                value = shared_values.setdefault(value, value)
+            setattr(self, field, value)
+
+    def _extract(self, data, field):
+        return data.get(field)
+
+    def __getitem__(self, field):
+        if field not in self.FIELDS:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def get(self, field, default=None):
+        value = getattr(self, field, None) if field in self.FIELDS else None
+        return default if value is None else value
+
+    def to_dict(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+    def __repr__(self):
+        return '<{0} {1}>'.format(self.__class__.__name__, self.to_dict())
+
+
+class CloudstackVmRecord(CloudstackRecord):
+    __slots__ = FIELDS = ('id', 'name', 'state', 'zoneid', 'templateid',
+                          'networkid', 'ipaddress')
+    SHARED_FIELDS = ('state', 'zoneid', 'templateid', 'networkid')
+
+    def _extract(self, data, field):
+        # the first nic is the one in the management network.
+        if field in ('networkid', 'ipaddress'):
+            nics = data.get('nic') or [{}]
+            return nics[0].get(field)
+        return data.get(field)
+
+
+class CloudstackNetworkRecord(CloudstackRecord):
+    __slots__ = FIELDS = ('id', 'name', 'displaytext', 'networkofferingid',
+                          'zoneid')
+    SHARED_FIELDS = ('networkofferingid', 'zoneid')
+
+
+class CloudstackPublicIpRecord(CloudstackRecord):
+    __slots__ = FIELDS = ('id', 'ipaddress', 'associatednetworkid',
+                          'issourcenat', 'zoneid')
+    SHARED_FIELDS = ('associatednetworkid', 'zoneid')
+
+
+class CloudstackRuleRecord(CloudstackRecord):
+    __slots__ = FIELDS = ('id', 'ipaddressid', 'ipaddress',
+                          'virtualmachineid', 'networkid', 'protocol',
+                          'publicport', 'privateport')
+    SHARED_FIELDS = ('ipaddressid', 'ipaddress', 'networkid', 'protocol',
+                     'publicport', 'privateport')
+
+
+class CloudstackKeypairRecord(CloudstackRecord):
+    __slots__ = FIELDS = ('name', 'fingerprint')
+
+
+class CloudstackRecordIndex(object):
+    """
+    the records of a collection with hash indexes by key and by name.
+    names need not be unique.
+    """
+
+    def __init__(self, key_field, records=()):
+        self.key_field = key_field
+        self.by_key = {}
+        self.by_name = {}
+        for record in records:
+            self.add(record)
+
+    def add(self, record):
+        key = record[self.key_field]
+        self.remove(key)
+        self.by_key[key] = record
+        name = record.get('name')
+        if name is not None and self.key_field != 'name':
+            self.by_name.setdefault(name, []).append(record)
+
+    def remove(self, key):
+        record = self.by_key.pop(key, None)
+        if record is None or self.key_field == 'name':
+            return
+        named = self.by_name.get(record.get('name'), [])
+        named[:] = [r for r in named if r is not record]
+        if not named:
+            self.by_name.pop(record.get('name'), None)
+
+    def values(self):
+        return self.by_key.values()
+
+    def find(self, field, value):
+        if field == self.key_field:
+            record = self.by_key.get(value)
+            return [record] if record is not None else []
+        if field == 'name':
+            return list(self.by_name.get(value, ()))
+        return [r for r in self.by_key.itervalues() if r.get(field) == value]
+
+    def __len__(self):
+        return len(self.by_key)
+
+
+class CloudstackInventory(object):
+    """
+    in memory inventory of the vms, networks, public ips, port forwarding
+    rules and keypairs of an account. one full snapshot is taken, later
+    syncs read listEvents from a start date cursor and re-list only what
+    the events touched. too many or too old events since the last sync
+    fall back to a full snapshot.
+    """
+
+    # collection: (list command, response key, key field, record type)
+    COLLECTIONS = {
+        'vms': ('listVirtualMachines', 'virtualmachine', 'id',
+                CloudstackVmRecord),
+        'networks': ('listNetworks', 'network', 'id',
+                     CloudstackNetworkRecord),
+        'public_ips': ('listPublicIpAddresses', 'publicipaddress', 'id',
+                       CloudstackPublicIpRecord),
+        'rules': ('listPortForwardingRules', 'portforwardingrule', 'id',
+                  CloudstackRuleRecord),
+        'keypairs': ('listSSHKeyPairs', 'sshkeypair', 'name',
+                     CloudstackKeypairRecord),
+    }
+    # event type fragment: collection the event changes
+    EVENT_TYPES = (
+        ('VM.', 'vms'),
+        ('NETWORK.', 'networks'),
+        ('NET.IP', 'public_ips'),
+        ('NET.RULE', 'rules'),
+        ('SSH.KEYPAIR', 'keypairs'),
+    )
+    # events that are not done yet are applied by their completed event
+    PENDING_EVENT_STATES = ('Scheduled', 'Started')
+    # cursor of an account without any event, later events are all newer
+    # than the snapshot.
+    EMPTY_CURSOR = '1970-01-01 00:00:00'
+
+    def __init__(self, connector, provider_config):
+        self.connector = connector
+        inventory_config = provider_config.get('cloudstack', {}).get(
+            'inventory', {})
+        self.max_events = inventory_config.get('max_events', 500)
+        self.max_age = inventory_config.get('max_age', 3600)
+        self._lock = threading.RLock()
+        self._collections = None
+        self._cursor = None
+        self._cursor_events = set()
+        self._synced_at = None
+        # values of the records' shared fields, dropped with the snapshot
+        # they were listed for.
+        self._shared_values = {}
+
+    def _list(self, cloud_driver, collection, **params):
+        command, response_key, _, record_type = self.COLLECTIONS[collection]
+        # records are built page by page, the raw pages are dropped.
+        return [record_type(r, self._shared_values) for r in _iter_resources(
+            cloud_driver, command, response_key, self.connector,
+            listall='true', **params)]
+
+    def _latest_events(self, cloud_driver, **params):
+        # events are listed newest first.
+        return _list_resources(cloud_driver, 'listEvents', 'event',
+                               listall='true', page=1,
+                               pagesize=self.max_events + 1, **params)
+
+    def _set_cursor(self, events):
+        if not events:
+            return
+        # startdate takes the server's local time, which 'created' holds
+        # before its utc offset.
+        newest = events[0]['created'][:19].replace('T', ' ')
+        if newest != self._cursor:
+            self._cursor = newest
+            self._cursor_events = set()
+        self._cursor_events.update(
+            e['id'] for e in events
+            if e['created'][:19].replace('T', ' ') == newest)
+
+    def snapshot(self):
+        """
+        lists every collection from scratch.
+        """
+        cloud_driver = self.connector.get()
+        # taken first, so changes made while listing are applied again
+        # by the next sync.
+        latest = self._latest_events(cloud_driver)[:1]
+        self._shared_values = {}
+
+        def _list_collection(driver, collection):
+            key_field = self.COLLECTIONS[collection][2]
+            return collection, CloudstackRecordIndex(
+                key_field, self._list(driver, collection))
+
+        collections = dict(self.connector.map(_list_collection,
+                                              self.COLLECTIONS.keys()))
+        with self._lock:
+            self._collections = collections
+            self._cursor = self.EMPTY_CURSOR
+            self._cursor_events = set()
+            self._set_cursor(latest)
+            self._synced_at = time.time()
+        lgr.debug('inventory snapshot: {0}'.format(', '.join(
+            '{0} {1}'.format(len(v), k) for k, v in collections.items())))
+
+    def _get_collection(self, event_type):
+        for fragment, collection in self.EVENT_TYPES:
+            if fragment in event_type:
+                return collection
+        return None
+
+    def _refresh(self, cloud_driver, collection, resource_id=None):
+        key_field = self.COLLECTIONS[collection][2]
+        if resource_id is None or key_field != 'id':
+            self._collections[collection] = CloudstackRecordIndex(
+                key_field, self._list(cloud_driver, collection))
+            return
+        records = self._list(cloud_driver, collection, id=resource_id)
+        if records:
+            self._collections[collection].add(records[0])
+        else:
+            self._collections[collection].remove(resource_id)
+
+    def sync(self):
+        """
+        brings the inventory up to date, with a full snapshot the first
+        time and when the events since the last sync cannot be trusted.
+        """
+        with self._lock:
+            if self._collections is None or self._cursor is None or \
+                    time.time() - self._synced_at > self.max_age:
+                return self.snapshot()
+
+            cloud_driver = self.connector.get()
+            events = self._latest_events(cloud_driver,
+                                         startdate=self._cursor)
+            if len(events) > self.max_events:
+                lgr.debug('{0}+ events since {1}, taking a snapshot'
+                          .format(self.max_events, self._cursor))
+                return self.snapshot()
+
+            new_events = [e for e in events
+                          if e['id'] not in self._cursor_events and
+                          e.get('state') not in self.PENDING_EVENT_STATES]
+            # one refresh per changed resource, or per collection when
+            # the event does not name the resource.
+            changes = set()
+            for event in new_events:
+                collection = self._get_collection(event.get('type', ''))
+                if collection is not None:
+                    changes.add((collection, event.get('resourceid')))
+            relisted = set(c for c, r in changes if r is None)
+            changes = set((c, r) for c, r in changes
+                          if r is None or c not in relisted)
+            for collection, resource_id in changes:
+                self._refresh(cloud_driver, collection, resource_id)
+
+            self._set_cursor(events)
+            self._synced_at = time.time()
+            lgr.debug('inventory synced {0} events, {1} refreshes'.format(
+                len(new_events), len(changes)))
+
+    def list(self, collection):
+        """
+        :rtype: 'list' of the records of a collection
+        """
+        with self._lock:
+            return self._collections[collection].values()
+
+    def find(self, collection, field, value):
+        """
+        :rtype: 'list' of the records of a collection whose field equals
+        value. lookups by id and name are hash lookups.
+        """
+        with self._lock:
+            return self._collections[collection].find(field, value)
+
+
+def _lookup_image(cloud_driver, image_id, catalog=None, zone_id=None):
+    record = catalog.find('templates', 'id', image_id, zone_id) \
+        if catalog else None
+    if record is None:
+        params = {'zoneid': zone_id} if zone_id is not None else {}
+        images = _list_resources(cloud_driver, 'listTemplates', 'template',
+                                 templatefilter='executable', id=image_id,
+                                 **params)
+        if not images:
+            raise CloudstackLogicError(
+                'template {0} cannot be found'.format(image_id))
+        record = images[0]
+    return _to_image(cloud_driver, record)
+
+
+def _lookup_size(cloud_driver, size_name, catalog=None):
+    record = catalog.find('service_offerings', 'name', size_name) \
+        if catalog else None
+    if record is None:
+        record = _find_resource(cloud_driver, 'listServiceOfferings',
+                                'serviceoffering', size_name, name=size_name)
+        if record is None:
+            raise CloudstackLogicError(
+                'service offering {0} cannot be found'.format(size_name))
+    return _to_size(cloud_driver, record)
+
+
+def _lookup_zone(cloud_driver, zone_name, catalog=None):
+    record = catalog.find('zones', 'name', zone_name) if catalog else None
+    if record is None:
+        record = _find_resource(cloud_driver, 'listZones', 'zone', zone_name,
+                                name=zone_name)
+        if record is None:
+            raise CloudstackLogicError(
+                'zone {0} cannot be found'.format(zone_name))
+    return _to_location(cloud_driver, record)
+
+
+def _lookup_network_offering(cloud_driver, offering_name, catalog=None):
+    record = catalog.find('network_offerings', 'name', offering_name) \
+        if catalog else None
+    if record is None:
+        record = _find_resource(cloud_driver, 'listNetworkOfferings',
+                                'networkoffering', offering_name,
+                                name=offering_name)
+        if record is None:
+            raise CloudstackLogicError(
+                'network offering {0} cannot be found'.format(offering_name))
+    return _to_network_offering(cloud_driver, record)
+
+
+def _get_resolved_image(cloud_driver, resolved, image_id, catalog=None):
+    image = resolved.get('image')
+    if image is not None and image.id == image_id:
+        return image
+    return _lookup_image(cloud_driver, image_id, catalog)
+
+
+def _get_resolved_size(cloud_driver, resolved, size_name, catalog=None):
+    size = resolved.get('size')
+    if size is not None and size.name == size_name:
+        return size
+    return _lookup_size(cloud_driver, size_name, catalog)
+
+
+def _lookup_management_image(cloud_driver, provider_config, resolved=None,
+                             catalog=None):
+    """
+    :rtype: the template baked for the configured packages when there is
+    a ready one, else the configured image.
+    """
+    resolved = resolved or {}
+    server_config = provider_config['compute']['management_server'][
+        'instance']
+    if server_config.get('use_baked_template', True):
+        packages_key = _get_packages_key(provider_config)
+        registry = _get_template_registry(provider_config)
+        template = registry.get(packages_key)
+        if template is not None:
+            image = resolved.get('image')
+            if image is not None and image.id == template['id']:
+                return image
+            records = _list_resources(cloud_driver, 'listTemplates',
+                                      'template', templatefilter='self',
+                                      id=template['id'])
+            ready = [r for r in records if r.get('isready')]
+            if ready:
+                lgr.debug('using baked template {0}'.format(
+                    template['name']))
+                return _to_image(cloud_driver, ready[0])
+            lgr.warn('baked template {0} is not ready, using image {1}'
+                     .format(template['name'], server_config['image']))
+            # other accounts do not see the template, only a listing by
+            # the account which baked it tells it was deleted.
+            if not records and template.get('api_key') is not None and \
+                    getattr(cloud_driver, 'key', None) == \
+                    template['api_key']:
+                registry.forget(packages_key)
+    return _get_resolved_image(cloud_driver, resolved,
+                               server_config['image'], catalog)
+
+
+class CloudstackResourceResolver(object):
+    """
+    resolves every cloud object referenced by the provider config before
+    anything gets created. each object is looked up with a single filtered
+    api call and all lookups run concurrently.
+
+    the resolved bundle is a dict with the following keys:
+    image, size, zone, network_offering, network, security_group and
+    keypairs (a dict of keypair name to keypair). a value of None means
+    the object does not exist (yet).
+    """
+
+    def __init__(self, connector, provider_config, catalog=None,
+                 inventory=None):
+        self.connector = connector
+        self.provider_config = provider_config
+        self.catalog = catalog
+        self.inventory = inventory
+        self.errors = {}
+
+    def _get_lookups(self):
+        compute_config = self.provider_config['compute']
+        server_config = compute_config['management_server']['instance']
+        zone_type = self.provider_config['cloudstack']['zone_type'].lower()
+        lookups = {}
+
+        lookups['image'] = lambda driver: _lookup_management_image(
+            driver, self.provider_config, catalog=self.catalog)
+        size_name = server_config['size']
+        lookups['size'] = lambda driver: _lookup_size(
+            driver, size_name, self.catalog)
+
+        for keypair_name in self._get_keypair_names():
+            lookups['keypair:' + keypair_name] = \
+                lambda driver, name=keypair_name: self._lookup_keypair(
+                    driver, name)
+
+        if zone_type == 'basic':
+            sg_name = self.provider_config['networking'][
+                'management_security_group']['name']
+            lookups['security_group'] = lambda driver: _find_resource(
+                driver, 'listSecurityGroups', 'securitygroup', sg_name,
+                securitygroupname=sg_name)
+        else:
+            netw_config = self.provider_config['networking'][
+                'management_network']
+            lookups['network'] = lambda driver: self._lookup_network(
+                driver, netw_config['name'])
+            if not netw_config['use_existing']:
+                lookups['zone'] = lambda driver: _lookup_zone(
+                    driver, netw_config['network_zone'], self.catalog)
+                lookups['network_offering'] = \
+                    lambda driver: _lookup_network_offering(
+                        driver, netw_config['network_offering'],
+                        self.catalog)
+        return lookups
+
+    def _get_keypair_names(self):
+        compute_config = self.provider_config['compute']
+        return [compute_config['management_server'][
+                'management_keypair']['name'],
+                compute_config['agent_servers']['agents_keypair']['name']]
+
+    def _lookup_network(self, cloud_driver, network_name):
+        if self.inventory is not None:
+            networks = self.inventory.find('networks', 'name', network_name)
+            network = networks[0] if networks else None
+        else:
+            network = _find_resource(cloud_driver, 'listNetworks',
+                                     'network', network_name,
+                                     keyword=network_name)
+        if network is None:
+            return None
+        return _to_network(cloud_driver, network)
+
+    def _lookup_keypair(self, cloud_driver, keypair_name):
+        if self.inventory is not None:
+            keypairs = self.inventory.find('keypairs', 'name', keypair_name)
+        else:
+            keypairs = _list_resources(cloud_driver, 'listSSHKeyPairs',
+                                       'sshkeypair', name=keypair_name)
+        if not keypairs:
+            return None
+        return _to_keypair(cloud_driver, keypairs[0])
+
+    def _run_lookup(self, cloud_driver, lookup):
+        key, func = lookup
+        try:
+            return key, func(cloud_driver)
+        except Exception as exc:
+            lgr.debug('failed resolving {0}: {1}'.format(key, exc))
+            self.errors[key] = str(exc)
+            return key, None
+
+    def _check_missing(self, resolved):
+        netw_config = self.provider_config['networking'].get(
+            'management_network', {})
+        if 'network' in resolved and resolved['network'] is None \
+                and netw_config.get('use_existing'):
+            self.errors['network'] = 'network {0} cannot be found and ' \
+                                     'use_existing is set to true' \
+                .format(netw_config['name'])
+
+        compute_config = self.provider_config['compute']
+        for keypair_config in (
+                compute_config['management_server']['management_keypair'],
+                compute_config['agent_servers']['agents_keypair']):
+            if resolved['keypairs'].get(keypair_config['name']):
+                continue
+            if 'provided' not in keypair_config and \
+                    'auto_generated' not in keypair_config:
+                self.errors['keypair:' + keypair_config['name']] = \
+                    'keypair {0} cannot be found and neither a provided ' \
+                    'nor an auto_generated key is configured' \
+                    .format(keypair_config['name'])
+
+    def resolve(self):
+        """
+        :rtype: 'dict' with the resolved objects. lookup failures are
+        collected in self.errors.
+        """
+        if self.inventory is not None:
+            self.inventory.sync()
+        lookups = self._get_lookups()
+        lgr.debug('resolving {0} referenced cloud objects'
+                  .format(len(lookups)))
+        results = dict(self.connector.map(self._run_lookup, lookups.items()))
+
+        resolved = {'keypairs': {}}
+        for key, value in results.iteritems():
+            if key.startswith('keypair:'):
+                resolved['keypairs'][key[len('keypair:'):]] = value
+            else:
+                resolved[key] = value
+
+        network = resolved.get('network')
+        if network is not None:
+            # an existing network decides the zone the vm is deployed to.
+            resolved['zone'] = NodeLocation(network.zoneid, network.zoneid,
+                                            'Unknown', network.driver)
+        self._check_missing(resolved)
+        return resolved
+
+
+class CloudstackPlanner(object):
+    """
+    lists the mutating api calls provision() and teardown() would make,
+    based on the current state of the cloud which is only read (through
+    the catalog cache where possible). each call is given an estimated
+    duration taken from the recorded job timings.
+    """
+
+    def __init__(self, connector, provider_config, resolver):
+        self.connector = connector
+        self.provider_config = provider_config
+        self.resolver = resolver
+
+    def _step(self, command, resource, action='create', note=None):
+        estimate = self.connector.job_timings.estimate(command)
+        recorded = estimate is not None
+        if not recorded:
+            estimate = DEFAULT_JOB_ESTIMATES.get(command, 0)
+        return {'command': command,
+                'resource': resource,
+                'action': action,
+                'estimate': estimate if action != 'reuse' else 0,
+                'recorded': recorded,
+                'note': note}
+
+    def _plan_keypairs(self, resolved):
+        steps = []
+        compute_config = self.provider_config['compute']
+        for keypair_config in (
+                compute_config['management_server']['management_keypair'],
+                compute_config['agent_servers']['agents_keypair']):
+            name = keypair_config['name']
+            if resolved['keypairs'].get(name):
+                steps.append(self._step('createSSHKeyPair', name, 'reuse'))
+            elif keypair_config.get('provided', {}).get(
+                    'public_key_filepath'):
+                steps.append(self._step('registerSSHKeyPair', name))
+            else:
+                steps.append(self._step('createSSHKeyPair', name))
+        return steps
+
+    def _plan_node(self, cloud_driver, node_name=None, note=None):
+        if node_name is None:
+            node_name = self.provider_config['compute'][
+                'management_server']['instance']['name']
+        existing = [vm for vm in _list_resources(
+            cloud_driver, 'listVirtualMachines', 'virtualmachine',
+            name=node_name) if vm.get('name') == node_name]
+        if existing:
+            note = 'WARNING: {0} vm(s) named {1} already exist ({2}), ' \
+                   'another one will be created'.format(
+                       len(existing), node_name,
+                       ', '.join(vm['id'] for vm in existing))
+        return self._step('deployVirtualMachine', node_name, note=note)
+
+    def _plan_staging(self, cloud_driver, resolved):
+        server_config = self.provider_config['compute']['management_server']
+        if not server_config.get('template_staging', {}).get(
+                'enabled', True) or resolved.get('image') is None:
+            return []
+        image_id = resolved['image'].id
+        status = CloudstackTemplateStager(
+            self.connector, self.provider_config, image_id).get_status()
+        steps = []
+        for zone_id in _get_staging_zone_ids(
+                cloud_driver, self.provider_config, resolved):
+            resource = '{0} -> {1}'.format(image_id, zone_id)
+            if zone_id in status:
+                steps.append(self._step('copyTemplate', resource, 'reuse',
+                                        status[zone_id]))
+            else:
+                steps.append(self._step('copyTemplate', resource))
+        return steps
+
+    def _plan_claim(self, cloud_driver, warm_pool):
+        # the calls claiming the first pooled vm, none for an empty pool.
+        network = warm_pool._get_network(cloud_driver)
+        for vm in warm_pool.list_members(cloud_driver, network):
+            if warm_pool._get_public_ip(cloud_driver, network,
+                                        vm['id']) is None:
+                continue
+            steps = [self._step('createTags', vm['name'],
+                                note='claims warm pool vm {0}'.format(
+                                    vm['id'])),
+                     self._step('resetSSHKeyForVirtualMachine', vm['name'])]
+            if CloudstackUserdataBuilder(
+                    self.provider_config).build() is not None:
+                steps.append(self._step('updateVirtualMachine', vm['name']))
+            note = None
+            if warm_pool.background_refill:
+                note = 'the warm pool is refilled in the background'
+            steps.append(self._step('startVirtualMachine', vm['name'],
+                                    note=note))
+            return steps
+        return []
+
+    def _plan_cluster(self, cloud_driver, cluster):
+        steps = []
+        if _find_resource(cloud_driver, 'listAffinityGroups',
+                          'affinitygroup', cluster.group, name=cluster.group):
+            steps.append(self._step('createAffinityGroup', cluster.group,
+                                    'reuse'))
+        else:
+            steps.append(self._step('createAffinityGroup', cluster.group))
+        for index in range(1, cluster.size + 1):
+            steps.append(self._plan_node(cloud_driver,
+                                         cluster._get_node_name(index)))
+        return steps
+
+    def plan_provision(self):
+        """
+        :rtype: 'dict' with the planned steps, resolve errors and the
+        estimated total duration in seconds.
+        """
+        cloud_driver = self.connector.create()
+        resolved = self.resolver.resolve()
+        zone_type = self.provider_config['cloudstack']['zone_type'].lower()
+        networking_config = self.provider_config['networking']
+        steps = []
+
+        if zone_type == 'basic':
+            sg_config = networking_config['management_security_group']
+            if resolved.get('security_group'):
+                steps.append(self._step('createSecurityGroup',
+                                        sg_config['name'], 'reuse'))
+            else:
+                steps.append(self._step('createSecurityGroup',
+                                        sg_config['name']))
+                for port in sg_config['ports']:
+                    steps.append(self._step(
+                        'authorizeSecurityGroupIngress',
+                        '{0}:{1}'.format(sg_config['name'], port)))
+            steps.extend(self._plan_keypairs(resolved))
+            steps.extend(self._plan_staging(cloud_driver, resolved))
+            steps.append(self._plan_node(cloud_driver))
+        else:
+            netw_config = networking_config['management_network']
+            if resolved.get('network'):
+                steps.append(self._step('createNetwork', netw_config['name'],
+                                        'reuse'))
+            else:
+                steps.append(self._step('createNetwork', netw_config['name']))
+            steps.extend(self._plan_keypairs(resolved))
+
+            data_volumes = CloudstackDataVolumes(self.connector,
+                                                 self.provider_config)
+            volume_names = ['{0}-data-{1}'.format(data_volumes.node_name,
+                                                  index)
+                            for index in range(1, len(data_volumes.specs) + 1)]
+            # created while the vm deploys.
+            steps.extend(self._step('createVolume', name)
+                         for name in volume_names)
+
+            cluster = CloudstackManagerCluster(
+                self.connector, self.provider_config, resolved)
+            warm_pool = CloudstackWarmPool(
+                self.connector, self.provider_config, resolved)
+            claim_steps = []
+            if warm_pool.is_enabled() and not cluster.is_enabled():
+                claim_steps = self._plan_claim(cloud_driver, warm_pool)
+            if claim_steps:
+                steps.extend(claim_steps)
+            else:
+                steps.extend(self._plan_staging(cloud_driver, resolved))
+                if cluster.is_enabled():
+                    steps.extend(self._plan_cluster(cloud_driver, cluster))
+                else:
+                    steps.append(self._plan_node(
+                        cloud_driver, note='the warm pool is empty'
+                        if warm_pool.is_enabled() else None))
+
+            steps.extend(self._step('attachVolume', name)
+                         for name in volume_names)
+            if not netw_config['use_existing']:
+                for port in netw_config['ports']:
+                    if cluster.is_enabled() and \
+                            port in cluster.balanced_ports:
+                        continue
+                    steps.append(self._step(
+                        'createPortForwardingRule',
+                        '{0}/{1}'.format(port, netw_config.get('protocol'))))
+            if cluster.is_enabled():
+                for port in cluster.balanced_ports:
+                    rule_name = '{0}-{1}'.format(cluster.node_name, port)
+                    steps.append(self._step('createLoadBalancerRule',
+                                            rule_name))
+                    steps.append(self._step('assignToLoadBalancerRule',
+                                            rule_name))
+
+        return self._report('provision', steps, self.resolver.errors)
+
+    def _plan_delete(self, command, resource, found, kind):
+        if found:
+            return self._step(command, resource, 'delete')
+        return self._step(command, resource, 'skip',
+                          '{0} not found'.format(kind))
+
+    def plan_teardown(self, provider_context):
+        """
+        :rtype: 'dict' with the planned steps and the estimated total
+        duration in seconds.
+        """
+        cloud_driver = self.connector.create()
+        provider_config = _name_context_resources(
+            self.provider_config, _get_provisioned_resources(
+                self.provider_config, provider_context))
+        zone_type = provider_config['cloudstack']['zone_type'].lower()
+        resources = provider_context.get('resources', {})
+        steps = []
+
+        # the cluster members and their load balancer rules go first.
+        for rule_id in resources.get('load_balancer_rules', []):
+            steps.append(self._plan_delete(
+                'deleteLoadBalancerRule', rule_id, _list_resources(
+                    cloud_driver, 'listLoadBalancerRules',
+                    'loadbalancerrule', id=rule_id),
+                'load balancer rule'))
+        ip_id = resources.get('public_ip')
+        if ip_id:
+            steps.append(self._plan_delete(
+                'disassociateIpAddress', ip_id, _list_resources(
+                    cloud_driver, 'listPublicIpAddresses', 'publicipaddress',
+                    id=ip_id),
+                'public ip'))
+        for node_id in provider_context.get('mgmt_node_ids', [])[1:] + \
+                [provider_context['mgmt_node_id']]:
+            steps.append(self._plan_delete(
+                'destroyVirtualMachine', node_id, _list_resources(
+                    cloud_driver, 'listVirtualMachines', 'virtualmachine',
+                    id=node_id),
+                'vm'))
+
+        compute_config = provider_config['compute']
+        for name in (compute_config['management_server'][
+                'management_keypair']['name'],
+                compute_config['agent_servers']['agents_keypair']['name']):
+            steps.append(self._plan_delete(
+                'deleteSSHKeyPair', name, _list_resources(
+                    cloud_driver, 'listSSHKeyPairs', 'sshkeypair',
+                    name=name),
+                'keypair'))
+
+        if zone_type == 'basic':
+            sg_name = provider_config['networking'][
+                'management_security_group']['name']
+            steps.append(self._step('deleteSecurityGroup', sg_name,
+                                    'delete'))
+        else:
+            netw_config = provider_config['networking'][
+                'management_network']
+            if netw_config['use_existing']:
+                steps.append(self._step('deleteNetwork', netw_config['name'],
+                                        'skip', 'existing network is kept'))
+            else:
+                steps.append(self._plan_delete(
+                    'deleteNetwork', netw_config['name'], _find_resource(
+                        cloud_driver, 'listNetworks', 'network',
+                        netw_config['name'], keyword=netw_config['name']),
+                    'network'))
+
+        group = resources.get('affinity_group')
+        if group:
+            steps.append(self._plan_delete(
+                'deleteAffinityGroup', group, _find_resource(
+                    cloud_driver, 'listAffinityGroups', 'affinitygroup',
+                    group, name=group),
+                'affinity group'))
+        for volume_id in resources.get('volumes', []):
+            steps.append(self._plan_delete(
+                'deleteVolume', volume_id, _list_resources(
+                    cloud_driver, 'listVolumes', 'volume', id=volume_id),
+                'volume'))
+
+        return self._report('teardown', steps, {})
+
+    def _report(self, action, steps, errors):
+        total = sum(step['estimate'] for step in steps
+                    if step['action'] in ('create', 'delete'))
+        lgr.info('{0} plan (account {1}):'.format(
+            action, self.provider_config['authentication']['api_key']))
+        for step in steps:
+            lgr.info('  {0:<7} {1:<30} {2:<40} {3}'.format(
+                step['action'], step['command'], step['resource'],
+                '~{0:.0f}s{1}'.format(step['estimate'],
+                                      '' if step['recorded'] else ' (default)')
+                if step['action'] in ('create', 'delete') else ''))
+            if step['note']:
+                lgr.info('          {0}'.format(step['note']))
+        for key, error in sorted(errors.items()):
+            lgr.error('  unresolved {0}: {1}'.format(key, error))
+        lgr.info('estimated duration: {0:.0f}s'.format(total))
+        return {'action': action,
+                'api_key': self.provider_config['authentication']['api_key'],
+                'steps': steps,
+                'errors': dict(errors),
+                'estimated_duration': total}
+
+
+class CloudstackOrphanSweeper(object):
+    """
+    finds and deletes every resource whose name starts with
+    cloudify.resources_prefix, including leftovers of failed runs which the
+    name based teardown never sees.
+
+    every resource type is listed once. public ips and port forwarding
+    rules have no name and are matched through the vm or network they
+    belong to. deletes run in dependency order, each type in parallel.
+    """
+
+    # resource type: (list command, response key)
+    LISTINGS = {
+        'port_forwarding_rules': ('listPortForwardingRules',
+                                  'portforwardingrule'),
+        'vms': ('listVirtualMachines', 'virtualmachine'),
+        'public_ips': ('listPublicIpAddresses', 'publicipaddress'),
+        'networks': ('listNetworks', 'network'),
+        'security_groups': ('listSecurityGroups', 'securitygroup'),
+        'keypairs': ('listSSHKeyPairs', 'sshkeypair'),
+        'volumes': ('listVolumes', 'volume'),
+        'load_balancer_rules': ('listLoadBalancerRules', 'loadbalancerrule'),
+        'affinity_groups': ('listAffinityGroups', 'affinitygroup'),
+    }
+    # affinity groups go once their vms are gone, the ips once their
+    # rules are.
+    DELETE_ORDER = ('port_forwarding_rules', 'load_balancer_rules', 'vms',
+                    'volumes', 'affinity_groups', 'public_ips', 'networks',
+                    'security_groups', 'keypairs')
+
+    def __init__(self, connector, provider_config, prefix=None):
+        self.connector = connector
+        # the prefix _get_resource_name names the resources with.
+        self.prefix = prefix or _get_resources_prefix(provider_config)
+        if not self.prefix:
+            raise CloudstackLogicError(
+                'cloudify.resources_prefix must be set to sweep orphans')
+
+    def _list(self, cloud_driver, resource_type):
+        command, response_key = self.LISTINGS[resource_type]
+        return resource_type, list(_iter_resources(
+            cloud_driver, command, response_key, self.connector,
+            listall='true'))
+
+    def build_index(self):
+        """
+        :rtype: 'dict' of resource type to the list of matching records
+        """
+        listings = dict(self.connector.map(self._list, self.LISTINGS.keys()))
+        prefixed = lambda records: [r for r in records if
+                                    (r.get('name') or '').startswith(
+                                        self.prefix)]
+        index = {}
+        for resource_type in ('vms', 'networks', 'security_groups',
+                              'keypairs', 'volumes', 'affinity_groups'):
+            index[resource_type] = prefixed(listings[resource_type])
+        vm_ids = set(vm['id'] for vm in index['vms'])
+        network_ids = set(net['id'] for net in index['networks'])
+
+        # source nat addresses go away with their network.
+        index['public_ips'] = [
+            ip for ip in listings['public_ips']
+            if not ip.get('issourcenat') and
+            (ip.get('virtualmachineid') in vm_ids or
+             ip.get('associatednetworkid') in network_ids)]
+        ip_ids = set(ip['id'] for ip in listings['public_ips']
+                     if ip.get('associatednetworkid') in network_ids)
+        index['port_forwarding_rules'] = [
+            rule for rule in listings['port_forwarding_rules']
+            if rule.get('virtualmachineid') in vm_ids or
+            rule.get('ipaddressid') in ip_ids]
+        index['load_balancer_rules'] = [
+            rule for rule in listings['load_balancer_rules']
+            if (rule.get('name') or '').startswith(self.prefix) or
+            rule.get('publicipid') in ip_ids]
+        return index
+
+    def _delete(self, cloud_driver, item):
+        resource_type, record = item
+        try:
+            if resource_type == 'port_forwarding_rules':
+                cloud_driver._async_request('deletePortForwardingRule',
+                                            params={'id': record['id']})
+            elif resource_type == 'vms':
+                cloud_driver._async_request('destroyVirtualMachine',
+                                            params={'id': record['id']})
+            elif resource_type == 'public_ips':
+                cloud_driver._async_request('disassociateIpAddress',
+                                            params={'id': record['id']})
+            elif resource_type == 'networks':
+                cloud_driver._async_request('deleteNetwork',
+                                            params={'id': record['id']})
+            elif resource_type == 'security_groups':
+                cloud_driver._sync_request('deleteSecurityGroup',
+                                           params={'id': record['id']})
+            elif resource_type == 'keypairs':
+                cloud_driver._sync_request('deleteSSHKeyPair',
+                                           params={'name': record['name']})
+            elif resource_type == 'volumes':
+                _delete_volume(cloud_driver, record['id'])
+            elif resource_type == 'load_balancer_rules':
+                cloud_driver._async_request('deleteLoadBalancerRule',
+                                            params={'id': record['id']})
+            elif resource_type == 'affinity_groups':
+                cloud_driver._async_request('deleteAffinityGroup',
+                                            params={'id': record['id']})
+            return None
+        except Exception as exc:
+            lgr.warn('failed deleting {0} {1}: {2}'.format(
+                resource_type, _describe_record(record), exc))
+            return (resource_type, record.get('id') or record.get('name'),
+                    str(exc))
+
+    def sweep(self, dry_run=True):
+        """
+        :param bool dry_run: only report what would be deleted.
+        :rtype: 'dict' with the matched resources per type and the
+        failed deletes.
+        """
+        index = self.build_index()
+        lgr.info('{0} orphans matching prefix {1}:'.format(
+            'found' if dry_run else 'deleting', self.prefix))
+        for resource_type in self.DELETE_ORDER:
+            for record in index[resource_type]:
+                lgr.info('  {0:<22} {1}'.format(resource_type,
+                                                 _describe_record(record)))
+
+        failures = []
+        if not dry_run:
+            for resource_type in self.DELETE_ORDER:
+                results = self.connector.map(
+                    self._delete,
+                    [(resource_type, r) for r in index[resource_type]])
+                failures.extend(r for r in results if r)
+        return {'prefix': self.prefix,
+                'dry_run': dry_run,
+                'resources': index,
+                'failures': failures}
+
+
+def _describe_record(record):
+    if record.get('name'):
+        return '{0} ({1})'.format(record['name'], record.get('id', '-'))
+    if record.get('ipaddress'):
+        return '{0} ({1})'.format(record['ipaddress'], record['id'])
+    return record.get('id', '-')
 
 
 class CloudstackKeypairCreator(object):
-    def __init__(self, cloud_driver, provider_config):
+    def __init__(self, cloud_driver, provider_config, resolved=None):
         self.cloud_driver = cloud_driver
         self.provider_config = provider_config
+        self.resolved = resolved or {}
 
     def _get_keypair(self, keypair_name):
         keypairs = [kp for kp in self.cloud_driver.list_key_pairs()
@@ -641,7 +5275,13 @@ class CloudstackKeypairCreator(object):
             public_key_filepath = keypair_config.get('provided', {}).get(
                 'public_key_filepath', None)
 
-        if self._get_keypair(keypair_name):
+        resolved_keypairs = self.resolved.get('keypairs', {})
+        if keypair_name in resolved_keypairs:
+            existing_keypair = resolved_keypairs[keypair_name]
+        else:
+            existing_keypair = self._get_keypair(keypair_name)
+
+        if existing_keypair:
             lgr.info('using existing keypair {0}'.format(keypair_name))
             return
         else:
@@ -805,9 +5445,10 @@ class CloudstackSecurityGroupCreator(object):
 
 
 class CloudstackNetworkCreator(object):
-    def __init__(self, cloud_driver, provider_config):
+    def __init__(self, cloud_driver, provider_config, resolved=None):
         self.cloud_driver = cloud_driver
         self.provider_config = provider_config
+        self.resolved = resolved or {}
 
     def add_port_fwd_rule(self, ip_address, privateport,
                   publicport, protocol, node=None):
@@ -823,13 +5464,13 @@ class CloudstackNetworkCreator(object):
                                             openfirewall=False)
 
     def get_network(self, network_name):
-        networks = [netw for netw in self.cloud_driver
-            .ex_list_networks() if netw.name == network_name]
-
-        if networks.__len__() == 0:
+        network = _find_resource(self.cloud_driver, 'listNetworks',
+                                 'network', network_name,
+                                 keyword=network_name)
+        if network is None:
             return None
         #TODO: refactor - needs to return network[0] first item
-        return networks
+        return [_to_network(self.cloud_driver, network)]
 
     def get_networks(self):
         networks = self.cloud_driver.ex_list_networks()
@@ -874,26 +5515,31 @@ class CloudstackNetworkCreator(object):
         mgmt_net = self.provider_config['networking'][
             'management_network']['name']
 
-        nets = self.get_networks()
-
-        for net in nets:
-
-            if net.name == mgmt_net:
-                lgr.debug('Management Network {0} found!'.format(net.name))
-                break
-        else:
-            raise RuntimeError('Management network {0} not found'.
+        net = self.resolved.get('network')
+        if net is None:
+            nets = self.get_network(mgmt_net)
+            if not nets:
+                raise RuntimeError('Management network {0} not found'.
                                    format(mgmt_net))
+            net = nets[0]
+        lgr.debug('Management Network {0} found!'.format(net.name))
 
-        publicips = self.cloud_driver.ex_list_public_ips()
+        publicips = _list_resources(self.cloud_driver,
+                                    'listPublicIpAddresses',
+                                    'publicipaddress',
+                                    associatednetworkid=net.id)
 
         for public_ip in publicips:
 
-            if public_ip.associated_network_id == net.id:
+            if public_ip['associatednetworkid'] == net.id:
                 lgr.debug('Found acquired Public IP: {0} with ID {1} '
                           'Associated with network id {2}'.
-                          format(public_ip.address, public_ip.id, net.id))
-                return public_ip
+                          format(public_ip['ipaddress'], public_ip['id'],
+                                 net.id))
+                return CloudStackAddress(public_ip['id'],
+                                         public_ip['ipaddress'],
+                                         self.cloud_driver,
+                                         public_ip['associatednetworkid'])
         else:
             raise RuntimeError('No matching mgmt public ip found')
 
@@ -926,7 +5572,13 @@ class CloudstackNetworkCreator(object):
         # agent_netw_name = agent_netw_config['name']
         # agent_use_existing = agent_netw_config['use_existing']
 
-        if not self._is_netw_exists(management_netw_name):
+        if 'network' in self.resolved:
+            network = self.resolved['network']
+        else:
+            network = self.get_network(management_netw_name)
+            network = network[0] if network else None
+
+        if network is None:
             if not use_existing == False:
                 raise RuntimeError('No existing network and use_existing '
                                    'set to true')
@@ -941,33 +5593,39 @@ class CloudstackNetworkCreator(object):
                 net_offering = management_netw_config['network_offering']
                 domain = management_netw_config['network_domain']
                 zone = management_netw_config['network_zone']
-                locations = self.cloud_driver.list_locations()
-                offerings = self.cloud_driver.ex_list_network_offerings()
 
-                for location in locations:
-                    if zone == location.name:
-                        break
+                location = self.resolved.get('zone')
+                if location is None:
+                    for location in self.cloud_driver.list_locations():
+                        if zone == location.name:
+                            break
                     else:
                         raise RuntimeError('Specified location cannot be '
                                            'found!')
 
-                for offering in offerings:
-                    if net_offering == offering.name:
-                        break
+                offering = self.resolved.get('network_offering')
+                if offering is None:
+                    for offering in \
+                            self.cloud_driver.ex_list_network_offerings():
+                        if net_offering == offering.name:
+                            break
                     else:
                         raise RuntimeError('Specified network offering '
                                            'cannot be found!')
 
-                self.cloud_driver.ex_create_network(management_netw_name,
-                                                    management_netw_name,
-                                                    offering,
-                                                    location,
-                                                    gateway,
-                                                    netmask,
-                                                    domain)
+                network = self.cloud_driver.ex_create_network(
+                    management_netw_name,
+                    management_netw_name,
+                    offering,
+                    location,
+                    gateway,
+                    netmask,
+                    domain)
+                self.resolved['network'] = network
         else:
             lgr.info('using existing management network {0}'.format(
                 management_netw_name))
+        return network
 """
         lgr.debug('reading agent network configuration.')
         agent_netw_config = self.provider_config['networking'][
@@ -1020,22 +5678,115 @@ class CloudstackNetworkCreator(object):
 """
 
 
+class CloudstackUserdataBuilder(object):
+    """
+    builds cloud-init userdata which writes the agents' private key (and
+    any configured small files) on the manager at first boot, replacing
+    the ssh upload done by copy_files_to_manager.
+
+    file contents are gzipped and base64 encoded for cloud-init, and the
+    api base64 encodes the whole userdata once more. the driver sends it
+    in a POST body, where cloudstack takes up to 32KB. when the encoded
+    userdata is larger than userdata.max_size None is returned, so the
+    caller falls back to uploading over ssh.
+    """
+
+    def __init__(self, provider_config):
+        self.provider_config = provider_config
+        mgmt_server_config = provider_config['compute']['management_server']
+        self.userdata_config = mgmt_server_config.get('userdata', {})
+        self.user = mgmt_server_config.get('user_on_management')
+        self.userhome = mgmt_server_config.get('userhome_on_management')
+
+    def get_files(self):
+        """
+        :rtype: 'list' of (local path, path on the manager, permissions)
+        """
+        agents_keypair = self.provider_config['compute']['agent_servers'][
+            'agents_keypair']
+        agents_key_path = expanduser(
+            agents_keypair['provided']['private_key_filepath']
+            if 'provided' in agents_keypair else
+            agents_keypair['auto_generated']['private_key_target_path'])
+        files = [(agents_key_path,
+                  '{0}/.ssh/{1}'.format(self.userhome,
+                                        os.path.basename(agents_key_path)),
+                  '0600')]
+        for file_config in self.userdata_config.get('files', []):
+            files.append((expanduser(file_config['source']),
+                          file_config['destination'],
+                          str(file_config.get('permissions', '0644'))))
+        return files
+
+    def _encode(self, local_path):
+        compressed = StringIO()
+        with open(local_path, 'rb') as f, \
+                gzip.GzipFile(fileobj=compressed, mode='wb') as gz:
+            gz.write(f.read())
+        return base64.b64encode(compressed.getvalue())
+
+    def build(self):
+        """
+        :rtype: 'str' with the userdata or None if delivery by userdata
+        is disabled or the files do not fit.
+        """
+        if not self.userdata_config.get('enabled', False):
+            return None
+
+        write_files = []
+        commands = []
+        for local_path, remote_path, permissions in self.get_files():
+            write_files.append({'path': remote_path,
+                                'permissions': permissions,
+                                'encoding': 'gz+b64',
+                                'content': self._encode(local_path)})
+            # files are written before the default user exists, so
+            # ownership is fixed up once the commands run.
+            commands.append('chown {0}: {1} $(dirname {1})'.format(
+                self.user, remote_path))
+
+        userdata = '#cloud-config\n' + yaml.safe_dump(
+            {'write_files': write_files, 'runcmd': commands},
+            default_flow_style=False)
+
+        max_size = self.userdata_config.get('max_size',
+                                            DEFAULT_USERDATA_MAX_SIZE)
+        encoded_size = len(base64.b64encode(userdata))
+        if encoded_size > max_size:
+            lgr.warn('userdata of {0} bytes exceeds the {1} bytes cloudstack '
+                     'accepts, files will be uploaded over ssh'
+                     .format(encoded_size, max_size))
+            return None
+        lgr.debug('delivering {0} files by userdata ({1} bytes)'
+                  .format(len(write_files), encoded_size))
+        return userdata
+
+
 class CloudstackSecurityGroupComputeCreator(object):
     def __init__(self, cloud_driver,
                  provider_config,
                  keypair_name=None,
                  security_group_name=None,
-                 node_name=None):
+                 node_name=None,
+                 resolved=None):
         self.cloud_driver = cloud_driver
         self.provider_config = provider_config
         self.keypair_name = keypair_name
         self.security_group_names = [security_group_name, ]
         self.node_name = node_name
+        self.resolved = resolved or {}
+        self.userdata_delivered = False
 
     def delete_node(self, node_ip):
         lgr.debug('getting node for id {0}'.format(node_ip))
-        node = [node for node in self.cloud_driver.list_nodes() if
-                node_ip in node.public_ips][0]
+        for vm in _iter_resources(self.cloud_driver, 'listVirtualMachines',
+                                  'virtualmachine'):
+            if node_ip in [nic.get('ipaddress') for nic in vm['nic']]:
+                break
+        else:
+            raise CloudstackLogicError(
+                'no vm with ip {0} found'.format(node_ip))
+        node = self.cloud_driver._to_node(vm)
 
         lgr.debug('destroying node {0}'.format(node))
         self.cloud_driver.destroy_node(node)
@@ -1051,12 +5802,10 @@ class CloudstackSecurityGroupComputeCreator(object):
         size_id = server_config.get('size')
 
         lgr.debug('getting node image for ID {0}'.format(image_id))
-
-        image = [image for image in self.cloud_driver.list_images() if
-                 image_id == image.id][0]
+        image = _lookup_management_image(self.cloud_driver,
+                                         self.provider_config, self.resolved)
         lgr.debug('getting node size for ID {0}'.format(size_id))
-        size = [size for size in self.cloud_driver.list_sizes() if
-                size.name == size_id][0]
+        size = _get_resolved_size(self.cloud_driver, self.resolved, size_id)
 
         if self.node_name is None:
             self.node_name = server_config.get('name', None)
@@ -1067,12 +5816,16 @@ class CloudstackSecurityGroupComputeCreator(object):
                 .get('management_security_group', {})
             self.security_group_names = [network_config['name'], ]
 
+        userdata = CloudstackUserdataBuilder(self.provider_config).build()
+        self.userdata_delivered = userdata is not None
+
         lgr.info(
             'starting a new virtual instance named {0}'.format(self.node_name))
         result = self.cloud_driver.create_node(
             name=self.node_name,
             ex_keyname=self.keypair_name,
             ex_security_groups=self.security_group_names,
+            ex_userdata=userdata,
             image=image,
             size=size)
 
@@ -1086,7 +5839,8 @@ class CloudstackNetworkComputeCreator(object):
                  network_name=None,
                  node_name=None,
                  zone=None,
-                 ip_address=None):
+                 ip_address=None,
+                 resolved=None):
         self.cloud_driver = cloud_driver
         self.provider_config = provider_config
         self.keypair_name = keypair_name
@@ -1094,6 +5848,8 @@ class CloudstackNetworkComputeCreator(object):
         self.node_name = node_name
         self.zone = zone
         self.ip_address = ip_address
+        self.resolved = resolved or {}
+        self.userdata_delivered = False
 
     def get_zone_from_network(self, network_name):
         lgr.debug('getting zone info of network: {0}'.format(network_name))
@@ -1114,8 +5870,12 @@ class CloudstackNetworkComputeCreator(object):
     def delete_node(self, node_id):
         lgr.debug('getting node for ID {0}'.format(node_id))
 
-        node = [node for node in self.cloud_driver.list_nodes() if
-                node_id == node.id][0]
+        vm = next(_iter_resources(self.cloud_driver, 'listVirtualMachines',
+                                  'virtualmachine', id=node_id), None)
+        if vm is None:
+            raise CloudstackLogicError(
+                'vm {0} cannot be found'.format(node_id))
+        node = self.cloud_driver._to_node(vm)
 
         lgr.debug('destroying node {0}'.format(node))
         self.cloud_driver.destroy_node(node)
@@ -1131,11 +5891,10 @@ class CloudstackNetworkComputeCreator(object):
         size_id = server_config.get('size')
 
         lgr.debug('getting node image for ID {0}'.format(image_id))
-        image = [image for image in self.cloud_driver.list_images() if
-                 image_id == image.id][0]
+        image = _lookup_management_image(self.cloud_driver,
+                                         self.provider_config, self.resolved)
         lgr.debug('getting node size for ID {0}'.format(size_id))
-        size = [size for size in self.cloud_driver.list_sizes() if
-                size.name == size_id][0]
+        size = _get_resolved_size(self.cloud_driver, self.resolved, size_id)
 
         if self.node_name is None:
             self.node_name = server_config.get('name', None)
@@ -1154,6 +5913,9 @@ class CloudstackNetworkComputeCreator(object):
         if self.ip_address is None:
             self.ip_address = server_config['private_ip']
 
+        userdata = CloudstackUserdataBuilder(self.provider_config).build()
+        self.userdata_delivered = userdata is not None
+
         lgr.info(
             'starting a new virtual instance named {0} on network {1}'
             ' in zone {2}'
@@ -1162,6 +5924,7 @@ class CloudstackNetworkComputeCreator(object):
             name=self.node_name,
             ex_keyname=self.keypair_name,
             networks=self.network_names,
+            ex_userdata=userdata,
             image=image,
             size=size,
             location=self.zone,
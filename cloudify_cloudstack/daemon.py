@@ -0,0 +1,187 @@
+########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+
+"""
+local daemon keeping the connectors (and their drivers and connections),
+catalog caches and inventories of every api endpoint warm between
+provider calls. ProviderManager calls go through it when
+cloudstack.daemon.enabled is set and the daemon is running:
+
+    python -m cloudify_cloudstack.daemon [socket path]
+"""
+
+# the package and its main module share their name.
+from __future__ import absolute_import
+
+import collections
+import json
+import os
+import sys
+import threading
+import SocketServer
+from multiprocessing.pool import ThreadPool
+from os.path import expanduser
+
+from cloudify_cloudstack.cloudify_cloudstack import lgr
+from cloudify_cloudstack.cloudify_cloudstack import DEFAULT_CONCURRENCY
+from cloudify_cloudstack.cloudify_cloudstack import DEFAULT_DAEMON_SOCKET
+from cloudify_cloudstack.cloudify_cloudstack import ProviderManager
+from cloudify_cloudstack.cloudify_cloudstack import CloudstackConnector
+from cloudify_cloudstack.cloudify_cloudstack import CloudstackInventory
+from cloudify_cloudstack.cloudify_cloudstack import _get_api_urls
+from cloudify_cloudstack.cloudify_cloudstack import _get_catalog_cache
+
+# ProviderManager methods the daemon runs
+DAEMON_METHODS = ('_provision_resources', '_plan_provision',
+                  '_teardown_resources', '_plan_teardown', 'validate',
+                  'teardown_many', 'sweep', 'bake_template',
+                  'fill_warm_pool', 'preflight', 'place_agents',
+                  'stage_template')
+# the ones making no more than a few reads, which never wait behind
+# provisionings and teardowns
+QUICK_METHODS = ('_plan_provision', '_plan_teardown', 'validate',
+                 'preflight', 'place_agents')
+# client sessions whose managers are kept
+DAEMON_SESSIONS = 64
+
+
+class CloudstackDaemonHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+            workers = self.server.quick_workers \
+                if request.get('method') in QUICK_METHODS \
+                else self.server.workers
+            response = workers.apply(self.server.run, (request,))
+        except Exception as exc:
+            lgr.warn('daemon call failed: {0}'.format(exc))
+            response = {'error': str(exc),
+                        'error_type': exc.__class__.__name__}
+        self.wfile.write(json.dumps(response) + '\n')
+
+
+class CloudstackDaemon(SocketServer.ThreadingMixIn,
+                       SocketServer.UnixStreamServer):
+    """
+    serves ProviderManager calls on a unix socket. calls run on fixed
+    sets of worker threads, so the per thread drivers of the endpoint
+    connectors are reused from call to call. quick calls have workers of
+    their own.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path=None, workers=DEFAULT_CONCURRENCY):
+        self.socket_path = expanduser(socket_path or DEFAULT_DAEMON_SOCKET)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        socket_dir = os.path.dirname(self.socket_path)
+        if not os.path.isdir(socket_dir):
+            os.makedirs(socket_dir, 0700)
+        # the socket carries api credentials, it is created 0600 rather
+        # than changed once others could have connected.
+        umask = os.umask(0177)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, self.socket_path,
+                                                   CloudstackDaemonHandler)
+        finally:
+            os.umask(umask)
+        self.workers = ThreadPool(workers)
+        self.quick_workers = ThreadPool(workers)
+        self._endpoints = {}
+        self._sessions = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_endpoint(self, provider_config):
+        """
+        :rtype: 'dict' with the connector, catalog cache and inventory
+        kept for the api endpoint and key of provider_config.
+        """
+        auth = provider_config['authentication']
+        key = (tuple(_get_api_urls(provider_config)), auth['api_key'])
+        with self._lock:
+            endpoint = self._endpoints.get(key)
+            if endpoint is None:
+                lgr.info('warming up endpoint {0}'.format(auth['api_url']))
+                connector = CloudstackConnector(provider_config)
+                endpoint = {
+                    'connector': connector,
+                    'catalog': _get_catalog_cache(connector,
+                                                  provider_config),
+                    'inventory': CloudstackInventory(connector,
+                                                     provider_config)}
+                self._endpoints[key] = endpoint
+            return endpoint
+
+    def get_manager(self, session, provider_config):
+        """
+        :rtype: the 'ProviderManager' kept for the client session, so the
+        state of earlier calls (resolved resources, inventory) is reused.
+        """
+        with self._lock:
+            provider_manager = self._sessions.pop(session, None)
+            if provider_manager is None:
+                provider_manager = ProviderManager(provider_config)
+                # picks the warm endpoint of the account it ends up using.
+                provider_manager.daemon = self
+            else:
+                # the client may have changed it since.
+                provider_manager.provider_config = provider_config
+            if session is not None:
+                self._sessions[session] = provider_manager
+                while len(self._sessions) > DAEMON_SESSIONS:
+                    self._sessions.popitem(last=False)
+            return provider_manager
+
+    def run(self, request):
+        """
+        :rtype: 'dict' with the result of the call and the provider config
+        the manager ended with, which the client keeps.
+        """
+        method = request['method']
+        if method not in DAEMON_METHODS:
+            raise ValueError('unknown method {0}'.format(method))
+        provider_manager = self.get_manager(request.get('session'),
+                                            request['config'])
+        result = getattr(provider_manager, method)(*request['args'],
+                                                   **request['kwargs'])
+        return {'result': result,
+                'config': provider_manager.provider_config}
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    daemon = CloudstackDaemon(argv[0] if argv else None)
+    lgr.info('cloudstack provider daemon listening on {0}'.format(
+        daemon.socket_path))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server_close()
+
+
+if __name__ == '__main__':
+    main()
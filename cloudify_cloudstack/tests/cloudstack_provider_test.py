@@ -18,13 +18,259 @@ __author__ = 'adaml'
 
 import unittest
 import os
+import shutil
+import tempfile
+import threading
+import BaseHTTPServer
+import base64
+import stat
+import time
+import socket
+import hashlib
+import gzip
+import yaml
+import paramiko
+from copy import deepcopy
+from StringIO import StringIO
 from cloudify_cloudstack.cloudify_cloudstack import _read_config
 from cloudify_cloudstack.cloudify_cloudstack import CloudstackLogicError
 from cloudify_cloudstack.cloudify_cloudstack import CloudstackConnector
 from cloudify_cloudstack.cloudify_cloudstack import CloudstackKeypairCreator
 from cloudify_cloudstack.cloudify_cloudstack import \
     CloudstackSecurityGroupCreator
+from cloudify_cloudstack.cloudify_cloudstack import CloudstackPackageCache
+from cloudify_cloudstack.cloudify_cloudstack import CloudstackCatalogCache
+from cloudify_cloudstack.cloudify_cloudstack import CloudstackOrphanSweeper
+from cloudify_cloudstack.cloudify_cloudstack import ProviderManager
+from cloudify_cloudstack.cloudify_cloudstack import CloudstackBulkTerminator
+from cloudify_cloudstack.cloudify_cloudstack import CloudstackAccountPool
+from cloudify_cloudstack.cloudify_cloudstack import CloudstackTemplateStager
+from cloudify_cloudstack.cloudify_cloudstack import CloudstackEndpointPool
+from cloudify_cloudstack.cloudify_cloudstack import CloudstackWarmPool
+from cloudify_cloudstack.cloudify_cloudstack import CloudstackPreflight
+from cloudify_cloudstack.cloudify_cloudstack import CloudstackInventory
+from cloudify_cloudstack.cloudify_cloudstack import CloudstackSingleFlight
+from cloudify_cloudstack.cloudify_cloudstack import _iter_resources
+from cloudify_cloudstack.cloudify_cloudstack import CloudstackHedger
+from cloudify_cloudstack.cloudify_cloudstack import \
+    CloudstackPlacementScheduler
+from cloudify_cloudstack.cloudify_cloudstack import CloudstackRecordIndex
+from cloudify_cloudstack.cloudify_cloudstack import CloudstackVmRecord
+from cloudify_cloudstack.cloudify_cloudstack import CloudstackKeypairRecord
+from cloudify_cloudstack.cloudify_cloudstack import CloudstackFileUploader
+from cloudify_cloudstack.cloudify_cloudstack import CloudstackSSHSessionPool
+from cloudify_cloudstack.cloudify_cloudstack import _get_template_registry
+from cloudify_cloudstack.cloudify_cloudstack import _get_packages_key
+from cloudify_cloudstack.cloudify_cloudstack import _lookup_management_image
+from cloudify_cloudstack import cloudify_cloudstack as provider_module
+from cloudify_cloudstack.cloudify_cloudstack import CloudstackPlanner
+from cloudify_cloudstack.cloudify_cloudstack import \
+    _get_provisioned_resources
+from cloudify_cloudstack.cloudify_cloudstack import CloudstackUserdataBuilder
+from cloudify_cloudstack.cloudify_cloudstack import CloudstackConnection
+from cloudify_cloudstack.cloudify_cloudstack import _move_body_params
+from cloudify_cloudstack.cloudify_cloudstack import DEFAULT_USERDATA_MAX_SIZE
+from cloudify_cloudstack.daemon import CloudstackDaemon
 import logging
+from libcloud.common.types import ProviderError
+from libcloud.compute.drivers.cloudstack import CloudStackNetwork
+from libcloud.compute.base import NodeSize
+from libcloud.compute.base import NodeImage
+from libcloud.compute.base import NodeLocation
+from libcloud.compute.base import Node
+from libcloud.compute.types import NodeState
+
+
+class FakeCloud(object):
+    """
+    answers api calls from canned responses (a dict, a callable taking the
+    params, or an exception to raise) and records every call.
+    """
+
+    def __init__(self, responses=None):
+        self.responses = responses or {}
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def request(self, command, params=None):
+        params = dict(params or {})
+        with self._lock:
+            self.calls.append((command, params))
+        response = self.responses.get(command, {})
+        if isinstance(response, Exception):
+            raise response
+        if callable(response):
+            return response(params)
+        return deepcopy(response)
+
+    def commands(self):
+        with self._lock:
+            return [command for command, _ in self.calls]
+
+
+class FakeDriver(object):
+    page_size = 500
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def _sync_request(self, command, params=None, **kwargs):
+        return self.cloud.request(command, params)
+
+    def _async_request(self, command, params=None, **kwargs):
+        return self.cloud.request(command, params)
+
+    def _to_node(self, data):
+        return data
+
+
+class FakeNodeDriver(FakeDriver):
+    """
+    a driver deploying vms as provisioning does, returning libcloud nodes.
+    """
+
+    type = 'cloudstack'
+    name = 'CloudStack'
+
+    def _create_args_to_params(self, node, **kwargs):
+        return {'name': kwargs['name']}
+
+    def _to_node(self, data):
+        return Node(data['id'], data.get('name'), NodeState.RUNNING, [],
+                    [], self)
+
+    def ex_create_port_forwarding_rule(self, **kwargs):
+        return self.cloud.request('createPortForwardingRule', {
+            'publicport': kwargs['public_port']})
+
+    def destroy_node(self, node):
+        return self.cloud.request('destroyVirtualMachine', {'id': node.id})
+
+    def list_key_pairs(self):
+        return []
+
+    def ex_delete_network(self, network):
+        return self.cloud.request('deleteNetwork', {'id': network.id})
+
+
+class FakeConnector(CloudstackConnector):
+    """
+    a connector whose drivers talk to a FakeCloud.
+    """
+
+    def __init__(self, provider_config, cloud, driver_class=FakeDriver):
+        CloudstackConnector.__init__(self, provider_config)
+        self.cloud = cloud
+        self.driver_class = driver_class
+
+    def create(self):
+        return self.driver_class(self.cloud)
+
+
+class FakeResolver(object):
+    """
+    a resolver handing out resolved objects without any lookup.
+    """
+
+    def __init__(self, resolved):
+        self.resolved = resolved
+        self.errors = {}
+
+    def resolve(self):
+        return self.resolved
+
+
+class FakeHedgedDriver(object):
+    """
+    a driver whose requests the hedger can abort.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.aborted = False
+        self.connection = None
+
+
+class FakeSnapshot(object):
+    """
+    a capacity snapshot which is never fetched.
+    """
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.deducted = []
+
+    def get(self):
+        return self.snapshot
+
+    def deduct(self, placements, memory=0):
+        self.deducted.append((placements, memory))
+
+
+class FakeSSHClient(object):
+    """
+    an ssh client of a manager holding files of known sha256 digests.
+    """
+
+    class Output(object):
+        def __init__(self, data, status=0):
+            self.data = data
+            self.channel = self
+            self.status = status
+
+        def recv_exit_status(self):
+            return self.status
+
+        def read(self):
+            return self.data
+
+    class SFTP(object):
+        def __init__(self, client):
+            self.client = client
+
+        def stat(self, path):
+            return path
+
+        def put(self, local_path, remote_path):
+            self.client.puts.append((local_path, remote_path))
+
+        def chmod(self, path, mode):
+            pass
+
+        def posix_rename(self, source, target):
+            self.client.renames.append((source, target))
+
+        def close(self):
+            pass
+
+    def __init__(self, digests):
+        self.digests = digests
+        self.commands = []
+        self.puts = []
+        self.renames = []
+
+    def exec_command(self, command):
+        self.commands.append(command)
+        out = ''.join('{0}  {1}\n'.format(digest, path)
+                      for path, digest in self.digests.items()
+                      if path in command)
+        return None, self.Output(out), self.Output('')
+
+    def open_sftp(self):
+        return self.SFTP(self)
+
+
+class FakeDaemon(CloudstackDaemon):
+    """
+    a daemon whose endpoint connector talks to a FakeCloud.
+    """
+
+    def __init__(self, socket_path, cloud):
+        CloudstackDaemon.__init__(self, socket_path)
+        self.cloud = cloud
+
+    def get_endpoint(self, provider_config):
+        return {'connector': FakeConnector(provider_config, self.cloud)}
 
 
 class CloudstackProviderTestCase(unittest.TestCase):
@@ -261,9 +507,1405 @@ class CloudstackProviderTestCase(unittest.TestCase):
         except CloudstackLogicError:
             pass
 
+    def test_package_cache_resumes_download(self):
+        """
+        Tests the package cache resumes a dropped download, standing in a
+        local file server for the package repository.
+        """
+        package = os.urandom(3 * 1024 * 1024)
+        requests = []
 
+        class PackageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append(self.headers.get('Range'))
+                start = 0
+                if self.headers.get('Range'):
+                    start = int(self.headers['Range'][6:].rstrip('-'))
+                    self.send_response(206)
+                else:
+                    self.send_response(200)
+                body = package[start:]
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                # the first response drops after the first megabyte.
+                self.wfile.write(body[:1024 * 1024]
+                                 if len(requests) == 1 else body)
 
+            def log_message(self, *args):
+                pass
 
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), PackageHandler)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        cache_dir = tempfile.mkdtemp()
+        try:
+            url = 'http://127.0.0.1:{0}/cloudify-components.deb'.format(
+                server.server_port)
+            package_cache = CloudstackPackageCache(cache_dir)
+            with open(package_cache.fetch(url), 'rb') as f:
+                if f.read() != package:
+                    raise AssertionError('cached package is corrupt')
+            if requests != [None, 'bytes={0}-'.format(1024 * 1024)]:
+                raise AssertionError(
+                    'expecting a resumed download, got {0}'.format(requests))
+
+            package_cache.fetch(url)
+            if len(requests) != 2:
+                raise AssertionError('expecting the package to be cached')
+        finally:
+            server.shutdown()
+            shutil.rmtree(cache_dir)
+
+
+class CloudstackOfflineTestCase(unittest.TestCase):
+    """
+    tests running against a FakeCloud, no cloud needed.
+    """
+
+    def setUp(self):
+        self.provider_config = _read_config(None)
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_catalog_cache_refreshes_in_place(self):
+        """
+        Tests a catalog cache without background refresh fills itself on
+        the first lookup and answers the next ones.
+        """
+        self.provider_config['cloudstack']['catalog_cache'] = {
+            'background_refresh': False}
+        cloud = FakeCloud({'listServiceOfferings': {'serviceoffering': [
+            {'id': 'so-1', 'name': 'Small'},
+            {'id': 'so-2', 'name': 'Medium'}], 'count': 2}})
+        catalog = CloudstackCatalogCache(
+            FakeConnector(self.provider_config, cloud),
+            self.provider_config, self.tmp_dir)
+        self.assertEqual('so-2', catalog.find('service_offerings', 'name',
+                                              'Medium')['id'])
+        self.assertEqual('so-1', catalog.find('service_offerings', 'name',
+                                              'Small')['id'])
+        self.assertEqual(['listServiceOfferings'], cloud.commands())
+
+    def test_catalog_cache_templates_by_zone(self):
+        """
+        Tests a template listed in two zones is found with the record of
+        the zone asked for.
+        """
+        self.provider_config['cloudstack']['catalog_cache'] = {
+            'background_refresh': False}
+        cloud = FakeCloud({'listTemplates': {'template': [
+            {'id': 't-1', 'name': 'ubuntu', 'zoneid': 'z1',
+             'isready': False},
+            {'id': 't-1', 'name': 'ubuntu', 'zoneid': 'z2',
+             'isready': True}], 'count': 2}})
+        catalog = CloudstackCatalogCache(
+            FakeConnector(self.provider_config, cloud),
+            self.provider_config, self.tmp_dir)
+        record = catalog.find('templates', 'id', 't-1', zone_id='z2')
+        self.assertEqual('z2', record['zoneid'])
+        self.assertTrue(record['isready'])
+        self.assertEqual('z1', catalog.find('templates', 'id', 't-1',
+                                            zone_id='z1')['zoneid'])
+
+    def test_catalog_cache_lists_every_page(self):
+        """
+        Tests templates past the first page are cached, so finding one
+        neither misses nor invalidates the catalog.
+        """
+        self.provider_config['cloudstack']['catalog_cache'] = {
+            'background_refresh': False}
+        templates = [{'id': 't-{0}'.format(i), 'name': 'template',
+                      'zoneid': 'z1'} for i in range(700)]
+        cloud = FakeCloud({'listTemplates': lambda params: {
+            'template': templates[(params['page'] - 1) * 500:
+                                  params['page'] * 500],
+            'count': len(templates)}})
+        catalog = CloudstackCatalogCache(
+            FakeConnector(self.provider_config, cloud),
+            self.provider_config, self.tmp_dir)
+        self.assertEqual('t-650', catalog.find('templates', 'id',
+                                               't-650')['id'])
+        self.assertEqual('t-1', catalog.find('templates', 'id', 't-1')['id'])
+        self.assertEqual(2, cloud.commands().count('listTemplates'))
 
+    def test_sweeper_matches_provisioned_names(self):
+        """
+        Tests the names provisioning uses carry the resources prefix the
+        orphan sweeper looks for, and existing resources keep their name.
+        """
+        self.provider_config['cloudify']['resources_prefix'] = 'unittest-'
+        self.provider_config['networking']['management_network'][
+            'use_existing'] = False
+        self.provider_config['compute']['agent_servers']['agents_keypair'][
+            'use_existing'] = True
+        config = ProviderManager(self.provider_config).provider_config
+        compute_config = config['compute']
+        vm_name = compute_config['management_server']['instance']['name']
+        keypair_name = compute_config['management_server'][
+            'management_keypair']['name']
+        network_name = config['networking']['management_network']['name']
+        agents_keypair_name = compute_config['agent_servers'][
+            'agents_keypair']['name']
+        for name in (vm_name, keypair_name, network_name):
+            self.assertTrue(name.startswith('unittest-'), name)
+        self.assertFalse(agents_keypair_name.startswith('unittest-'))
+
+        cloud = FakeCloud({
+            'listVirtualMachines': {'virtualmachine': [
+                {'id': 'vm-1', 'name': vm_name},
+                {'id': 'vm-2', 'name': 'someone-elses-vm'}], 'count': 2},
+            'listSSHKeyPairs': {'sshkeypair': [
+                {'name': keypair_name}, {'name': agents_keypair_name}],
+                'count': 2},
+            'listNetworks': {'network': [
+                {'id': 'net-1', 'name': network_name}], 'count': 1},
+            'listVolumes': {'volume': [
+                {'id': 'vol-1', 'name': vm_name + '-data-1'}], 'count': 1}})
+        index = CloudstackOrphanSweeper(
+            FakeConnector(config, cloud), config).build_index()
+        self.assertEqual(['vm-1'], [vm['id'] for vm in index['vms']])
+        self.assertEqual([keypair_name],
+                         [k['name'] for k in index['keypairs']])
+        self.assertEqual(['net-1'], [n['id'] for n in index['networks']])
+        self.assertEqual(['vol-1'], [v['id'] for v in index['volumes']])
+
+    def test_resource_names_prefixed_once_changed(self):
+        """
+        Tests the placeholder prefix of the shipped config names nothing,
+        and contexts of provisions older than the prefixing are torn down
+        by their unprefixed names.
+        """
+        self.provider_config['cloudstack']['zone_type'] = 'advanced'
+        config = ProviderManager(self.provider_config).provider_config
+        self.assertEqual('your_name_here',
+                         config['cloudify']['resources_prefix'])
+        self.assertEqual(
+            self.provider_config['compute']['management_server'][
+                'instance']['name'],
+            config['compute']['management_server']['instance']['name'])
+
+        self.provider_config['cloudify']['resources_prefix'] = 'me-'
+        unprefixed = self.provider_config['networking'][
+            'management_network']['name']
+        config = ProviderManager(self.provider_config).provider_config
+        self.assertEqual('me-' + unprefixed, config['networking'][
+            'management_network']['name'])
+        # the daemon prefixes the config of its clients again.
+        config = ProviderManager(config).provider_config
+        self.assertEqual(unprefixed, _get_provisioned_resources(
+            config, {'mgmt_node_id': 'vm-1'})['network'])
+        self.assertEqual({'network': 'recorded'}, _get_provisioned_resources(
+            config, {'mgmt_node_id': 'vm-1',
+                     'resources': {'network': 'recorded'}}))
+
+        cloud = FakeCloud({'listSSHKeyPairs': lambda params: {
+            'sshkeypair': [{'name': params['name']}], 'count': 1}})
+        plan = CloudstackPlanner(
+            FakeConnector(config, cloud), config, None).plan_teardown({
+                'mgmt_node_id': 'vm-1',
+                'resources': {'keypairs': ['old-kp', 'old-agents-kp'],
+                              'network': 'old-network'}})
+        self.assertEqual(
+            ['old-kp', 'old-agents-kp', 'old-network'],
+            [step['resource'] for step in plan['steps']
+             if step['command'] in ('deleteSSHKeyPair', 'deleteNetwork')])
+
+    def test_bulk_teardown_releases_ips_before_networks(self):
+        """
+        Tests the bulk teardown releases the public ips of a context
+        before deleting its network.
+        """
+        cloud = FakeCloud({
+            'listVirtualMachines': {'virtualmachine': [
+                {'id': 'vm-{0}'.format(i)} for i in range(4)], 'count': 4},
+            'listNetworks': {'network': [
+                {'id': 'net-{0}'.format(i), 'name': 'net-{0}'.format(i)}
+                for i in range(4)], 'count': 4},
+            'listPublicIpAddresses': {'publicipaddress': [
+                {'id': 'ip-{0}'.format(i)} for i in range(4)], 'count': 4}})
+        contexts = [{'mgmt_node_id': 'vm-{0}'.format(i),
+                     'resources': {'keypairs': [],
+                                   'network': 'net-{0}'.format(i),
+                                   'public_ip': 'ip-{0}'.format(i)}}
+                    for i in range(4)]
+        failures = CloudstackBulkTerminator(
+            FakeConnector(self.provider_config, cloud),
+            self.provider_config).terminate(contexts)
+        self.assertEqual([], failures)
+        commands = [c for c in cloud.commands() if not c.startswith('list')]
+        self.assertEqual(4, commands.count('disassociateIpAddress'))
+        self.assertEqual(4, commands.count('deleteNetwork'))
+        last_release = max(i for i, c in enumerate(commands)
+                           if c == 'disassociateIpAddress')
+        first_delete = commands.index('deleteNetwork')
+        self.assertTrue(last_release < first_delete, commands)
+
+    def test_teardown_releases_ip_before_network(self):
+        """
+        Tests the teardown of a manager claimed from the warm pool releases
+        its public ip before deleting the network.
+        """
+        self.provider_config['cloudstack']['zone_type'] = 'advanced'
+        released = []
 
+        def _delete_network(params):
+            if not released:
+                raise ProviderError('network has ips', 431)
+            return {}
 
+        cloud = FakeCloud({
+            'listVirtualMachines': {'virtualmachine': [
+                {'id': 'vm-1', 'name': 'manager'}], 'count': 1},
+            'listNetworks': {'network': [
+                {'id': 'net-1', 'name': 'net', 'displaytext': 'net',
+                 'networkofferingid': 'offering-1', 'zoneid': 'zone-1'}],
+                'count': 1},
+            'disassociateIpAddress': lambda params: released.append(
+                params['id']) or {},
+            'deleteNetwork': _delete_network})
+        provider_manager = ProviderManager(self.provider_config)
+        provider_manager._teardown(
+            FakeConnector(provider_manager.provider_config, cloud,
+                          FakeNodeDriver),
+            {'mgmt_node_id': 'vm-1',
+             'resources': {'keypairs': [], 'network': 'net',
+                           'public_ip': 'ip-1'}})
+        self.assertEqual(['disassociateIpAddress', 'destroyVirtualMachine',
+                          'deleteNetwork'],
+                         [c for c in cloud.commands()
+                          if not c.startswith('list')])
+
+    def test_bulk_teardown_of_contexts_without_resources(self):
+        """
+        Tests contexts of provisions older than the resource prefix get
+        their resources deleted by the names they were provisioned with.
+        """
+        self.provider_config['cloudstack']['zone_type'] = 'advanced'
+        compute_config = self.provider_config['compute']
+        names = [compute_config['management_server']['management_keypair'][
+                     'name'],
+                 compute_config['agent_servers']['agents_keypair']['name']]
+        network_name = self.provider_config['networking'][
+            'management_network']['name']
+        self.provider_config['cloudify']['resources_prefix'] = 'unittest-'
+        config = ProviderManager(self.provider_config).provider_config
+        cloud = FakeCloud({
+            'listVirtualMachines': {'virtualmachine': [{'id': 'vm-1'}],
+                                    'count': 1},
+            'listSSHKeyPairs': {'sshkeypair': [
+                {'name': name} for name in names] + [
+                {'name': 'unittest-' + name} for name in names],
+                'count': 4},
+            'listNetworks': {'network': [
+                {'id': 'net-1', 'name': network_name},
+                {'id': 'net-2', 'name': 'unittest-' + network_name}],
+                'count': 2}})
+        failures = CloudstackBulkTerminator(
+            FakeConnector(config, cloud), config).terminate(
+                [{'mgmt_node_id': 'vm-1'}])
+        self.assertEqual([], failures)
+        self.assertEqual(
+            sorted([('deleteNetwork', 'net-1'),
+                    ('deleteSSHKeyPair', names[0]),
+                    ('deleteSSHKeyPair', names[1])]),
+            sorted((command, params.get('id') or params.get('name'))
+                   for command, params in cloud.calls
+                   if command.startswith('delete')))
+
+    def test_userdata_fits_default_size(self):
+        """
+        Tests the userdata carrying a 2048 bit agents key fits the default
+        userdata.max_size, and cloud-init gets the key back from it.
+        """
+        key_path = os.path.join(self.tmp_dir, 'agents-kp.pem')
+        paramiko.RSAKey.generate(2048).write_private_key_file(key_path)
+        server_config = self.provider_config['compute']['management_server']
+        server_config['userdata'] = {'enabled': True}
+        self.provider_config['compute']['agent_servers']['agents_keypair'][
+            'provided'] = {'private_key_filepath': key_path}
+
+        userdata = CloudstackUserdataBuilder(self.provider_config).build()
+        self.assertTrue(userdata is not None)
+        self.assertTrue(len(base64.b64encode(userdata)) <=
+                        DEFAULT_USERDATA_MAX_SIZE)
+        written = yaml.safe_load(userdata)['write_files'][0]
+        content = gzip.GzipFile(fileobj=StringIO(
+            base64.b64decode(written['content']))).read()
+        with open(key_path) as f:
+            self.assertEqual(f.read(), content)
+
+    def test_userdata_sent_in_signed_body(self):
+        """
+        Tests userdata is moved to a POST body and signed together with
+        the query parameters.
+        """
+        kwargs = _move_body_params({'params': {'name': 'vm',
+                                               'userdata': 'dXNlcg=='}})
+        self.assertEqual({'name': 'vm'}, kwargs['params'])
+        self.assertEqual({'userdata': 'dXNlcg=='}, kwargs['data'])
+        self.assertEqual('POST', kwargs['method'])
+        self.assertEqual({'params': {'name': 'vm'}},
+                         _move_body_params({'params': {'name': 'vm'}}))
+
+        connection = CloudstackConnection('key', 'secret')
+        connection.encode_data(kwargs['data'])
+        params = connection.add_default_params(
+            dict(kwargs['params'], command='deployVirtualMachine'))
+        params, headers = connection.pre_connect_hook(dict(params), {})
+        signature = params.pop('signature')
+        self.assertEqual(connection._make_signature(
+            dict(params, userdata='dXNlcg==')), signature)
+        self.assertEqual('application/x-www-form-urlencoded',
+                         headers['Content-Type'])
+        # the next request without a body is signed as usual.
+        params, headers = connection.pre_connect_hook({'command': 'x'}, {})
+        self.assertEqual(connection._make_signature({'command': 'x'}),
+                         params['signature'])
+
+    def test_daemon_keeps_session_state(self):
+        """
+        Tests calls through the daemon run on one manager per client, whose
+        config comes back to the client, over a socket only the user can
+        open.
+        """
+        socket_path = os.path.join(self.tmp_dir, 'daemon.sock')
+        self.provider_config['cloudstack']['daemon'] = {
+            'enabled': True, 'socket': socket_path}
+        self.provider_config['cloudify']['resources_prefix'] = 'unittest-'
+        provider_manager = ProviderManager(self.provider_config)
+        vm_name = provider_manager.provider_config['compute'][
+            'management_server']['instance']['name']
+        cloud = FakeCloud({'listVirtualMachines': {'virtualmachine': [
+            {'id': 'vm-1', 'name': vm_name}], 'count': 1}})
+        daemon = FakeDaemon(socket_path, cloud)
+        daemon_thread = threading.Thread(target=daemon.serve_forever)
+        daemon_thread.daemon = True
+        daemon_thread.start()
+        try:
+            self.assertEqual(0600, stat.S_IMODE(os.stat(socket_path).st_mode))
+            self.assertEqual(['vm-1'], [vm['id'] for vm in provider_manager
+                                        .sweep()['resources']['vms']])
+            daemon_manager = daemon.get_manager(
+                provider_manager.daemon_session,
+                provider_manager.provider_config)
+            daemon_manager.provider_config['cloudify']['resources_prefix'] = \
+                'changed-by-the-daemon'
+            provider_manager.sweep()
+            self.assertEqual('changed-by-the-daemon',
+                             provider_manager.provider_config['cloudify'][
+                                 'resources_prefix'])
+            self.assertEqual(1, len(daemon._sessions))
+        finally:
+            daemon.shutdown()
+            daemon.server_close()
+
+    def test_account_selected_per_operation(self):
+        """
+        Tests every provisioning goes to the account with the most capacity
+        left at the time, and teardowns to the account of their context.
+        """
+        auth = self.provider_config['authentication']
+        auth.update({'api_key': 'key-a', 'api_secret_key': 'secret-a',
+                     'accounts': [{'api_key': 'key-b',
+                                   'api_secret_key': 'secret-b'}]})
+        remaining = {'key-a': 5, 'key-b': 10}
+
+        def _get_usage(account_pool, account):
+            return {'instance': {'remaining': remaining[account['api_key']]},
+                    'network': {'remaining': None}}
+
+        get_usage = CloudstackAccountPool._get_usage
+        CloudstackAccountPool._get_usage = _get_usage
+        try:
+            provider_manager = ProviderManager(self.provider_config)
+            provider_manager._select_account()
+            self.assertEqual('key-b', provider_manager.provider_config[
+                'authentication']['api_key'])
+            remaining['key-b'] = 1
+            provider_manager._select_account()
+            self.assertEqual('key-a', provider_manager.provider_config[
+                'authentication']['api_key'])
+            provider_manager._select_account({'api_key': 'key-b'})
+            self.assertEqual('secret-b', provider_manager.provider_config[
+                'authentication']['api_secret_key'])
+            # contexts from before accounts were configured.
+            provider_manager._select_account({})
+            self.assertEqual('key-a', provider_manager.provider_config[
+                'authentication']['api_key'])
+            self.assertRaises(CloudstackLogicError,
+                              provider_manager._select_account,
+                              {'api_key': 'key-c'})
+            self.assertEqual(
+                ['key-a', 'key-b'],
+                [a['api_key'] for a in CloudstackAccountPool(
+                    provider_manager.provider_config).accounts])
+        finally:
+            CloudstackAccountPool._get_usage = get_usage
+
+    def test_stager_fails_fast_on_copies_not_started(self):
+        """
+        Tests waiting for a zone the template copy failed to start for
+        fails at once instead of at the timeout.
+        """
+        cloud = FakeCloud({
+            'listTemplates': {'template': [
+                {'id': 'tmpl-1', 'zoneid': 'zone-1', 'isready': True}],
+                'count': 1},
+            'copyTemplate': lambda params: {'jobid': 'job-1'}
+            if params['destzoneid'] == 'zone-2'
+            else self.fail_copy(params)})
+        stager = CloudstackTemplateStager(
+            FakeConnector(self.provider_config, cloud), self.provider_config,
+            'tmpl-1')
+        self.assertEqual({'zone-1': 'ready', 'zone-2': 'copying',
+                          'zone-3': 'failed'},
+                         stager.stage(['zone-1', 'zone-2', 'zone-3']))
+        self.assertEqual({'zone-2': 'job-1', 'zone-3': None}, stager.jobs)
+        self.assertEqual({'zone-2': 'copying', 'zone-3': 'failed'},
+                         stager.pending())
+        self.assertRaises(CloudstackLogicError, stager.wait, ['zone-3'],
+                          timeout=600, interval=600)
+        # a single poll.
+        self.assertEqual(3, cloud.commands().count('listTemplates'))
+
+    def fail_copy(self, params):
+        raise ProviderError('no secondary storage in zone {0}'.format(
+            params['destzoneid']), 431)
+
+    def test_endpoint_pool_prefers_fast_healthy_endpoints(self):
+        """
+        Tests endpoints not measured yet or failing do not win over a
+        measured healthy one.
+        """
+        pool = CloudstackEndpointPool(['http://a/client/api',
+                                       'http://b/client/api',
+                                       'http://c/client/api'])
+        a, b, c = pool.endpoints
+        pool.release(pool.acquire(exclude=[b, c]), latency=0.2)
+        pool.release(pool.acquire(exclude=[a, c]), latency=0.35)
+        # c is expected to be as fast as the mean of a and b.
+        self.assertTrue(pool.acquire() is a)
+        self.assertTrue(pool.acquire() is c)
+        pool.release(a, latency=0.2)
+        pool.release(c, error=True)
+        self.assertTrue(c.latency is None)
+        self.assertTrue(pool.acquire() is a)
+        self.assertTrue(pool.acquire() is b)
+
+    def test_endpoint_pool_circuit(self):
+        """
+        Tests an endpoint is skipped once it failed failure_threshold
+        requests in a row, and gets a single probe once reset_timeout
+        passed.
+        """
+        pool = CloudstackEndpointPool(['http://a/client/api',
+                                       'http://b/client/api'],
+                                      failure_threshold=2, reset_timeout=60)
+        a, b = pool.endpoints
+        pool.release(pool.acquire(exclude=[b]), latency=0.1)
+        pool.release(pool.acquire(exclude=[a]), latency=0.2)
+        for _ in range(2):
+            pool.release(pool.acquire(exclude=[b]), error=True)
+        self.assertTrue(a.open_until > time.time())
+        self.assertTrue(pool.acquire() is b)
+        # every circuit open, the one closing first is tried.
+        self.assertTrue(pool.acquire(exclude=[b]) is a)
+        pool.release(a, error=True)
+        pool.release(b, latency=0.2)
+
+        a.open_until = time.time() - 1
+        self.assertTrue(pool.acquire() is a)
+        self.assertTrue(a.probing)
+        # one probe at a time.
+        self.assertTrue(pool.acquire() is b)
+        pool.release(b, latency=0.2)
+        # a failed probe opens the circuit again.
+        pool.release(a, error=True)
+        self.assertFalse(a.probing)
+        self.assertTrue(a.open_until > time.time())
+
+        a.open_until = time.time() - 1
+        self.assertTrue(pool.acquire() is a)
+        pool.release(a, latency=0.1)
+        self.assertEqual((0, 0), (a.open_until, a.failures))
+
+    def test_package_cache_fetches_each_url_once(self):
+        """
+        Tests a package listed several times, or fetched by several threads
+        at once, is downloaded once.
+        """
+        package = os.urandom(256 * 1024)
+        requests = []
+
+        class PackageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append(self.path)
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(package)))
+                self.end_headers()
+                self.wfile.write(package)
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), PackageHandler)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        try:
+            url = 'http://127.0.0.1:{0}/cloudify-core.deb'.format(
+                server.server_port)
+            package_cache = CloudstackPackageCache(self.tmp_dir)
+            paths = package_cache.fetch_in_background([url, url, url]).get()
+            self.assertEqual(1, len(paths))
+            self.assertEqual(1, len(requests))
+
+            url = url.replace('core', 'ui')
+            fetches = [threading.Thread(target=package_cache.fetch,
+                                        args=(url,)) for _ in range(4)]
+            for fetch in fetches:
+                fetch.start()
+            for fetch in fetches:
+                fetch.join()
+            self.assertEqual(2, len(requests))
+            with open(package_cache.get(url), 'rb') as f:
+                self.assertEqual(package, f.read())
+        finally:
+            server.shutdown()
+
+    def test_warm_pool_claims_atomically(self):
+        """
+        Tests a warm pool vm tagged by another run is left to it, and a
+        claimed vm is not a pool member anymore.
+        """
+        self.provider_config['compute']['management_server'][
+            'warm_pool'] = {'size': 2}
+        prefix = self.provider_config['compute']['management_server'][
+            'instance']['name'] + CloudstackWarmPool.NAME_INFIX
+        vms = [{'id': 'vm-1', 'name': prefix + '1', 'tags': [
+                    {'key': CloudstackWarmPool.CLAIM_TAG, 'value': 'x'}]},
+               {'id': 'vm-2', 'name': prefix + '2'},
+               {'id': 'vm-3', 'name': prefix + '3'}]
+        tags = {}
+
+        def _create_tags(params):
+            # vm-2 is claimed by another run meanwhile.
+            if params['resourceids'] == 'vm-2':
+                raise ProviderError('tag exists', 431)
+            tags[params['resourceids']] = params['tags[0].value']
+            return {}
+
+        cloud = FakeCloud({
+            'listVirtualMachines': {'virtualmachine': vms, 'count': 3},
+            'listPortForwardingRules': {'portforwardingrule': [
+                {'virtualmachineid': vm['id'], 'ipaddressid': 'ip-' + vm['id'],
+                 'ipaddress': '10.0.0.1'} for vm in vms], 'count': 3},
+            'createTags': _create_tags,
+            'listTags': lambda params: {'tag': [
+                {'key': CloudstackWarmPool.CLAIM_TAG,
+                 'value': tags[params['resourceid']]}], 'count': 1},
+            'startVirtualMachine': lambda params: {
+                'virtualmachine': {'id': params['id']}}})
+        network = CloudStackNetwork('net', 'net', 'offering-1', 'net-1',
+                                    'zone-1', None)
+        warm_pool = CloudstackWarmPool(
+            FakeConnector(self.provider_config, cloud), self.provider_config,
+            {'network': network})
+        cloud_driver = FakeDriver(cloud)
+        self.assertEqual(['vm-2', 'vm-3'], [vm['id'] for vm in warm_pool
+                         .list_members(cloud_driver, network)])
+        node, public_ip = warm_pool.claim(cloud_driver)
+        self.assertEqual('vm-3', node['id'])
+        self.assertEqual('ip-vm-3', public_ip['id'])
+        self.assertEqual([('startVirtualMachine', {'id': 'vm-3'})],
+                         [call for call in cloud.calls
+                          if call[0] == 'startVirtualMachine'])
+
+    def test_provision_needs_include_data_disks(self):
+        """
+        Tests the preflight counts the data volumes and their size.
+        """
+        self.provider_config['cloudstack']['zone_type'] = 'advanced'
+        self.provider_config['compute']['management_server']['instance'][
+            'data_disks'] = [
+                {'disk_offering': 'Custom', 'size': 50, 'mount_point': '/a'},
+                {'disk_offering': 'Medium', 'mount_point': '/b'}]
+        cloud = FakeCloud({
+            'listDiskOfferings': {'diskoffering': [
+                {'id': 'do-2', 'name': 'Medium', 'disksize': 20}],
+                'count': 1},
+            'listResourceLimits': {'resourcelimit': [
+                {'resourcetype': '10', 'max': '60', 'account': 'acc'}],
+                'count': 1},
+            'listAccounts': {'account': [
+                {'name': 'acc', 'primarystoragetotal': '0'}], 'count': 1}})
+        provider_manager = ProviderManager(self.provider_config)
+        connector = FakeConnector(provider_manager.provider_config, cloud)
+        size = NodeSize('size-1', 'Small', 2048, 0, 0, 0, None,
+                        extra={'cpu': 2})
+        needs = provider_manager._get_provision_needs(
+            connector, {'size': size, 'network': 'net-1'})
+        self.assertEqual({'instance': 1, 'volume': 3, 'memory': 2048,
+                          'cpu': 2, 'primary_storage': 70}, needs)
+        self.assertEqual([{'scope': 'account',
+                           'resource': 'primary_storage',
+                           'needed': 70, 'available': 60}],
+                         CloudstackPreflight(
+                             connector, provider_manager.provider_config)
+                         .check(needs))
+
+    def test_preflight_checks_public_ips_of_zone_type(self):
+        """
+        Tests public ips are checked against the virtual network pool
+        (capacity type 4) in advanced zones and the direct attached ones
+        (type 8) in basic zones.
+        """
+        cloud = FakeCloud({'listCapacity': {'capacity': [
+            {'type': 4, 'capacitytotal': '10', 'capacityused': '10'},
+            {'type': 8, 'capacitytotal': '10', 'capacityused': '0'}],
+            'count': 2}})
+        self.provider_config['cloudstack']['zone_type'] = 'advanced'
+        shortfalls = CloudstackPreflight(
+            FakeConnector(self.provider_config, cloud),
+            self.provider_config).check({'public_ip': 1}, 'zone-1')
+        self.assertEqual([{'scope': 'zone', 'resource': 'public_ip',
+                           'needed': 1, 'available': 0}], shortfalls)
+        self.provider_config['cloudstack']['zone_type'] = 'basic'
+        self.assertEqual([], CloudstackPreflight(
+            FakeConnector(self.provider_config, cloud),
+            self.provider_config).check({'public_ip': 1}, 'zone-1'))
+
+    def test_sweeper_deletes_cluster_resources(self):
+        """
+        Tests the sweeper deletes the load balancer rules before the vms
+        and ips, and the affinity group once the vms are gone.
+        """
+        self.provider_config['cloudify']['resources_prefix'] = 'unittest-'
+        config = ProviderManager(self.provider_config).provider_config
+        cloud = FakeCloud({
+            'listVirtualMachines': {'virtualmachine': [
+                {'id': 'vm-1', 'name': 'unittest-manager'}], 'count': 1},
+            'listNetworks': {'network': [
+                {'id': 'net-1', 'name': 'unittest-network'}], 'count': 1},
+            'listPublicIpAddresses': {'publicipaddress': [
+                {'id': 'ip-1', 'associatednetworkid': 'net-1'}],
+                'count': 1},
+            'listLoadBalancerRules': {'loadbalancerrule': [
+                {'id': 'lb-1', 'name': 'unittest-manager-80'},
+                {'id': 'lb-2', 'name': 'manual', 'publicipid': 'ip-1'},
+                {'id': 'lb-3', 'name': 'someone-elses-rule'}], 'count': 3},
+            'listAffinityGroups': {'affinitygroup': [
+                {'id': 'ag-1', 'name': 'unittest-manager-cluster'},
+                {'id': 'ag-2', 'name': 'someone-elses-group'}],
+                'count': 2}})
+        result = CloudstackOrphanSweeper(
+            FakeConnector(config, cloud), config).sweep(dry_run=False)
+        self.assertEqual([], result['failures'])
+        deletes = [(command, params.get('id')) for command, params
+                   in cloud.calls if command.startswith(('delete',
+                                                          'destroy',
+                                                          'disassociate'))]
+        self.assertEqual(
+            [('deleteLoadBalancerRule', 'lb-1'),
+             ('deleteLoadBalancerRule', 'lb-2'),
+             ('destroyVirtualMachine', 'vm-1'),
+             ('deleteAffinityGroup', 'ag-1'),
+             ('disassociateIpAddress', 'ip-1'),
+             ('deleteNetwork', 'net-1')],
+            sorted(deletes[:2]) + deletes[2:])
+
+    def test_inventory_shares_values_per_snapshot(self):
+        """
+        Tests the values of shared fields are stored once per inventory
+        snapshot, not for the life of the process.
+        """
+        # every response holds strings of its own.
+        cloud = FakeCloud({'listVirtualMachines': lambda params: {
+            'virtualmachine': [
+                {'id': 'vm-{0}'.format(i), 'zoneid': ''.join(['zone', '-1'])}
+                for i in range(3)], 'count': 3}})
+        inventory = CloudstackInventory(
+            FakeConnector(self.provider_config, cloud), self.provider_config)
+        inventory.snapshot()
+        zone_ids = [vm['zoneid'] for vm in inventory.list('vms')]
+        self.assertTrue(zone_ids[0] is zone_ids[1] is zone_ids[2])
+
+        inventory.snapshot()
+        self.assertFalse(inventory.list('vms')[0]['zoneid'] is zone_ids[0])
+        other = CloudstackInventory(
+            FakeConnector(self.provider_config, cloud), self.provider_config)
+        other.snapshot()
+        self.assertFalse(other.list('vms')[0]['zoneid'] is zone_ids[0])
+
+    def test_inventory_syncs_account_without_events(self):
+        """
+        Tests an inventory of an account without events syncs from the
+        events of later changes instead of taking a snapshot every time.
+        """
+        events = []
+        cloud = FakeCloud({
+            'listEvents': lambda params: {'event': list(events),
+                                          'count': len(events)},
+            'listVirtualMachines': lambda params: {'virtualmachine': [
+                {'id': params.get('id', 'vm-1'), 'name': 'vm'}],
+                'count': 1}})
+        inventory = CloudstackInventory(
+            FakeConnector(self.provider_config, cloud), self.provider_config)
+        inventory.sync()
+        listed = cloud.commands().count('listVirtualMachines')
+        inventory.sync()
+        self.assertEqual(listed, cloud.commands().count('listVirtualMachines'))
+
+        events.append({'id': 'ev-1', 'type': 'VM.CREATE', 'state': 'Completed',
+                       'resourceid': 'vm-2',
+                       'created': '2014-06-01T12:00:00+0200'})
+        inventory.sync()
+        self.assertEqual(['vm-1', 'vm-2'], sorted(
+            vm['id'] for vm in inventory.list('vms')))
+        self.assertEqual(('listVirtualMachines', 'vm-2'),
+                         (cloud.calls[-1][0], cloud.calls[-1][1].get('id')))
+        self.assertEqual('2014-06-01 12:00:00', inventory._cursor)
+
+    def test_managers_share_connectors(self):
+        """
+        Tests the managers of the process share one connector per api
+        endpoint and account.
+        """
+        connector = ProviderManager(self.provider_config)._get_connector()
+        self.assertTrue(connector is ProviderManager(
+            self.provider_config)._get_connector())
+        self.provider_config['authentication']['api_key'] = 'other-key'
+        self.assertFalse(connector is ProviderManager(
+            self.provider_config)._get_connector())
+
+    def test_single_flight_shares_copies(self):
+        """
+        Tests concurrent identical calls make one api call, and no caller
+        sees the changes another makes to its response.
+        """
+        single_flight = CloudstackSingleFlight()
+        key = single_flight.get_key('listNetworks', {'name': 'net'})
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def _request():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return {'network': [{'id': 'net-1'}]}
+
+        results = []
+
+        def _call():
+            result = single_flight.call(key, _request)
+            result['network'].append('changed')
+            results.append(result)
+
+        leader = threading.Thread(target=_call)
+        leader.start()
+        started.wait()
+        followers = [threading.Thread(target=_call) for _ in range(3)]
+        for follower in followers:
+            follower.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+        self.assertEqual(1, len(calls))
+        self.assertEqual([[{'id': 'net-1'}, 'changed']] * 4,
+                         [result['network'] for result in results])
+
+    def test_single_flight_negative_cache(self):
+        """
+        Tests empty responses are kept for negative_ttl seconds, until a
+        mutating call invalidates them.
+        """
+        single_flight = CloudstackSingleFlight(negative_ttl=60)
+        key = single_flight.get_key('listNetworks', {'name': 'net'})
+        calls = []
+        request = lambda: calls.append(1) or {}
+        self.assertEqual({}, single_flight.call(key, request))
+        self.assertEqual({}, single_flight.call(key, request))
+        self.assertEqual(1, len(calls))
+        single_flight.invalidate()
+        single_flight.call(key, request)
+        self.assertEqual(2, len(calls))
+        # found responses are not kept.
+        other = single_flight.get_key('listNetworks', {'name': 'other'})
+        for _ in range(2):
+            single_flight.call(other, lambda: calls.append(1) or {
+                'network': [{'id': 'net-2'}]})
+        self.assertEqual(4, len(calls))
+
+        single_flight.negative_ttl = 0.01
+        single_flight.invalidate()
+        single_flight.call(key, request)
+        time.sleep(0.02)
+        single_flight.call(key, request)
+        self.assertEqual(6, len(calls))
+
+    def _paged_cloud(self, total, with_count=True):
+        def _list(params):
+            start = (params['page'] - 1) * params['pagesize']
+            vms = [{'id': 'vm-{0}'.format(i)}
+                   for i in range(start, min(start + params['pagesize'],
+                                             total))]
+            response = {'virtualmachine': vms} if vms else {}
+            if with_count and vms:
+                response['count'] = total
+            return response
+        return FakeCloud({'listVirtualMachines': _list})
+
+    def test_pagination_stops_at_count(self):
+        """
+        Tests listings stop once count resources were listed, or at the
+        first short page when there is no count.
+        """
+        for with_count, pages in ((True, [1, 2]), (False, [1, 2, 3])):
+            cloud = self._paged_cloud(4, with_count)
+            cloud_driver = FakeDriver(cloud)
+            cloud_driver.page_size = 2
+            self.assertEqual(
+                ['vm-0', 'vm-1', 'vm-2', 'vm-3'],
+                [vm['id'] for vm in _iter_resources(
+                    cloud_driver, 'listVirtualMachines', 'virtualmachine')])
+            self.assertEqual(pages, [params['page'] for _, params
+                                     in cloud.calls])
+
+    def test_pagination_prefetches_in_order(self):
+        """
+        Tests pages prefetched on the connector's pool are yielded in
+        order, and a caller stopping early leaves the rest unrequested.
+        """
+        cloud = self._paged_cloud(7)
+        connector = FakeConnector(self.provider_config, cloud)
+        cloud_driver = FakeDriver(cloud)
+        cloud_driver.page_size = 2
+        self.assertEqual(
+            ['vm-{0}'.format(i) for i in range(7)],
+            [vm['id'] for vm in _iter_resources(
+                cloud_driver, 'listVirtualMachines', 'virtualmachine',
+                connector)])
+        self.assertEqual([1, 2, 3, 4], sorted(params['page'] for _, params
+                                              in cloud.calls))
+
+        cloud.calls[:] = []
+        resources = _iter_resources(cloud_driver, 'listVirtualMachines',
+                                    'virtualmachine', connector)
+        self.assertEqual('vm-0', next(resources)['id'])
+        resources.close()
+        # the prefetch of the second page may still run.
+        for _ in range(100):
+            if len(cloud.calls) > 1:
+                break
+            time.sleep(0.01)
+        time.sleep(0.05)
+        # the first page and the prefetched second one.
+        self.assertEqual([1, 2], sorted(params['page'] for _, params
+                                        in cloud.calls))
+
+        # listings made by the pool's workers fetch pages themselves.
+        cloud.calls[:] = []
+        self.assertEqual([7], connector.map(
+            lambda driver, item: len(list(_iter_resources(
+                cloud_driver, 'listVirtualMachines', 'virtualmachine',
+                connector))), [1]))
+
+    def _hedged_request(self, slow, events):
+        # the slow driver's request blocks until the hedger aborts it.
+        def _request(cloud_driver):
+            if cloud_driver.name != slow:
+                time.sleep(0.05)
+                return cloud_driver.name
+            deadline = time.time() + 5
+            while not cloud_driver.aborted and time.time() < deadline:
+                time.sleep(0.01)
+            events.append('{0} aborted'.format(cloud_driver.name))
+            raise socket.error('aborted')
+        return _request
+
+    def test_hedger_delay_is_the_latency_percentile(self):
+        """
+        Tests calls are hedged after the p95 of their timed latencies, but
+        not before min_samples calls were timed.
+        """
+        hedger = CloudstackHedger(None, min_delay=0.5, min_samples=20)
+        for latency in range(19):
+            hedger._record('listzones', latency / 10.0)
+        self.assertTrue(hedger.get_delay('listzones') is None)
+        hedger._record('listzones', 1.9)
+        self.assertEqual(1.9, hedger.get_delay('listzones'))
+        for _ in range(80):
+            hedger._record('listzones', 0.1)
+        # index 95 of the sorted latencies.
+        self.assertEqual(1.5, hedger.get_delay('listzones'))
+        # only the latest 200 latencies are kept.
+        for _ in range(200):
+            hedger._record('listzones', 0.1)
+        self.assertEqual(0.5, hedger.get_delay('listzones'))
+
+    def test_hedger_late_call_answered_by_hedge(self):
+        """
+        Tests a call still unanswered after the delay is answered by its
+        hedge, and the late request is aborted.
+        """
+        hedge_driver = FakeHedgedDriver('hedge')
+        connector = type('Connector', (object,), {
+            'get': lambda self: hedge_driver})()
+        hedger = CloudstackHedger(connector, min_delay=0.01, min_samples=1)
+        hedger._record('listzones', 0.01)
+        events = []
+        primary = FakeHedgedDriver('primary')
+        self.assertEqual('hedge', hedger.call(
+            primary, 'listZones', self._hedged_request('primary', events)))
+        self.assertEqual(['primary aborted'], events)
+        # the aborted driver is usable again.
+        self.assertFalse(primary.aborted)
+
+    def test_hedger_primary_answer_aborts_hedge(self):
+        """
+        Tests the hedge of a call is aborted when the original request
+        answers first.
+        """
+        hedge_driver = FakeHedgedDriver('hedge')
+        connector = type('Connector', (object,), {
+            'get': lambda self: hedge_driver})()
+        hedger = CloudstackHedger(connector, min_delay=0.01, min_samples=1)
+        hedger._record('listzones', 0.01)
+        events = []
+        self.assertEqual('primary', hedger.call(
+            FakeHedgedDriver('primary'), 'listZones',
+            self._hedged_request('hedge', events)))
+        for _ in range(100):
+            if events:
+                break
+            time.sleep(0.01)
+        self.assertEqual(['hedge aborted'], events)
+
+    def test_hedger_watcher_stops_with_answered_calls(self):
+        """
+        Tests a call answered before its hedge is due leaves no hedge
+        pending, so the (daemon) watcher stops at once.
+        """
+        hedger = CloudstackHedger(None, min_delay=30, min_samples=1)
+        hedger._record('listzones', 0.01)
+        self.assertEqual('primary', hedger.call(
+            FakeHedgedDriver('primary'), 'listZones',
+            lambda cloud_driver: cloud_driver.name))
+        watcher = hedger._watcher
+        self.assertTrue(watcher is None or watcher.daemon)
+        if watcher is not None:
+            watcher.join(1)
+            self.assertFalse(watcher.is_alive())
+        self.assertEqual([], hedger._pending)
+
+    def _placement_snapshot(self, instances=None):
+        return FakeSnapshot({
+            'zones': [
+                {'id': 'z1', 'name': 'zone-1',
+                 'pods': [{'id': 'p1', 'hosts': 1, 'memory_total': 8192,
+                           'memory_used': 0}],
+                 'networks': [{'id': 'n1', 'name': 'net-1'},
+                              {'id': 'n2', 'name': 'net-2'}]},
+                {'id': 'z2', 'name': 'zone-2',
+                 'pods': [{'id': 'p2', 'hosts': 2, 'memory_total': 8192,
+                           'memory_used': 4096}],
+                 'networks': [{'id': 'n3', 'name': 'net-3'}]}],
+            'account': {'instance': {'remaining': instances}}})
+
+    def test_placement_spreads_by_free_memory(self):
+        """
+        Tests vms go to the pods keeping the largest share of their memory
+        free, to the least used network of a zone.
+        """
+        snapshot = self._placement_snapshot()
+        placements = CloudstackPlacementScheduler(
+            snapshot, self.provider_config).place(3, 2048)
+        self.assertEqual([('z1', 'n1'), ('z1', 'n2'), ('z2', 'n3')],
+                         [(p['zone_id'], p['network_id'])
+                          for p in placements])
+        self.assertEqual([(placements, 2048)], snapshot.deducted)
+
+    def test_placement_respects_anti_affinity_and_limits(self):
+        """
+        Tests an anti-affinity group gets no more vms in a zone than it
+        has hosts, and placements beyond the account limit are refused.
+        """
+        scheduler = CloudstackPlacementScheduler(
+            self._placement_snapshot(), self.provider_config)
+        self.assertEqual(['z1', 'z2', 'z2'], [
+            p['zone_id'] for p in scheduler.place(3, 2048, 'group')])
+        self.assertRaises(CloudstackLogicError, scheduler.place, 4, 2048,
+                          'group')
+        self.provider_config['compute']['agent_servers']['placement'] = {
+            'zones': ['zone-2']}
+        self.assertEqual(['z2'], [p['zone_id'] for p in
+                                  CloudstackPlacementScheduler(
+                                      self._placement_snapshot(),
+                                      self.provider_config).place(1)])
+        self.assertRaises(CloudstackLogicError, CloudstackPlacementScheduler(
+            self._placement_snapshot(instances=2),
+            self.provider_config).place, 3)
+
+    def test_account_pool_chooses_most_remaining(self):
+        """
+        Tests the account with the most of its scarcest resource left is
+        chosen, skipping accounts whose limits cannot be read.
+        """
+        auth = self.provider_config['authentication']
+        auth.update({'api_key': 'key-a', 'api_secret_key': 'secret-a',
+                     'accounts': [
+                         {'api_key': 'key-b', 'api_secret_key': 'secret-b'},
+                         {'api_key': 'key-c', 'api_secret_key': 'secret-c'},
+                         {'api_key': 'key-a', 'api_secret_key': 'secret-a'}]})
+        usages = {
+            'key-a': {'instance': {'remaining': 20},
+                      'public_ip': {'remaining': 2}},
+            'key-b': {'instance': {'remaining': 5},
+                      'public_ip': {'remaining': None}},
+            'key-c': None}
+
+        def _get_usage(account_pool, account):
+            return usages[account['api_key']]
+
+        get_usage = CloudstackAccountPool._get_usage
+        CloudstackAccountPool._get_usage = _get_usage
+        try:
+            accounts = CloudstackAccountPool(self.provider_config)
+            self.assertEqual(3, len(accounts))
+            self.assertEqual({'api_key': 'key-b',
+                              'api_secret_key': 'secret-b'},
+                             accounts.choose())
+            # ties go to the account listed first.
+            usages['key-b']['instance']['remaining'] = 2
+            self.assertEqual('key-a', accounts.choose()['api_key'])
+            usages.update({'key-a': None, 'key-b': None})
+            self.assertRaises(CloudstackLogicError, accounts.choose)
+        finally:
+            CloudstackAccountPool._get_usage = get_usage
+
+    def test_userdata_disabled_or_too_large(self):
+        """
+        Tests no userdata is built when disabled, or when it does not fit
+        userdata.max_size, so the files are uploaded over ssh instead.
+        """
+        key_path = os.path.join(self.tmp_dir, 'agents-kp.pem')
+        with open(key_path, 'w') as f:
+            f.write(os.urandom(4096).encode('hex'))
+        self.provider_config['compute']['agent_servers']['agents_keypair'][
+            'provided'] = {'private_key_filepath': key_path}
+        server_config = self.provider_config['compute']['management_server']
+        server_config['userdata'] = {'enabled': False}
+        self.assertTrue(
+            CloudstackUserdataBuilder(self.provider_config).build() is None)
+        server_config['userdata'] = {
+            'enabled': True, 'files': [
+                {'source': key_path, 'destination': '/etc/cloudify/extra',
+                 'permissions': '0640'}]}
+        userdata = yaml.safe_load(
+            CloudstackUserdataBuilder(self.provider_config).build())
+        self.assertEqual(
+            ['0600', '0640'],
+            [f['permissions'] for f in userdata['write_files']])
+        self.assertEqual('/etc/cloudify/extra',
+                         userdata['write_files'][1]['path'])
+        self.assertEqual(2, len(userdata['runcmd']))
+        server_config['userdata']['max_size'] = 4096
+        self.assertTrue(
+            CloudstackUserdataBuilder(self.provider_config).build() is None)
+
+    def test_record_index(self):
+        """
+        Tests records are found by key and by (non unique) name, and
+        replaced or removed from both indexes.
+        """
+        index = CloudstackRecordIndex('id', [
+            CloudstackVmRecord({'id': 'vm-1', 'name': 'vm', 'state': 'a'}),
+            CloudstackVmRecord({'id': 'vm-2', 'name': 'vm', 'state': 'b'})])
+        self.assertEqual(2, len(index))
+        self.assertEqual(['vm-1', 'vm-2'], sorted(
+            r['id'] for r in index.find('name', 'vm')))
+        self.assertEqual(['vm-2'], [r['id'] for r in index.find('state', 'b')])
+        index.add(CloudstackVmRecord({'id': 'vm-1', 'name': 'renamed'}))
+        self.assertEqual(['vm-2'], [r['id'] for r in index.find('name', 'vm')])
+        self.assertEqual(['vm-1'],
+                         [r['id'] for r in index.find('name', 'renamed')])
+        index.remove('vm-2')
+        index.remove('vm-3')
+        self.assertEqual([], index.find('name', 'vm'))
+        self.assertEqual([], index.find('id', 'vm-2'))
+        self.assertEqual(1, len(index))
+
+        keypairs = CloudstackRecordIndex('name', [
+            CloudstackKeypairRecord({'name': 'kp', 'fingerprint': 'a'})])
+        keypairs.add(CloudstackKeypairRecord({'name': 'kp',
+                                              'fingerprint': 'b'}))
+        self.assertEqual(['b'], [r['fingerprint']
+                                 for r in keypairs.find('name', 'kp')])
+
+    def test_uploader_skips_up_to_date_files(self):
+        """
+        Tests files whose remote sha256 matches are not transferred, and
+        the others are written under a temporary name first.
+        """
+        paths = []
+        for name in ('same', 'changed', 'new'):
+            path = os.path.join(self.tmp_dir, name)
+            with open(path, 'w') as f:
+                f.write(name)
+            paths.append(path)
+        ssh_client = FakeSSHClient({
+            '/remote/same': hashlib.sha256('same').hexdigest(),
+            '/remote/changed': hashlib.sha256('old').hexdigest()})
+        uploaded = CloudstackFileUploader(ssh_client).upload(
+            [(path, '/remote/' + os.path.basename(path)) for path in paths])
+        self.assertEqual(['/remote/changed', '/remote/new'], uploaded)
+        # one command reads every remote digest.
+        self.assertEqual(1, len(ssh_client.commands))
+        self.assertEqual(['/remote/changed', '/remote/new'],
+                         [target for _, target in ssh_client.renames])
+        self.assertEqual([source for source, _ in ssh_client.renames],
+                         [remote for _, remote in ssh_client.puts])
+
+        ssh_client.digests['/remote/changed'] = \
+            hashlib.sha256('changed').hexdigest()
+        ssh_client.digests['/remote/new'] = hashlib.sha256('new').hexdigest()
+        self.assertEqual([], CloudstackFileUploader(ssh_client).upload(
+            [(path, '/remote/' + os.path.basename(path)) for path in paths]))
+
+    def _plan_and_provision(self, cloud):
+        # (commands of the planned creates, mutating calls of provision)
+        self.provider_config['cloudstack']['zone_type'] = 'advanced'
+        self.provider_config['cloudstack']['preflight'] = {'enabled': False}
+        server_config = self.provider_config['compute']['management_server']
+        server_config['instance']['use_baked_template'] = False
+        provider_manager = ProviderManager(self.provider_config)
+        config = provider_manager.provider_config
+        instance_config = config['compute']['management_server']['instance']
+        compute_config = config['compute']
+        resolved = {
+            'keypairs': dict(
+                (name, {'name': name}) for name in (
+                    compute_config['management_server'][
+                        'management_keypair']['name'],
+                    compute_config['agent_servers']['agents_keypair'][
+                        'name'])),
+            'network': CloudStackNetwork('net', 'net', 'offering-1', 'net-1',
+                                         'zone-1', None),
+            'zone': NodeLocation('zone-1', 'zone-1', 'Unknown', None),
+            'image': NodeImage(instance_config['image'], 'image', None),
+            'size': NodeSize('size-1', instance_config['size'], 2048, 0, 0,
+                             0, None)}
+        connector = FakeConnector(config, cloud, FakeNodeDriver)
+        plan = CloudstackPlanner(connector, config,
+                                 FakeResolver(resolved)).plan_provision()
+        del cloud.calls[:]
+        provider_manager.resolved_resources = resolved
+        provider_manager._provision(connector)
+        return ([step['command'] for step in plan['steps']
+                 if step['action'] == 'create'],
+                [command for command in cloud.commands()
+                 if not command.startswith(('list', 'query'))])
+
+    def test_plan_matches_cluster_provision(self):
+        """
+        Tests the plan of a cluster with data volumes and a template copy
+        lists the calls its provisioning makes.
+        """
+        server_config = self.provider_config['compute']['management_server']
+        server_config['cluster'] = {'size': 3}
+        server_config['instance']['data_disks'] = [
+            {'disk_offering': 'Medium', 'mount_point': '/a'},
+            {'disk_offering': 'Medium', 'mount_point': '/b'}]
+        copied = []
+        cloud = FakeCloud({
+            'listTemplates': lambda params: {'template': [
+                {'zoneid': zone_id, 'isready': True}
+                for zone_id in ['zone-2'] + copied], 'count': 1},
+            'copyTemplate': lambda params: copied.append(
+                params['destzoneid']) or {'jobid': 'job-1'},
+            'listDiskOfferings': {'diskoffering': [
+                {'id': 'do-1', 'name': 'Medium'}], 'count': 1},
+            'createVolume': lambda params: {'volume': {
+                'id': params['name'], 'name': params['name']}},
+            'attachVolume': {'volume': {'deviceid': 1}},
+            'deployVirtualMachine': lambda params: {'virtualmachine': {
+                'id': params['name'], 'name': params['name']}},
+            'createLoadBalancerRule': lambda params: {'loadbalancer': {
+                'id': params['name']}},
+            'listPublicIpAddresses': {'publicipaddress': [
+                {'id': 'ip-1', 'ipaddress': '10.0.0.1',
+                 'associatednetworkid': 'net-1'}], 'count': 1}})
+        planned, made = self._plan_and_provision(cloud)
+        self.assertEqual(sorted(made), sorted(planned))
+        self.assertEqual(
+            ['assignToLoadBalancerRule', 'attachVolume', 'copyTemplate',
+             'createAffinityGroup', 'createLoadBalancerRule',
+             'createPortForwardingRule', 'createVolume',
+             'deployVirtualMachine'],
+            sorted(set(planned)))
+        self.assertEqual(3, planned.count('deployVirtualMachine'))
+        # 80 and 8100 are balanced instead.
+        self.assertEqual(4, planned.count('createPortForwardingRule'))
+
+    def test_plan_matches_warm_pool_claim(self):
+        """
+        Tests the plan of a provisioning served from the warm pool lists
+        the claim of a pooled vm instead of a deploy.
+        """
+        server_config = self.provider_config['compute']['management_server']
+        server_config['warm_pool'] = {'size': 1,
+                                      'background_refill': False}
+        self.provider_config['networking']['management_network'][
+            'use_existing'] = True
+        prefix = ProviderManager(self.provider_config).provider_config[
+            'compute']['management_server']['instance']['name'] + \
+            CloudstackWarmPool.NAME_INFIX
+        tags = {}
+        cloud = FakeCloud({
+            'listTemplates': {'template': [
+                {'zoneid': 'zone-1', 'isready': True}], 'count': 1},
+            'listVirtualMachines': lambda params: {'virtualmachine': [
+                {'id': 'vm-1', 'name': prefix + '1'}]
+                if params.get('state') == 'Stopped' else [], 'count': 1},
+            'listPortForwardingRules': {'portforwardingrule': [
+                {'virtualmachineid': 'vm-1', 'ipaddressid': 'ip-1',
+                 'ipaddress': '10.0.0.1'}], 'count': 1},
+            'createTags': lambda params: tags.update(
+                {params['resourceids']: params['tags[0].value']}) or {},
+            'listTags': lambda params: {'tag': [
+                {'key': CloudstackWarmPool.CLAIM_TAG,
+                 'value': tags.get(params['resourceid'])}], 'count': 1},
+            'startVirtualMachine': lambda params: {
+                'virtualmachine': {'id': params['id']}}})
+        planned, made = self._plan_and_provision(cloud)
+        self.assertEqual(made, planned)
+        self.assertEqual(['createTags', 'resetSSHKeyForVirtualMachine',
+                          'startVirtualMachine'], planned)
+
+    def test_plan_teardown_lists_context_resources(self):
+        """
+        Tests the teardown plan covers every resource the context records,
+        skipping those already gone.
+        """
+        self.provider_config['cloudstack']['zone_type'] = 'advanced'
+        config = ProviderManager(self.provider_config).provider_config
+        existing = ['vm-1', 'vm-2', 'lb-1', 'vol-1', 'ip-1']
+        cloud = FakeCloud(dict(
+            (command, lambda params, key=key: {
+                key: [{'id': params['id']}]
+                if params.get('id') in existing else [], 'count': 1})
+            for command, key in (
+                ('listVirtualMachines', 'virtualmachine'),
+                ('listLoadBalancerRules', 'loadbalancerrule'),
+                ('listVolumes', 'volume'),
+                ('listPublicIpAddresses', 'publicipaddress'))))
+        cloud.responses['listAffinityGroups'] = {'affinitygroup': [
+            {'id': 'ag-1', 'name': 'group'}], 'count': 1}
+        plan = CloudstackPlanner(
+            FakeConnector(config, cloud), config, None).plan_teardown({
+                'mgmt_node_id': 'vm-1',
+                'mgmt_node_ids': ['vm-1', 'vm-2', 'vm-3'],
+                'resources': {'load_balancer_rules': ['lb-1', 'lb-2'],
+                              'volumes': ['vol-1'],
+                              'public_ip': 'ip-1',
+                              'affinity_group': 'group'}})
+        steps = [(step['command'], step['resource'], step['action'])
+                 for step in plan['steps']]
+        for step in (('deleteLoadBalancerRule', 'lb-1', 'delete'),
+                     ('deleteLoadBalancerRule', 'lb-2', 'skip'),
+                     ('destroyVirtualMachine', 'vm-2', 'delete'),
+                     ('destroyVirtualMachine', 'vm-3', 'skip'),
+                     ('destroyVirtualMachine', 'vm-1', 'delete'),
+                     ('deleteAffinityGroup', 'group', 'delete'),
+                     ('disassociateIpAddress', 'ip-1', 'delete'),
+                     ('deleteVolume', 'vol-1', 'delete')):
+            self.assertIn(step, steps)
+
+    def test_ssh_sessions_connect_hosts_independently(self):
+        """
+        Tests a host still being connected to holds up only the callers of
+        that host, which share the one session.
+        """
+        class Transport(object):
+            def is_active(self):
+                return True
+
+        class Client(object):
+            def get_transport(self):
+                return Transport()
+
+        unblocked = threading.Event()
+        connects = []
+
+        class SessionPool(CloudstackSSHSessionPool):
+            def _connect(self, host, user, key_filename):
+                connects.append(host)
+                if host == 'booting':
+                    unblocked.wait(5)
+                return Client()
+
+        sessions = SessionPool()
+        clients = []
+        threads = [threading.Thread(
+            target=lambda: clients.append(sessions.get('booting', 'u', 'k')))
+            for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for _ in range(100):
+            if connects:
+                break
+            time.sleep(0.01)
+        started = time.time()
+        sessions.get('up', 'u', 'k')
+        self.assertTrue(time.time() - started < 1)
+        unblocked.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(['booting', 'up'], connects)
+        self.assertTrue(clients[0] is clients[1])
+
+    def test_baked_templates_kept_per_account(self):
+        """
+        Tests a template baked by one account is neither used nor
+        forgotten by the others, and forgotten once its own account no
+        longer lists it.
+        """
+        cache_dir = provider_module.CACHE_DIR
+        provider_module.CACHE_DIR = self.tmp_dir
+        try:
+            configs = {}
+            for api_key in ('key-a', 'key-b'):
+                configs[api_key] = deepcopy(self.provider_config)
+                configs[api_key]['authentication']['api_key'] = api_key
+            packages_key = _get_packages_key(configs['key-a'])
+            _get_template_registry(configs['key-a']).record(
+                packages_key, {'id': 't-baked', 'name': 'baked',
+                               'api_key': 'key-a'})
+            image_id = self.provider_config['compute'][
+                'management_server']['instance']['image']
+            cloud = FakeCloud({'listTemplates': lambda params: {
+                'template': [{'id': image_id, 'name': 'image'}]
+                if params['templatefilter'] == 'executable' else [],
+                'count': 1}})
+
+            cloud_driver = FakeDriver(cloud)
+            cloud_driver.key = 'key-b'
+            self.assertTrue(_get_template_registry(configs['key-b']).get(
+                packages_key) is None)
+            self.assertEqual(image_id, _lookup_management_image(
+                cloud_driver, configs['key-b']).id)
+            # a listing by another account tells nothing of the template.
+            _lookup_management_image(cloud_driver, configs['key-a'])
+            registry = _get_template_registry(configs['key-a'])
+            self.assertEqual('t-baked', registry.get(packages_key)['id'])
+            cloud_driver.key = 'key-a'
+            self.assertEqual(image_id, _lookup_management_image(
+                cloud_driver, configs['key-a']).id)
+            self.assertTrue(registry.get(packages_key) is None)
+        finally:
+            provider_module.CACHE_DIR = cache_dir
@@ -33,6 +33,7 @@ setup(
                                         'cloudify-config.defaults.yaml']},
     install_requires=[
         "scp",
+        "paramiko",
         "jsonschema",
         "IPy==0.81",
         "apache-libcloud>=0.15.1",